@@ -0,0 +1,63 @@
+""" Compares the conversion of raw BSON documents into CrateDB compatible JSON
+by ``export`` with the previous round trip through MongoDB Extended JSON.
+
+Usage, with the package installed: python benchmarks/convert.py [DOCUMENTS]
+"""
+
+import sys
+import time
+from datetime import datetime, timedelta
+
+import bson
+import bsonjs
+import orjson
+from bson.raw_bson import RawBSONDocument
+
+from crate.migr8 import codec, export
+
+
+def make_document(i):
+    return {
+        "_id": bson.ObjectId(),
+        "n": i,
+        "long": bson.Int64(i * 2**32),
+        "price": i / 3,
+        "name": "document %d" % i,
+        "active": i % 2 == 0,
+        "created": datetime(2020, 1, 1) + timedelta(seconds=i, milliseconds=i % 1000),
+        "updated": datetime(2020, 1, 2) + timedelta(minutes=i),
+        "ref": bson.ObjectId(),
+        "tags": ["a", "b", "c"],
+        "address": {"street": "Main Street", "number": i, "zip": "12345"},
+        "items": [{"sku": "x%d" % j, "qty": j} for j in range(5)],
+    }
+
+
+def legacy(document):
+    return orjson.dumps(export.convert(orjson.loads(bsonjs.dumps(document.raw))))
+
+
+def native(document):
+    return codec.dumps(export.convert_document(document))
+
+
+def measure(convert, documents):
+    start = time.perf_counter()
+    for document in documents:
+        convert(document)
+    return len(documents) / (time.perf_counter() - start)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    documents = [RawBSONDocument(bson.encode(make_document(i))) for i in range(count)]
+    assert orjson.loads(legacy(documents[0])) == orjson.loads(native(documents[0]))
+    before = measure(legacy, documents)
+    after = measure(native, documents)
+    print("bsonjs + convert: {0:10.0f} documents/s".format(before))
+    print("single pass:      {0:10.0f} documents/s".format(after))
+    print("speedup:          {0:10.1f}x".format(after / before))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+""" Generates synthetic documents of different shapes for the benchmarks.
+
+Each generator returns a document for a sequence number, drawing its values
+from a seeded random number generator, so that every run measures the same
+documents.
+"""
+
+import random
+from datetime import datetime, timedelta, timezone
+
+import bson
+
+EPOCH = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+
+def object_id(rng):
+    return bson.ObjectId(rng.getrandbits(96).to_bytes(12, "big"))
+
+
+def flat(i, rng):
+    """A small document of scalar values of the common types."""
+
+    return {
+        "_id": object_id(rng),
+        "n": i,
+        "long": bson.Int64(rng.getrandbits(48)),
+        "price": rng.random() * 100,
+        "name": "document %d" % i,
+        "active": rng.random() < 0.5,
+        "created": EPOCH + timedelta(seconds=rng.randrange(10**8)),
+        "ref": object_id(rng),
+        "note": None,
+    }
+
+
+def nested(i, rng, depth=6):
+    """A document whose objects are nested ``depth`` levels deep."""
+
+    document = {"value": i, "label": "leaf"}
+    for level in range(depth):
+        document = {
+            "level": level,
+            "weight": rng.random(),
+            "child": document,
+            "sibling": {"a": rng.randrange(100), "b": "s%d" % level},
+        }
+    document["_id"] = object_id(rng)
+    return document
+
+
+def wide(i, rng, fields=200):
+    """A document with ``fields`` top-level fields of rotating types."""
+
+    document = {"_id": object_id(rng)}
+    for j in range(fields):
+        kind = j % 4
+        if kind == 0:
+            value = rng.randrange(10**6)
+        elif kind == 1:
+            value = rng.random()
+        elif kind == 2:
+            value = "value %d" % j
+        else:
+            value = rng.random() < 0.5
+        document["field_%03d" % j] = value
+    return document
+
+
+def arrays(i, rng, length=20):
+    """A document made of arrays of scalars and of objects."""
+
+    return {
+        "_id": object_id(rng),
+        "numbers": [rng.randrange(1000) for _ in range(length)],
+        "tags": ["tag%d" % rng.randrange(50) for _ in range(length)],
+        "points": [[rng.random(), rng.random()] for _ in range(length // 2)],
+        "items": [
+            {"sku": "x%d" % j, "qty": rng.randrange(10), "price": rng.random()}
+            for j in range(length)
+        ],
+    }
+
+
+def dates(i, rng, count=10):
+    """A document of many dates, as BSON datetimes and as ISO 8601 strings."""
+
+    document = {"_id": object_id(rng)}
+    for j in range(count):
+        date = EPOCH + timedelta(milliseconds=rng.randrange(10**12))
+        document["date_%d" % j] = date
+        document["iso_%d" % j] = date.isoformat(timespec="milliseconds")
+    return document
+
+
+GENERATORS = {
+    "flat": flat,
+    "nested": nested,
+    "wide": wide,
+    "arrays": arrays,
+    "dates": dates,
+}
+
+
+def generate(name, count, seed=0):
+    """Returns ``count`` documents of a generator, as dicts."""
+
+    rng = random.Random(seed)
+    generator = GENERATORS[name]
+    return [generator(i, rng) for i in range(count)]
@@ -0,0 +1,244 @@
+""" Measures the throughput of the extract, translate and export stages on
+synthetic documents, without a MongoDB server.
+
+Each stage is run on the documents of each generator in ``generators.py``,
+and its best time out of ``--repeat`` runs is reported as items and bytes of
+input per second. The items are documents, except for ``translate``, which
+translates the schema of the documents ``--documents`` times, and
+``date_converter``, which converts the ISO 8601 strings of the documents.
+
+The results can be saved as JSON with ``--output``, and compared with the
+results of a previous run with ``--compare``, which fails if a stage has
+become slower by more than ``--threshold``.
+
+Usage, with the package installed:
+
+    python benchmarks/suite.py --output before.json
+    python benchmarks/suite.py --compare before.json
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import bson
+import pymongo
+from bson.raw_bson import RawBSONDocument
+
+from crate.migr8 import codec, export, extract, translate
+from crate.migr8.coerce import Coercer
+
+from generators import GENERATORS, generate
+
+
+def extract_documents(data):
+    schema = {}
+    for document in data["documents"]:
+        extract.extract_schema_from_document(document, schema)
+
+
+def extract_counter(data):
+    counter = extract.SchemaCounter()
+    counter.add(data["documents"])
+    counter.schema()
+
+
+def translate_schema(data):
+    for schemas in data["schemas"]:
+        translate.translate(schemas)
+
+
+def convert(data):
+    dumps = codec.dumps
+    convert_document = export.convert_document
+    for document in data["raw"]:
+        dumps(convert_document(document))
+
+
+def coerce(data):
+    coercer = Coercer(data["schema"]["document"])
+    for document in data["raw"]:
+        coercer(export.convert_document(document))
+
+
+def date_converter(data):
+    convert_date = export.date_converter
+    for value in data["dates"]:
+        convert_date(value)
+
+
+# The stages, and the input data their items are counted in. Translating a
+# schema has no input bytes.
+STAGES = {
+    "extract_schema_from_document": (extract_documents, "documents"),
+    "extract": (extract_counter, "documents"),
+    "translate": (translate_schema, "schemas"),
+    "convert": (convert, "raw"),
+    "coerce": (coerce, "raw"),
+    "date_converter": (date_converter, "dates"),
+}
+
+
+def prepare(name, count):
+    """Generates the input data of the stages for a generator."""
+
+    documents = generate(name, count)
+    raw = [RawBSONDocument(bson.encode(document)) for document in documents]
+    counter = extract.SchemaCounter()
+    counter.add(documents)
+    dates = [
+        value
+        for document in documents
+        for key, value in document.items()
+        if key.startswith("iso_")
+    ]
+    schema = counter.schema()
+    size = sum(len(document.raw) for document in raw)
+    return {
+        "documents": documents,
+        "raw": raw,
+        "schema": schema,
+        "schemas": [{"test": schema}] * count,
+        "dates": dates,
+        "bytes": {
+            "documents": size,
+            "raw": size,
+            "schemas": None,
+            "dates": sum(len(value) for value in dates),
+        },
+    }
+
+
+def measure(stage, data, repeat):
+    """Returns the best time of ``repeat`` runs of a stage."""
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        stage(data)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(generators, stages, count, repeat):
+    results = []
+    for name in generators:
+        data = prepare(name, count)
+        for stage in stages:
+            function, items = STAGES[stage]
+            if not data[items]:
+                continue
+            seconds = measure(function, data, repeat)
+            size = data["bytes"][items]
+            result = {
+                "stage": stage,
+                "generator": name,
+                "items": len(data[items]),
+                "seconds": seconds,
+                "items_per_second": len(data[items]) / seconds,
+                "bytes_per_second": size / seconds if size is not None else None,
+            }
+            results.append(result)
+            line = "{0:30} {1:8} {2:12,.0f} items/s".format(
+                stage, name, result["items_per_second"]
+            )
+            if size is not None:
+                line += " {0:10.1f} MB/s".format(result["bytes_per_second"] / 2**20)
+            print(line)
+    return results
+
+
+def compare(results, path, threshold):
+    """Prints the change of throughput against the results in a file, and
+    returns whether any stage has become slower by more than ``threshold``.
+    """
+
+    with open(path) as f:
+        previous = {
+            (r["stage"], r["generator"]): r["items_per_second"]
+            for r in json.load(f)["results"]
+        }
+    regressed = False
+    print("\nCompared with {0}:".format(path))
+    for result in results:
+        before = previous.get((result["stage"], result["generator"]))
+        if before is None:
+            continue
+        ratio = result["items_per_second"] / before
+        flag = ""
+        if ratio < 1 - threshold:
+            flag = "  REGRESSION"
+            regressed = True
+        print(
+            "{0:30} {1:8} {2:6.2f}x{3}".format(
+                result["stage"], result["generator"], ratio, flag
+            )
+        )
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--documents", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--generator", action="append", choices=sorted(GENERATORS), default=None
+    )
+    parser.add_argument(
+        "--stage", action="append", choices=sorted(STAGES), default=None
+    )
+    parser.add_argument("--output", help="File to save the results to as JSON.")
+    parser.add_argument("--compare", help="File with the results of a previous run.")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Fraction by which a stage may become slower (default: 0.1).",
+    )
+    args = parser.parse_args()
+
+    results = run(
+        args.generator or list(GENERATORS),
+        args.stage or list(STAGES),
+        args.documents,
+        args.repeat,
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "commit": git_commit(),
+                    "date": datetime.now(timezone.utc).isoformat(),
+                    "python": platform.python_version(),
+                    "pymongo": pymongo.version,
+                    "platform": platform.platform(),
+                    "documents": args.documents,
+                    "repeat": args.repeat,
+                    "results": results,
+                },
+                f,
+                indent=4,
+            )
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -20,7 +20,15 @@
 # software solely pursuant to the terms of the relevant commercial agreement.
 
 import argparse
+import asyncio
+import contextlib
+import cProfile
+import functools
 import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import pymongo
 import rich
@@ -29,10 +37,44 @@ from rich.syntax import Syntax
 
 import re
 
-from .extract import extract_schema_from_collection
-from .translate import translate as translate_schema
-from .export import export
+from .extract import (
+    extract_schema_from_collection,
+    extract_schema_from_dump,
+    extract_schema_from_dump_parallel,
+    extract_schema_parallel,
+    progress_display,
+    refresh_schema_from_collection,
+)
+from . import aio, columnar
+from .translate import check_id_column, translate as translate_schema
+from .aggregate import aggregate_schema_from_collection
+from .checkpoint import Checkpoint
+from .coerce import Coercer
+from .columnar import ParquetSink
+from .dump import DumpCollection, check_dump, collection_name
+from .export import (
+    BATCH_SIZE,
+    DeadLetter,
+    combine_filters,
+    date_filter,
+    export,
+    export_parallel,
+    field_projection,
+    parse_date,
+)
+from .metrics import Metrics, Reporter
+from .sink import (
+    COMPRESSIONS,
+    CrateDBError,
+    CrateDBSink,
+    FileSink,
+    StreamSink,
+    parse_size,
+    zstandard,
+)
+from .sync import SyncState, sync
 
+from bson import json_util
 from bson.raw_bson import RawBSONDocument
 
 
@@ -42,16 +84,62 @@ def extract_parser(subargs):
     )
     parser.add_argument("--host", default="localhost", help="MongoDB host")
     parser.add_argument("--port", default=27017, help="MongoDB port")
-    parser.add_argument("--database", required=True, help="MongoDB database")
+    parser.add_argument("--database", help="MongoDB database")
     parser.add_argument(
         "--collection", help="MongoDB collection to create a schema for"
     )
+    parser.add_argument(
+        "--from-dump",
+        metavar="PATH",
+        help="Read the documents from a collection's BSON file written by "
+        "mongodump, instead of from MongoDB. The collection is named after "
+        "the file, unless --collection is given.",
+    )
     parser.add_argument(
         "--scan",
-        choices=["full", "partial"],
-        help="Whether to fully scan the MongoDB collections or only partially.",
+        choices=["full", "partial", "sample"],
+        help="Whether to fully scan the MongoDB collections, only partially, "
+        "or a random sample of documents.",
+    )
+    parser.add_argument(
+        "--sample-size",
+        type=positive_int,
+        help="Number of documents to sample per collection, with --scan sample "
+        "(default: 1000).",
+    )
+    parser.add_argument(
+        "--sample-fraction",
+        type=fraction,
+        help="Fraction of the documents to sample per collection, with --scan "
+        "sample, greater than 0 and at most 1, e.g. 0.01.",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["python", "aggregate"],
+        default="python",
+        help="Whether to build the schema from the documents decoded by the "
+        "client, or using aggregation pipelines on the MongoDB server.",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of collections to extract concurrently.",
+    )
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=1,
+        help="Number of worker processes scanning _id ranges of each "
+        "collection, for full scans. Requires MongoDB 3.2 or newer.",
+    )
+    parser.add_argument(
+        "--since-schema",
+        help="A schema file written by a previous full scan. Only the documents "
+        "added since are scanned, and merged into it.",
     )
     parser.add_argument("-o", "--out", default="mongodb_schema.json")
+    stats_arguments(parser)
 
 
 def translate_parser(subargs):
@@ -62,14 +150,312 @@ def translate_parser(subargs):
     parser.add_argument(
         "-i", "--infile", help="The JSON file to read the MongoDB schema from"
     )
+    parser.add_argument(
+        "--keep-id",
+        nargs="?",
+        const="id",
+        metavar="COLUMN",
+        help="Add a TEXT PRIMARY KEY column for the _id of the documents, named "
+        "COLUMN, or id by default.",
+    )
 
 
 def export_parser(subargs):
     parser = subargs.add_parser("export")
-    parser.add_argument("--collection", required=True)
+    parser.add_argument(
+        "--collection",
+        required=True,
+        action="append",
+        help="Collection to export. With --async, it can be given multiple "
+        "times to export several collections concurrently.",
+    )
+    parser.add_argument("--host", default="localhost", help="MongoDB host")
+    parser.add_argument("--port", default=27017, help="MongoDB port")
+    parser.add_argument("--database", help="MongoDB database")
+    parser.add_argument(
+        "--from-dump",
+        metavar="PATH",
+        help="Read the documents from a collection's BSON file written by "
+        "mongodump, instead of from MongoDB.",
+    )
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=1,
+        help="Number of worker processes, each exporting an _id range of the "
+        "collection, or a range of the --from-dump file. Requires MongoDB 3.2 "
+        "or newer.",
+    )
+    parser.add_argument(
+        "--out",
+        help="Directory to write the exported documents to, instead of stdout. "
+        "In parallel mode, each partition is written to its own file.",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["json", "parquet"],
+        default="json",
+        help="Format of the files written to --out. Parquet files have the "
+        "columns translated from the --schema of the collection, and require "
+        "the pyarrow package.",
+    )
+    parser.add_argument(
+        "--schema",
+        help="A schema file written by extract, with the schema of the "
+        "exported collection. Values which do not match the type of their "
+        "translated column are cast to it, or left out if they can not be.",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=parse_size,
+        help="Split the output files written to --out into chunks of at most "
+        "this many bytes of JSON, e.g. 1GB.",
+    )
+    parser.add_argument(
+        "--compress",
+        choices=sorted(COMPRESSIONS),
+        help="Compress the output files written to --out.",
+    )
+    parser.add_argument(
+        "--target",
+        help="Insert the documents into a CrateDB table directly, instead of "
+        "writing them out, e.g. crate://localhost:4200/doc.table. With --async, "
+        "the table may contain {collection} to name a table per collection.",
+    )
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="Export the collections using asyncio, driving all cursors from a "
+        "single thread. Requires pymongo 4.9 or motor.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=BATCH_SIZE,
+        help="Number of documents fetched from MongoDB and written out at a time.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Number of threads converting documents, while another thread "
+        "fetches them and the documents converted are written out. By default, "
+        "the documents are fetched, converted and written one after another.",
+    )
+    parser.add_argument(
+        "--unordered",
+        action="store_true",
+        help="Write the batches converted by --workers as soon as they are "
+        "ready, instead of in the order they were fetched.",
+    )
+    parser.add_argument(
+        "--bulk-size",
+        type=int,
+        default=1000,
+        help="Number of documents per CrateDB bulk insert request.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="Number of concurrent CrateDB bulk insert requests.",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        help="File to periodically record the progress of the export in.",
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        type=int,
+        default=10000,
+        help="Number of documents between saving checkpoints.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume the export after the last document recorded in the "
+        "checkpoint file.",
+    )
+    parser.add_argument(
+        "--dead-letter",
+        metavar="FILE",
+        help="Write the documents which fail to convert to this file as JSON "
+        "lines, with their _id and error, and carry on with the export. By "
+        "default, the export stops at the first such document.",
+    )
+    parser.add_argument(
+        "--keep-id",
+        nargs="?",
+        const="id",
+        metavar="COLUMN",
+        help="Keep the _id of the documents as a string in COLUMN, or id by "
+        "default, instead of leaving it out. With --target, documents which "
+        "already exist in the table are updated.",
+    )
+    parser.add_argument(
+        "--query",
+        type=query_filter,
+        help="Only export the documents matching this MongoDB query filter, "
+        'given as MongoDB Extended JSON, e.g. \'{"status": "active"}\'.',
+    )
+    parser.add_argument(
+        "--fields",
+        type=field_list,
+        help="Comma-separated list of fields to export, as dotted paths. The "
+        "other fields are not transferred from MongoDB.",
+    )
+    parser.add_argument(
+        "--exclude-fields",
+        type=field_list,
+        help="Comma-separated list of fields to leave out, as dotted paths. "
+        "They are not transferred from MongoDB.",
+    )
+    parser.add_argument(
+        "--date-field",
+        metavar="FIELD",
+        help="Date field to select the documents by, with --since and --until.",
+    )
+    parser.add_argument(
+        "--since",
+        type=iso_date,
+        help="Only export the documents whose --date-field is at or after this "
+        "ISO 8601 date or time, in UTC unless it has an offset.",
+    )
+    parser.add_argument(
+        "--until",
+        type=iso_date,
+        help="Only export the documents whose --date-field is before this ISO "
+        "8601 date or time, in UTC unless it has an offset.",
+    )
+    stats_arguments(parser)
+
+
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer: {value}")
+    return number
+
+
+def fraction(value):
+    try:
+        number = float(value)
+    except ValueError:
+        number = 0
+    if not 0 < number <= 1:
+        raise argparse.ArgumentTypeError(
+            f"must be greater than 0 and at most 1: {value}"
+        )
+    return number
+
+
+def query_filter(value):
+    try:
+        query = json_util.loads(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"invalid query filter: {e}")
+    if not isinstance(query, dict):
+        raise argparse.ArgumentTypeError("the query filter must be an object")
+    return query
+
+
+def field_list(value):
+    return [field.strip() for field in value.split(",") if field.strip()]
+
+
+def iso_date(value):
+    try:
+        return parse_date(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid ISO 8601 date: {value}")
+
+
+def stats_arguments(parser):
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Print the documents and bytes read per second, and the time "
+        "spent in each stage, to stderr every --stats-interval seconds and at "
+        "the end. Not supported with --parallel or --async.",
+    )
+    parser.add_argument(
+        "--stats-file",
+        metavar="FILE",
+        help="Save the statistics to this file in the Prometheus text format, "
+        "every --stats-interval seconds and at the end.",
+    )
+    parser.add_argument(
+        "--stats-interval",
+        type=float,
+        default=10,
+        help="Number of seconds between reporting statistics (default: 10).",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="FILE",
+        help="Profile the command with cProfile, and save the statistics to "
+        "this file, to be read with python -m pstats. Only the main thread is "
+        "profiled.",
+    )
+
+
+def sync_parser(subargs):
+    parser = subargs.add_parser(
+        "sync",
+        help="Export a MongoDB collection into a CrateDB table, and keep "
+        "applying its changes",
+    )
     parser.add_argument("--host", default="localhost", help="MongoDB host")
     parser.add_argument("--port", default=27017, help="MongoDB port")
     parser.add_argument("--database", required=True, help="MongoDB database")
+    parser.add_argument("--collection", required=True, help="MongoDB collection")
+    parser.add_argument(
+        "--target",
+        required=True,
+        help="CrateDB table to replicate the collection into, e.g. "
+        "crate://localhost:4200/doc.table. It needs a primary key column "
+        "for the _id, see translate --keep-id.",
+    )
+    parser.add_argument(
+        "--keep-id",
+        default="id",
+        metavar="COLUMN",
+        help="Primary key column holding the _id of the documents.",
+    )
+    parser.add_argument(
+        "--state",
+        help="File to record the position in the change stream in. If it "
+        "exists, the sync continues from there, without exporting the "
+        "collection again.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        help="Maximum number of changes applied at a time.",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=1.0,
+        help="Maximum number of seconds a change waits before it is applied.",
+    )
+    parser.add_argument(
+        "--bulk-size",
+        type=int,
+        default=1000,
+        help="Number of documents per CrateDB bulk insert request.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="Number of concurrent CrateDB bulk insert requests.",
+    )
 
 
 def get_args():
@@ -78,9 +464,30 @@ def get_args():
     extract_parser(subparsers)
     translate_parser(subparsers)
     export_parser(subparsers)
+    sync_parser(subparsers)
     return parser.parse_args()
 
 
+def stats_reporter(args, command, **labels):
+    """Returns the metrics to measure a command in, and a reporter of them, as
+    set up by the --stats arguments, or None and a context doing nothing.
+    """
+
+    if not args.stats and not args.stats_file:
+        return None, contextlib.nullcontext()
+    if args.parallel > 1 or getattr(args, "use_async", False):
+        raise SystemExit("--stats can not be combined with --parallel or --async")
+    labels = {name: value for name, value in labels.items() if value}
+    metrics = Metrics(command=command, **labels)
+    report = None
+    if args.stats:
+        report = functools.partial(print, file=sys.stderr, flush=True)
+    reporter = Reporter(
+        metrics, args.stats_interval, report=report, path=args.stats_file
+    )
+    return metrics, reporter
+
+
 def parse_input_numbers(s: str):
     """Parse an input string for numbers and ranges.
 
@@ -107,7 +514,11 @@ def extract_to_file(args):
     a JSON file.
     """
 
-    schema = extract(args)
+    metrics, reporter = stats_reporter(
+        args, "extract", database=args.database, collection=args.collection
+    )
+    with reporter:
+        schema = extract(args, metrics)
     rich.print(f"\nWriting resulting schema to {args.out}...")
     with open(args.out, "w") as out:
         json.dump(schema, out, indent=4)
@@ -147,22 +558,39 @@ def gather_collections(database):
     return filtered_collections
 
 
-def extract(args):
+def extract(args, metrics=None):
     """Extract schemas from MongoDB collections.
 
     This asks the user for which collections they would like to extract,
     iterates over these collections and returns a dictionary of schemas for
-    each of the selected collections.
+    each of the selected collections. Their scans are measured in the
+    optional ``metrics``.
     """
 
+    if args.scan != "sample" and (args.sample_size or args.sample_fraction):
+        raise SystemExit("--sample-size and --sample-fraction require --scan sample")
+    if args.sample_size and args.sample_fraction:
+        raise SystemExit("--sample-size can not be combined with --sample-fraction")
     rich.print(
         "\n[green bold]MongoDB[/green bold] -> [blue bold]CrateDB[/blue bold] Exporter :: Schema Extractor\n\n"
     )
 
+    if args.from_dump:
+        return extract_dump(args, metrics)
+    if not args.database:
+        raise SystemExit("--database is required, unless --from-dump is given")
+
     client = pymongo.MongoClient(args.host, int(args.port))
     db = client[args.database]
+    previous = {}
+    if args.since_schema:
+        with open(args.since_schema) as f:
+            previous = json.load(f)
+
     if args.collection:
         filtered_collections = [args.collection]
+    elif previous:
+        filtered_collections = list(previous)
     else:
         filtered_collections = gather_collections(db)
 
@@ -170,7 +598,17 @@ def extract(args):
         rich.print("\nExcluding all collections. Nothing to do.")
         exit(0)
 
-    if args.scan:
+    if args.engine == "aggregate" and args.scan == "sample":
+        rich.print("\nThe aggregate engine does not support sampled scans.")
+        exit(1)
+
+    sample_size = sample_fraction = None
+    if args.scan == "sample":
+        partial = False
+        sample_fraction = args.sample_fraction
+        if sample_fraction is None:
+            sample_size = args.sample_size or 1000
+    elif args.scan or previous:
         partial = args.scan == "partial"
     else:
         rich.print("\nDo a [red bold]full[/red bold] collection scan?")
@@ -185,20 +623,93 @@ def extract(args):
             f"\nExecuting a [red bold]{'partial' if partial else 'full'}[/red bold] scan..."
         )
 
+    def extract_collection(collection, cancel=None):
+        if "last_id" in previous.get(collection, {}):
+            return refresh_schema_from_collection(
+                db[collection],
+                previous[collection],
+                cancel=cancel,
+                metrics=metrics,
+            )
+        if args.engine == "aggregate":
+            rich.print(f"Aggregating schema of {collection}...")
+            return aggregate_schema_from_collection(db[collection], partial)
+        if args.parallel > 1 and not partial and args.scan != "sample":
+            return extract_schema_parallel(
+                args.host,
+                args.port,
+                args.database,
+                collection,
+                args.parallel,
+            )
+        return extract_schema_from_collection(
+            db[collection],
+            partial,
+            sample_size=sample_size,
+            sample_fraction=sample_fraction,
+            cancel=cancel,
+            metrics=metrics,
+        )
+
     schemas = {}
-    for collection in filtered_collections:
-        schemas[collection] = extract_schema_from_collection(db[collection], partial)
+    if args.jobs <= 1:
+        for collection in filtered_collections:
+            schemas[collection] = extract_collection(collection)
+        return schemas
+
+    cancel = threading.Event()
+    with ThreadPoolExecutor(args.jobs) as pool, progress_display():
+        futures = [
+            (collection, pool.submit(extract_collection, collection, cancel))
+            for collection in filtered_collections
+        ]
+        try:
+            for collection, future in futures:
+                schemas[collection] = future.result()
+        except KeyboardInterrupt:
+            # Stop the running extractions, and keep their partial schemas.
+            cancel.set()
+            for collection, future in futures:
+                if not future.cancel():
+                    schemas[collection] = future.result()
     return schemas
 
 
-def translate(schema):
+def extract_dump(args, metrics=None):
+    """Extracts the schema of a collection from its mongodump file."""
+
+    if args.scan in ("partial", "sample") or args.since_schema:
+        raise SystemExit(
+            "--from-dump can not be combined with --since-schema, or partial "
+            "and sampled scans"
+        )
+    if args.engine == "aggregate":
+        raise SystemExit("The aggregate engine requires a MongoDB server.")
+    try:
+        check_dump(args.from_dump)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    name = args.collection or collection_name(args.from_dump)
+    if args.parallel > 1:
+        schema = extract_schema_from_dump_parallel(args.from_dump, args.parallel)
+        return {name: schema}
+    with progress_display() as progress:
+        t = progress.add_task(name, total=os.path.getsize(args.from_dump))
+        schema = extract_schema_from_dump(args.from_dump, task=t, metrics=metrics)
+        return {name: schema}
+
+
+def translate(schema, id_column=None):
     """Translates a given schema into a CrateDB compatable CREATE TABLE SQL
     statement.
     """
+    try:
+        sql_queries = translate_schema(schema, id_column)
+    except ValueError as e:
+        raise SystemExit(f"{e}, pass another column name to --keep-id.")
     rich.print(
         "\n[green bold]MongoDB[/green bold] -> [blue bold]CrateDB[/blue bold] Exporter :: Schema Extractor\n\n"
     )
-    sql_queries = translate_schema(schema)
     for collection, query in sql_queries.items():
         syntax = Syntax(query, "sql")
         rich.print(f"Collection [blue bold]'{collection}'[/blue bold]:")
@@ -211,25 +722,431 @@ def translate_from_file(args):
 
     with open(args.infile) as f:
         schema = json.load(f)
-        translate(schema)
+        translate(schema, args.keep_id)
 
 
 def export_to_stdout(args):
+    if args.resume and not args.checkpoint:
+        raise SystemExit("--resume requires --checkpoint")
+    if args.from_dump:
+        if args.checkpoint or args.use_async:
+            raise SystemExit(
+                "--from-dump can not be combined with --checkpoint or --async"
+            )
+        if args.query or args.fields or args.exclude_fields or args.date_field:
+            raise SystemExit(
+                "--from-dump can not be combined with --query, --fields, "
+                "--exclude-fields or --date-field"
+            )
+        try:
+            check_dump(args.from_dump)
+        except ValueError as e:
+            raise SystemExit(str(e))
+    elif not args.database:
+        raise SystemExit("--database is required, unless --from-dump is given")
+    if (args.since or args.until) and not args.date_field:
+        raise SystemExit("--since and --until require --date-field")
+    export_filters(args)
+    if args.checkpoint and args.parallel > 1:
+        raise SystemExit("--checkpoint can not be combined with --parallel")
+    if args.checkpoint and args.unordered:
+        raise SystemExit("--checkpoint can not be combined with --unordered")
+    if (args.chunk_size or args.compress) and not args.out:
+        raise SystemExit("--chunk-size and --compress require --out")
+    if args.format == "json" and args.compress == "zstd" and zstandard is None:
+        raise SystemExit("--compress zstd requires the zstandard package")
+    if args.format == "parquet":
+        if not args.out or not args.schema:
+            raise SystemExit("--format parquet requires --out and --schema")
+        if args.target or args.chunk_size or args.checkpoint:
+            raise SystemExit(
+                "--format parquet can not be combined with --target, "
+                "--chunk-size or --checkpoint"
+            )
+        if columnar.pa is None:
+            raise SystemExit("--format parquet requires the pyarrow package")
+    if args.use_async:
+        if args.checkpoint or args.parallel > 1 or args.workers:
+            raise SystemExit(
+                "--async can not be combined with --checkpoint, --parallel or "
+                "--workers"
+            )
+    elif len(args.collection) > 1:
+        raise SystemExit("Multiple collections can only be exported with --async")
+    metrics, reporter = stats_reporter(
+        args, "export", database=args.database, collection=args.collection[0]
+    )
+    schemas = load_schemas(args)
+    if args.keep_id is not None:
+        for name, schema in schemas.items():
+            try:
+                check_id_column(name, schema, args.keep_id)
+            except ValueError as e:
+                raise SystemExit(f"{e}, pass another column name to --keep-id.")
+    coercers = {name: Coercer(schema, args.keep_id) for name, schema in schemas.items()}
+    dead_letter = None
+    if args.dead_letter:
+        dead_letter = DeadLetter(args.dead_letter, append=args.resume)
+    try:
+        if args.use_async:
+            asyncio.run(export_async(args, schemas, coercers, dead_letter))
+        else:
+            with reporter:
+                export_collection(args, schemas, coercers, dead_letter, metrics)
+    finally:
+        if dead_letter is not None:
+            dead_letter.close()
+    report_coercion(coercers)
+    if dead_letter is not None and dead_letter.count:
+        rich.print(
+            f"Skipped {dead_letter.count} documents which failed to convert, "
+            f"see {args.dead_letter}.",
+            file=sys.stderr,
+        )
+
+
+def export_filters(args):
+    """Returns the query filter and the projection of the documents to export,
+    as given by the export arguments.
+    """
+
+    query = combine_filters(
+        args.query, date_filter(args.date_field, args.since, args.until)
+    )
+    try:
+        projection = field_projection(args.fields, args.exclude_fields)
+    except ValueError as e:
+        raise SystemExit(f"{e}, see --fields and --exclude-fields")
+    return query or None, projection
+
+
+def export_collection(args, schemas, coercers, dead_letter=None, metrics=None):
+    """Exports a single collection, as set up by the export arguments, and
+    measures it in the optional ``metrics``.
+    """
+
+    collection = args.collection[0]
+    query, projection = export_filters(args)
+
+    sink_factory = None
+    if args.target:
+        sink_factory = functools.partial(
+            CrateDBSink,
+            args.target,
+            batch_size=args.bulk_size,
+            concurrency=args.concurrency,
+            primary_key=args.keep_id,
+        )
+
+    if args.parallel > 1:
+        coerce_factory = None
+        if collection in schemas:
+            coerce_factory = functools.partial(
+                Coercer, schemas[collection], args.keep_id
+            )
+        coerce = export_parallel(
+            args.host,
+            args.port,
+            args.database,
+            collection,
+            args.parallel,
+            directory=args.out,
+            sink_factory=sink_factory,
+            chunk_size=args.chunk_size,
+            compress=args.compress,
+            batch_size=args.batch_size,
+            schema=schemas.get(collection) if args.format == "parquet" else None,
+            coerce_factory=coerce_factory,
+            dead_letter=dead_letter,
+            id_column=args.keep_id,
+            dump=args.from_dump,
+            query=query,
+            projection=projection,
+        )
+        if coerce is not None:
+            coercers[collection] = coerce
+        return
+
+    if args.from_dump:
+        source = DumpCollection(args.from_dump)
+    else:
+        client = pymongo.MongoClient(
+            args.host, int(args.port), document_class=RawBSONDocument
+        )
+        source = client[args.database][collection]
+    checkpoint = None
+    if args.checkpoint:
+        checkpoint = Checkpoint(
+            args.checkpoint,
+            args.database,
+            collection,
+            interval=args.checkpoint_interval,
+        )
+        if args.resume:
+            checkpoint.load()
+            if checkpoint.resumed:
+                rich.print(
+                    f"Resuming export after {checkpoint.count} documents.",
+                    file=sys.stderr,
+                )
+
+    if sink_factory:
+        sink = sink_factory()
+        try:
+            export(
+                source,
+                sink,
+                checkpoint=checkpoint,
+                batch_size=args.batch_size,
+                workers=args.workers,
+                ordered=not args.unordered,
+                coerce=coercers.get(collection),
+                dead_letter=dead_letter,
+                id_column=args.keep_id,
+                metrics=metrics,
+                query=query,
+                projection=projection,
+            )
+        finally:
+            sink.close()
+        rich.print(
+            f"Inserted {sink.inserted} documents into {args.target}, "
+            f"{sink.failed} failed.",
+            file=sys.stderr,
+        )
+    elif args.out:
+        resumed = checkpoint is not None and checkpoint.resumed
+        sink = file_sink(
+            args,
+            collection,
+            schemas,
+            # Checkpoints saved by earlier versions have no output position.
+            append=resumed and checkpoint.output is None,
+            position=checkpoint.output if resumed else None,
+        )
+        if checkpoint is not None:
+            checkpoint.position = sink.position
+        try:
+            export(
+                source,
+                sink,
+                checkpoint=checkpoint,
+                batch_size=args.batch_size,
+                workers=args.workers,
+                ordered=not args.unordered,
+                coerce=coercers.get(collection),
+                dead_letter=dead_letter,
+                id_column=args.keep_id,
+                metrics=metrics,
+                query=query,
+                projection=projection,
+            )
+        finally:
+            sink.close()
+        if getattr(sink, "nulled", 0):
+            rich.print(
+                f"Wrote {sink.nulled} values of {collection} which do not match "
+                "the type of their column as nulls.",
+                file=sys.stderr,
+            )
+    else:
+        export(
+            source,
+            checkpoint=checkpoint,
+            batch_size=args.batch_size,
+            workers=args.workers,
+            ordered=not args.unordered,
+            coerce=coercers.get(collection),
+            dead_letter=dead_letter,
+            id_column=args.keep_id,
+            metrics=metrics,
+            query=query,
+            projection=projection,
+        )
+
+
+def load_schemas(args):
+    """Returns the document schemas of the exported collections from the
+    --schema file, by collection name.
+    """
+
+    if not args.schema:
+        return {}
+    with open(args.schema) as f:
+        schemas = json.load(f)
+    missing = [name for name in args.collection if name not in schemas]
+    if missing:
+        raise SystemExit(
+            "Schema file {0} has no schema for {1}".format(
+                args.schema, ", ".join(missing)
+            )
+        )
+    return {name: schemas[name]["document"] for name in args.collection}
+
+
+def file_sink(args, name, schemas, append=False, position=None):
+    """Returns a sink writing a collection's documents to --out, continuing
+    at the ``position`` of a checkpoint, if given.
+    """
+
+    manifest = os.path.join(args.out, f"{name}.manifest.json")
+    if args.format == "parquet":
+        return ParquetSink(
+            args.out,
+            name,
+            schemas[name],
+            compress=args.compress,
+            manifest=manifest,
+            id_column=args.keep_id,
+        )
+    return FileSink(
+        args.out,
+        name,
+        chunk_size=args.chunk_size,
+        compress=args.compress,
+        manifest=manifest,
+        append=append,
+        position=position,
+    )
+
+
+def report_coercion(coercers):
+    for name, coercer in coercers.items():
+        coerced = sum(coercer.coerced.values())
+        dropped = sum(coercer.dropped.values())
+        if not coerced and not dropped:
+            continue
+        fields = []
+        for path in sorted(set(coercer.coerced) | set(coercer.dropped)):
+            fields.append(
+                f"{path}: {coercer.coerced[path]} coerced, "
+                f"{coercer.dropped[path]} dropped"
+            )
+        rich.print(
+            f"Coerced {coerced} and dropped {dropped} values of {name} "
+            f"({', '.join(fields)}).",
+            file=sys.stderr,
+        )
+
+
+async def export_async(args, schemas, coercers, dead_letter=None):
+    def sink_factory(name):
+        if args.target:
+            sink = CrateDBSink(
+                args.target.format(collection=name),
+                batch_size=args.bulk_size,
+                concurrency=args.concurrency,
+                primary_key=args.keep_id,
+            )
+        elif args.out:
+            sink = file_sink(args, name, schemas)
+        else:
+            sink = StreamSink(sys.stdout.buffer)
+        return aio.ThreadSink(sink)
+
+    query, projection = export_filters(args)
+    client = aio.connect(args.host, args.port)
+    try:
+        sinks = await aio.export_collections(
+            client,
+            args.database,
+            args.collection,
+            sink_factory,
+            batch_size=args.batch_size,
+            coercers=coercers,
+            dead_letter=dead_letter,
+            id_column=args.keep_id,
+            query=query,
+            projection=projection,
+        )
+    finally:
+        await aio.close(client)
+    if args.target:
+        for name, sink in zip(args.collection, sinks):
+            rich.print(
+                f"Inserted {sink.sink.inserted} documents from {name} into "
+                f"{args.target.format(collection=name)}, {sink.sink.failed} failed.",
+                file=sys.stderr,
+            )
+
+
+def sync_to_target(args):
+    """Exports a collection into a CrateDB table, and applies its changes until
+    interrupted.
+    """
+
     client = pymongo.MongoClient(
         args.host, int(args.port), document_class=RawBSONDocument
     )
-    db = client[args.database]
-    export(db[args.collection])
+    state = None
+    if args.state:
+        state = SyncState(args.state, args.database, args.collection)
+        state.load()
+    if state is None or state.resume_token is None:
+        rich.print(f"Exporting {args.collection} to {args.target}...", file=sys.stderr)
+    else:
+        rich.print(f"Resuming sync of {args.collection}.", file=sys.stderr)
+
+    def report(upserted, deleted):
+        rich.print(
+            f"Applied {upserted} upserts and {deleted} deletes.", file=sys.stderr
+        )
+
+    sink = CrateDBSink(
+        args.target,
+        batch_size=args.bulk_size,
+        concurrency=args.concurrency,
+        primary_key=args.keep_id,
+    )
+    try:
+        stopped = sync(
+            client[args.database][args.collection],
+            sink,
+            id_column=args.keep_id,
+            state=state,
+            batch_size=args.batch_size,
+            interval=args.interval,
+            report=report,
+        )
+    except KeyboardInterrupt:
+        stopped = None
+    except CrateDBError as e:
+        raise SystemExit(str(e))
+    finally:
+        sink.close()
+        client.close()
+    if stopped is not None:
+        rich.print(f"Change stream ended by a {stopped} event.", file=sys.stderr)
+    rich.print(
+        f"Upserted {sink.inserted} and deleted {sink.deleted} documents, "
+        f"{sink.failed} failed.",
+        file=sys.stderr,
+    )
 
 
 def main():
     args = get_args()
+    profile = getattr(args, "profile", None)
+    if profile is None:
+        run(args)
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(run, args)
+    finally:
+        profiler.dump_stats(profile)
+        rich.print(f"Saved the profile to {profile}.", file=sys.stderr)
+
+
+def run(args):
     if args.command == "extract":
         extract_to_file(args)
     elif args.command == "translate":
         translate_from_file(args)
     elif args.command == "export":
         export_to_stdout(args)
+    elif args.command == "sync":
+        sync_to_target(args)
 
 
 if __name__ == "__main__":
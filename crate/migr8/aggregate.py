@@ -0,0 +1,204 @@
+# -*- coding: utf-8; -*-
+#
+# Licensed to CRATE Technology GmbH ("Crate") under one or more contributor
+# license agreements.  See the NOTICE file distributed with this work for
+# additional information regarding copyright ownership.  Crate licenses
+# this file to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  You may
+# obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# However, if you have executed another commercial license agreement
+# with Crate these terms will supersede the license and you may use the
+# software solely pursuant to the terms of the relevant commercial agreement.
+
+""" Extracts a schema definition from a MongoDB collection on the server.
+
+Instead of fetching and decoding every document, this runs aggregation
+pipelines which turn each object into one document per field using
+``$objectToArray``, and count the fields by name and ``$type`` with
+``$group``. Only these counts are transferred to the client.
+
+One pipeline is run for each level of the schema: the fields of all objects
+and the elements of all arrays found on the previous level are counted by
+one ``$facet`` each, which narrows down the documents to these values. The
+collection is therefore scanned once per level of nesting, and once more to
+count the documents. The resulting schema has the same structure as the one
+built by ``extract_schema_from_collection``.
+
+This requires MongoDB 3.4.4 or newer.
+"""
+
+from pymongo.collection import Collection
+
+# Maps the names returned by ``$type`` to the type names used in schemas.
+TYPES_MAP = {
+    "objectId": "OID",
+    "date": "DATETIME",
+    "timestamp": "TIMESTAMP",
+    "long": "INT64",
+    "string": "STRING",
+    "bool": "BOOLEAN",
+    "int": "INTEGER",
+    "double": "FLOAT",
+    "decimal": "DECIMAL128",
+    "binData": "BINARY",
+    "regex": "REGEX",
+    "null": "NULL",
+    "array": "ARRAY",
+    "object": "OBJECT",
+}
+
+
+def aggregate_schema_from_collection(collection: Collection, partial: bool):
+    """Extracts a schema definition from a collection, using aggregation
+    pipelines.
+
+    If the extraction is partial, only the first document in the collection is
+    used to create the schema.
+    """
+
+    stages = [{"$limit": 1}] if partial else []
+    count = 0
+    for result in aggregate(collection, stages + [{"$count": "count"}]):
+        count = result["count"]
+    document = {}
+    level = [("object", [], "$$ROOT", document)]
+    while level:
+        level = aggregate_level(collection, stages, level)
+    return {"count": count, "document": document}
+
+
+def aggregate(collection, pipeline):
+    return collection.aggregate(pipeline, allowDiskUse=True)
+
+
+def get_type(name):
+    return TYPES_MAP.get(name, "UNKNOWN")
+
+
+def field_stages(expression):
+    """Stages turning each object into one document per field, holding the
+    field in ``_f``, its position in ``_i`` and its type in ``_t``.
+    """
+
+    return [
+        {"$project": {"_f": {"$objectToArray": expression}}},
+        {"$unwind": {"path": "$_f", "includeArrayIndex": "_i"}},
+        {"$addFields": {"_t": {"$type": "$_f.v"}}},
+    ]
+
+
+FIELD_GROUP = [
+    {
+        "$group": {
+            "_id": {"k": "$_f.k", "t": "$_t"},
+            "count": {"$sum": 1},
+            "position": {"$min": "$_i"},
+        }
+    },
+    {"$sort": {"position": 1, "count": -1}},
+]
+
+
+def element_stages(expression):
+    """Stages turning each array into one document per element, holding the
+    element in ``_e`` and its type in ``_t``.
+    """
+
+    return [
+        {"$project": {"_e": expression}},
+        {"$unwind": "$_e"},
+        {"$addFields": {"_t": {"$type": "$_e"}}},
+    ]
+
+
+ELEMENT_GROUP = [
+    {"$group": {"_id": "$_t", "count": {"$sum": 1}}},
+    {"$sort": {"count": -1}},
+]
+
+
+def aggregate_level(collection, stages, level):
+    """Counts the fields of the objects, and the elements of the arrays, of one
+    level of the schema using a single pipeline, and fills in their schemas.
+
+    Each value of the level is described by its ``$type``, the stages
+    narrowing down the documents yielded by ``stages`` to it, the expression
+    of it, and the schema to fill in, which is the "document" of an object,
+    or the "types" of an array. The values nested in them are returned in the
+    same form, as the next level.
+    """
+
+    facets = {}
+    for i, (server_type, narrow, expression, _) in enumerate(level):
+        if server_type == "object":
+            facets[str(i)] = narrow + field_stages(expression) + FIELD_GROUP
+        else:
+            facets[str(i)] = narrow + element_stages(expression) + ELEMENT_GROUP
+    results = next(iter(aggregate(collection, stages + [{"$facet": facets}])), {})
+
+    nested = []
+    for i, (server_type, narrow, expression, schema) in enumerate(level):
+        if server_type == "object":
+            add_fields = add_document
+            narrow = narrow + field_stages(expression)
+        else:
+            add_fields = add_array
+            narrow = narrow + element_stages(expression)
+        nested.extend(add_fields(schema, results.get(str(i), []), narrow))
+    return nested
+
+
+def add_document(schema, results, stages):
+    """Adds the counts of the fields of objects to their schema, and returns
+    the objects and arrays nested in them, see ``aggregate_level``.
+    """
+
+    nested = []
+    for result in results:
+        name, server_type = result["_id"]["k"], result["_id"]["t"]
+        item_type = get_type(server_type)
+        field = schema.setdefault(name, {"count": 0, "types": {}})
+        if item_type not in field["types"]:
+            field["types"][item_type] = {"count": 0}
+        field["count"] += result["count"]
+        entry = field["types"][item_type]
+        entry["count"] += result["count"]
+        if item_type in ("OBJECT", "ARRAY"):
+            match = stages + [{"$match": {"_f.k": name, "_t": server_type}}]
+            nested.append(nested_value(server_type, match, "$_f.v", entry))
+    return nested
+
+
+def add_array(schema, results, stages):
+    """Adds the counts of the elements of arrays to their schema, and returns
+    the objects and arrays nested in them, see ``aggregate_level``.
+    """
+
+    nested = []
+    for result in results:
+        server_type = result["_id"]
+        item_type = get_type(server_type)
+        if item_type not in schema:
+            schema[item_type] = {"count": 0}
+        schema[item_type]["count"] += result["count"]
+        if item_type in ("OBJECT", "ARRAY"):
+            match = stages + [{"$match": {"_t": server_type}}]
+            nested.append(nested_value(server_type, match, "$_e", schema[item_type]))
+    return nested
+
+
+def nested_value(server_type, stages, expression, entry):
+    if server_type == "object":
+        schema = entry.setdefault("document", {})
+    else:
+        schema = entry.setdefault("types", {})
+    return (server_type, stages, expression, schema)
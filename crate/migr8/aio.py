@@ -0,0 +1,179 @@
+# -*- coding: utf-8; -*-
+#
+# Licensed to CRATE Technology GmbH ("Crate") under one or more contributor
+# license agreements.  See the NOTICE file distributed with this work for
+# additional information regarding copyright ownership.  Crate licenses
+# this file to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  You may
+# obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# However, if you have executed another commercial license agreement
+# with Crate these terms will supersede the license and you may use the
+# software solely pursuant to the terms of the relevant commercial agreement.
+
+""" Exports MongoDB collections from a single asyncio event loop.
+
+The cursors of many collections, and the bulk requests inserting their
+documents into CrateDB, are driven concurrently without a thread for each.
+Documents are read using ``pymongo``'s ``AsyncMongoClient``, or Motor's
+``AsyncIOMotorClient`` with older versions of ``pymongo``, and converted with
+``export.convert_batch``.
+
+The sinks are wrapped by ``ThreadSink``, which writes to them from a thread,
+so that e.g. ``sink.CrateDBSink`` issues its bulk requests from its own pool
+of keep-alive connections.
+"""
+
+import asyncio
+import inspect
+
+from bson.raw_bson import RawBSONDocument
+
+from .export import BATCH_SIZE, convert_batch
+
+try:
+    from pymongo import AsyncMongoClient
+except ImportError:  # pymongo < 4.9
+    try:
+        from motor.motor_asyncio import AsyncIOMotorClient as AsyncMongoClient
+    except ImportError:
+        AsyncMongoClient = None
+
+
+def connect(host, port):
+    """Returns an asynchronous MongoDB client, reading raw BSON documents."""
+
+    if AsyncMongoClient is None:
+        raise RuntimeError("Asynchronous exports require pymongo 4.9 or motor")
+    return AsyncMongoClient(host, int(port), document_class=RawBSONDocument)
+
+
+async def close(client):
+    # ``AsyncMongoClient.close`` is a coroutine, Motor's is not.
+    result = client.close()
+    if inspect.isawaitable(result):
+        await result
+
+
+async def export(
+    collection,
+    sink,
+    query=None,
+    batch_size=BATCH_SIZE,
+    coerce=None,
+    dead_letter=None,
+    id_column=None,
+    projection=None,
+):
+    """Exports the documents of a collection to an asynchronous sink, in
+    batches of ``batch_size`` documents, optionally passing them through a
+    ``coerce`` function. The documents which fail to convert are recorded in
+    the ``dead_letter``, if given, instead of aborting the export. The ``_id``
+    is kept in the ``id_column``, if given. The documents can be restricted
+    by a ``query`` filter, and to the fields of a ``projection``.
+    """
+
+    def convert_documents(batch):
+        documents, _, failures = convert_batch(
+            batch, dead_letter is not None, id_column
+        )
+        if coerce is not None:
+            documents = [coerce(d) for d in documents]
+        return documents, failures
+
+    async def convert(batch):
+        # Converting is CPU bound, so it runs in a thread, not to block the
+        # other collections and requests. The dead letters are recorded here,
+        # as they are shared with the other collections.
+        documents, failures = await asyncio.get_running_loop().run_in_executor(
+            None, convert_documents, batch
+        )
+        for document, error in failures:
+            dead_letter.add(document, error)
+        return documents
+
+    options = {"batch_size": batch_size}
+    if projection:
+        options["projection"] = projection
+    batch = []
+    async for document in collection.find(query or {}, **options):
+        batch.append(document)
+        if len(batch) >= batch_size:
+            await sink.write_batch(await convert(batch))
+            batch = []
+    if batch:
+        await sink.write_batch(await convert(batch))
+    await sink.flush()
+    if dead_letter is not None:
+        dead_letter.flush()
+
+
+async def export_collections(
+    client,
+    database,
+    collections,
+    sink_factory,
+    batch_size=BATCH_SIZE,
+    coercers=None,
+    dead_letter=None,
+    id_column=None,
+    query=None,
+    projection=None,
+):
+    """Exports several collections concurrently, each to its own sink created
+    by calling ``sink_factory`` with the name of the collection, and coerced
+    by its coercer in ``coercers``, if any. The documents of all collections
+    which fail to convert are recorded in the ``dead_letter``, if given.
+    The ``query`` and ``projection`` apply to all collections. Returns the
+    sinks, once all collections have been exported.
+    """
+
+    coercers = coercers or {}
+
+    async def export_collection(name):
+        sink = sink_factory(name)
+        try:
+            await export(
+                client[database][name],
+                sink,
+                query=query,
+                batch_size=batch_size,
+                coerce=coercers.get(name),
+                dead_letter=dead_letter,
+                id_column=id_column,
+                projection=projection,
+            )
+        finally:
+            await sink.close()
+        return sink
+
+    return await asyncio.gather(*(export_collection(name) for name in collections))
+
+
+class ThreadSink:
+    """Makes a sink asynchronous, by calling it from a thread. The wrapped
+    sink is kept as ``sink``, e.g. to read its counters.
+    """
+
+    def __init__(self, sink):
+        self.sink = sink
+
+    async def _call(self, method, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, method, *args)
+
+    async def write_batch(self, documents):
+        await self._call(self.sink.write_batch, documents)
+
+    async def flush(self):
+        await self._call(self.sink.flush)
+
+    async def close(self):
+        await self._call(self.sink.close)
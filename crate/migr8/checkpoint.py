@@ -0,0 +1,127 @@
+# -*- coding: utf-8; -*-
+#
+# Licensed to CRATE Technology GmbH ("Crate") under one or more contributor
+# license agreements.  See the NOTICE file distributed with this work for
+# additional information regarding copyright ownership.  Crate licenses
+# this file to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  You may
+# obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# However, if you have executed another commercial license agreement
+# with Crate these terms will supersede the license and you may use the
+# software solely pursuant to the terms of the relevant commercial agreement.
+
+""" Records the progress of an export, so that it can be resumed.
+
+A checkpoint file stores the ``_id`` of the last document which has been
+delivered to the sink, along with the number of documents exported so far.
+As the collection is exported in ``_id`` order, an interrupted export can
+continue with the documents whose ``_id`` sorts after the recorded one.
+
+The ``_id`` is stored as MongoDB Extended JSON, to preserve its type. When the
+sink can tell the position in its output up to which the documents have been
+written, e.g. ``FileSink.position``, it is stored as the "output", so that the
+documents written after the checkpoint can be discarded on resume:
+
+{
+    "database": "test_db",
+    "collection": "test",
+    "last_id": {"$oid": "55153a8014829a865bbf700d"},
+    "count": 100000,
+    "output": {
+        "files": [{"file": "test.json.gz", "rows": 100000, "bytes": 10485760}],
+        "size": 1048576
+    }
+}
+"""
+
+import json
+import os
+
+from bson import json_util
+
+from .partition import id_range
+
+
+class Checkpoint:
+    """Tracks the progress of an export of one collection to a checkpoint
+    file, which is saved every ``interval`` documents.
+
+    The optional ``position`` function returns the position in the output of
+    the sink, which is saved along, after the sink has been flushed.
+    """
+
+    def __init__(self, path, database, collection, interval=10000, position=None):
+        self.path = path
+        self.database = database
+        self.collection = collection
+        self.interval = interval
+        self.position = position
+        self.last_id = None
+        self.count = 0
+        self.output = None
+        self.resumed = False
+
+    def load(self):
+        """Loads the state of a previous export from the checkpoint file, if
+        it exists.
+        """
+
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            state = json.load(f)
+        if (state["database"], state["collection"]) != (
+            self.database,
+            self.collection,
+        ):
+            raise ValueError(
+                "Checkpoint {0} belongs to collection {1}.{2}".format(
+                    self.path, state["database"], state["collection"]
+                )
+            )
+        self.last_id = json_util.loads(json.dumps(state["last_id"]))
+        self.count = state["count"]
+        self.output = state.get("output")
+        self.resumed = True
+
+    def query(self):
+        """Returns the query filter matching the documents not exported yet."""
+
+        if self.last_id is None:
+            return {}
+        return id_range(after=self.last_id)
+
+    def advance(self, last_id, count=1):
+        """Records that documents up to ``last_id`` have been exported and
+        returns whether the checkpoint is due to be saved.
+        """
+
+        previous, self.count = self.count, self.count + count
+        if last_id is not None:
+            self.last_id = last_id
+        return self.count // self.interval > previous // self.interval
+
+    def save(self):
+        if self.position is not None:
+            self.output = self.position()
+        state = {
+            "database": self.database,
+            "collection": self.collection,
+            "last_id": json.loads(json_util.dumps(self.last_id)),
+            "count": self.count,
+        }
+        if self.output is not None:
+            state["output"] = self.output
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f, indent=4)
+        os.replace(tmp, self.path)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8; -*-
+#
+# Licensed to CRATE Technology GmbH ("Crate") under one or more contributor
+# license agreements.  See the NOTICE file distributed with this work for
+# additional information regarding copyright ownership.  Crate licenses
+# this file to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  You may
+# obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# However, if you have executed another commercial license agreement
+# with Crate these terms will supersede the license and you may use the
+# software solely pursuant to the terms of the relevant commercial agreement.
+
+""" Converts BSON documents into CrateDB compatible JSON in a single pass.
+
+Raw BSON documents are decoded by ``pymongo``'s C extension, keeping dates as
+their native milliseconds since the epoch, and serialized by ``orjson``.
+BSON types without a JSON counterpart are converted by ``default`` while
+serializing, into the same values the conversion of MongoDB Extended JSON in
+``export.convert`` yields:
+
+- ObjectIds and Decimal128 values become strings.
+- Dates become milliseconds since the epoch.
+- Timestamps become objects of their "t" and "i" fields.
+- Binary data becomes an object of its "base64" encoded data and "subType".
+- Regular expressions become objects of their "pattern" and "options".
+
+Unlike Extended JSON, ``orjson`` serializes NaN and infinite floats as null.
+"""
+
+import base64
+import calendar
+import re
+from datetime import datetime
+
+import bson
+import orjson as json
+from bson.codec_options import CodecOptions
+from bson.dbref import DBRef
+from bson.max_key import MaxKey
+from bson.min_key import MinKey
+
+try:
+    from bson import DatetimeConversion, DatetimeMS
+except ImportError:  # pymongo < 4.3
+    DatetimeConversion = DatetimeMS = None
+
+if DatetimeConversion is not None:
+    CODEC_OPTIONS = CodecOptions(datetime_conversion=DatetimeConversion.DATETIME_MS)
+else:
+    CODEC_OPTIONS = CodecOptions()
+
+OPTIONS = json.OPT_PASSTHROUGH_DATETIME
+
+_REGEX_FLAGS = [
+    (re.IGNORECASE, "i"),
+    (re.LOCALE, "l"),
+    (re.MULTILINE, "m"),
+    (re.DOTALL, "s"),
+    (re.UNICODE, "u"),
+    (re.VERBOSE, "x"),
+]
+
+
+def decode(data):
+    """Decodes a raw BSON document for serialization with ``dumps``."""
+    return bson.decode(data, CODEC_OPTIONS)
+
+
+def timestamp_converter(value):
+    if len(str(value)) <= 10:
+        return value * 1000
+    return value
+
+
+def regex_options(flags):
+    if isinstance(flags, str):
+        return flags
+    return "".join(option for flag, option in _REGEX_FLAGS if flags & flag)
+
+
+def default(o):
+    """Converts the BSON types ``orjson`` can not serialize natively."""
+    if DatetimeMS is not None and isinstance(o, DatetimeMS):
+        return int(o)
+    if isinstance(o, bson.ObjectId):
+        return str(o)
+    if isinstance(o, datetime):
+        millis = calendar.timegm(o.utctimetuple()) * 1000
+        return millis + o.microsecond // 1000
+    if isinstance(o, bson.Timestamp):
+        return {"t": timestamp_converter(o.time), "i": timestamp_converter(o.inc)}
+    if isinstance(o, bson.Decimal128):
+        return str(o)
+    if isinstance(o, bytes):
+        subtype = o.subtype if isinstance(o, bson.Binary) else 0
+        return {
+            "base64": base64.b64encode(o).decode("ascii"),
+            "subType": "{0:02x}".format(subtype),
+        }
+    if isinstance(o, (bson.regex.Regex, re.Pattern)):
+        return {"pattern": o.pattern, "options": regex_options(o.flags)}
+    if isinstance(o, DBRef):
+        value = {"ref": o.collection, "id": o.id}
+        if o.database is not None:
+            value["db"] = o.database
+        return value
+    if isinstance(o, (MinKey, MaxKey)):
+        return 1
+    raise TypeError("Can't convert {0} to JSON".format(type(o).__name__))
+
+
+def dumps(o):
+    """Serializes a decoded document into CrateDB compatible JSON."""
+    return json.dumps(o, default=default, option=OPTIONS)
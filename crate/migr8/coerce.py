@@ -0,0 +1,238 @@
+# -*- coding: utf-8; -*-
+#
+# Licensed to CRATE Technology GmbH ("Crate") under one or more contributor
+# license agreements.  See the NOTICE file distributed with this work for
+# additional information regarding copyright ownership.  Crate licenses
+# this file to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  You may
+# obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# However, if you have executed another commercial license agreement
+# with Crate these terms will supersede the license and you may use the
+# software solely pursuant to the terms of the relevant commercial agreement.
+
+""" Coerces exported documents into the column types translated from a schema.
+
+A field whose values have several types gets a column of its dominant type,
+see ``translate.determine_type``. CrateDB rejects a whole bulk request if one
+of its rows has a value which can not be stored in the column, so values of
+other types are cast to the column type where possible, and dropped
+otherwise:
+
+- Integers, floats, ObjectIds, decimals and UUIDs become strings for TEXT
+  columns, strings and decimals become numbers for numeric columns if they
+  can be parsed, and booleans and integral floats become integers.
+- Strings become booleans if they are "true" or "false".
+- Integers are taken as milliseconds for timestamp columns, and strings are
+  parsed as ISO 8601 dates.
+- Values which can not be cast are removed from their object, or replaced by
+  null within arrays.
+
+Fields which ``translate`` leaves out are not coerced. The functions coercing
+each field are built once from the schema, and count the values coerced and
+dropped by field path.
+"""
+
+import uuid
+from collections import Counter
+from datetime import datetime
+
+import bson
+from bson.binary import UUID_SUBTYPE, UuidRepresentation
+
+from .export import date_converter
+from .translate import TYPES, dominant_type
+
+try:
+    from bson import DatetimeMS
+except ImportError:  # pymongo < 4.3
+    DatetimeMS = None
+
+# Marks a value which can not be coerced.
+DROP = object()
+
+
+class Coercer:
+    """Coerces the values of documents into the types of a document schema,
+    counting the coerced and dropped values in ``coerced`` and ``dropped``.
+
+    The field named ``id_column``, if given, holds the ``_id`` of the exported
+    documents instead, and is not coerced.
+    """
+
+    def __init__(self, document, id_column=None):
+        self.coerced = Counter()
+        self.dropped = Counter()
+        self.fields = self.compile_document(document, "")
+        self.fields.pop(id_column, None)
+
+    def __call__(self, document):
+        return coerce_document(self.fields, document)
+
+    def stats(self):
+        return {"coerced": dict(self.coerced), "dropped": dict(self.dropped)}
+
+    def update(self, stats):
+        """Adds the counts of another coercer's ``stats``."""
+
+        self.coerced.update(stats["coerced"])
+        self.dropped.update(stats["dropped"])
+
+    def compile_document(self, document, prefix):
+        fields = {}
+        for name, field in document.items():
+            coerce = self.compile(field, prefix + name)
+            if coerce is not None:
+                fields[name] = coerce
+        return fields
+
+    def compile(self, field, path):
+        """Returns the function coercing the values of a field schema, or None
+        if they are left as they are.
+        """
+
+        type = dominant_type(field)
+        if type not in TYPES:
+            return None
+        coerced, dropped = self.coerced, self.dropped
+
+        if type == "OBJECT":
+            fields = self.compile_document(
+                field["types"]["OBJECT"].get("document", {}), path + "."
+            )
+
+            def coerce(value):
+                if isinstance(value, dict):
+                    return coerce_document(fields, value)
+                dropped[path] += 1
+                return DROP
+
+        elif type == "ARRAY":
+            coerce_item = self.compile(field["types"]["ARRAY"], path + "[]")
+
+            def coerce(value):
+                if isinstance(value, list):
+                    if coerce_item is None:
+                        return value
+                    return [coerce_value(coerce_item, v) for v in value]
+                dropped[path] += 1
+                return DROP
+
+        else:
+            check, cast = CASTS[type]
+
+            def coerce(value):
+                if check(value):
+                    return value
+                value = cast(value)
+                if value is DROP:
+                    dropped[path] += 1
+                else:
+                    coerced[path] += 1
+                return value
+
+        return coerce
+
+
+def coerce_document(fields, document):
+    for name, value in list(document.items()):
+        coerce = fields.get(name)
+        if coerce is not None and value is not None:
+            value = coerce(value)
+            if value is DROP:
+                del document[name]
+            else:
+                document[name] = value
+    return document
+
+
+def coerce_value(coerce, value):
+    if value is None:
+        return None
+    value = coerce(value)
+    return None if value is DROP else value
+
+
+def is_integer(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def is_datetime(value):
+    if DatetimeMS is not None and isinstance(value, DatetimeMS):
+        return True
+    return isinstance(value, datetime)
+
+
+def to_integer(value):
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            return DROP
+    return DROP
+
+
+def to_float(value):
+    if isinstance(value, bson.Decimal128):
+        value = value.to_decimal()
+    elif not isinstance(value, str):
+        return DROP
+    try:
+        return float(value)
+    except ValueError:
+        return DROP
+
+
+def to_string(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float, bson.ObjectId, bson.Decimal128, uuid.UUID)):
+        return str(value)
+    if isinstance(value, bson.Binary) and value.subtype == UUID_SUBTYPE:
+        return str(value.as_uuid(UuidRepresentation.STANDARD))
+    return DROP
+
+
+def to_boolean(value):
+    if isinstance(value, str) and value.lower() in ("true", "false"):
+        return value.lower() == "true"
+    return DROP
+
+
+def to_datetime(value):
+    if is_integer(value):
+        return value
+    if isinstance(value, str):
+        try:
+            return date_converter(value)
+        except ValueError:
+            return DROP
+    return DROP
+
+
+# The checks of the values which match a column type, and the casts of the
+# other values, returning DROP if they can not be cast.
+CASTS = {
+    "INTEGER": (is_integer, to_integer),
+    "INT64": (is_integer, to_integer),
+    "FLOAT": (is_number, to_float),
+    "STRING": (lambda v: isinstance(v, str), to_string),
+    "BOOLEAN": (lambda v: isinstance(v, bool), to_boolean),
+    "DATETIME": (is_datetime, to_datetime),
+}
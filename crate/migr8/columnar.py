@@ -0,0 +1,256 @@
+# -*- coding: utf-8; -*-
+#
+# Licensed to CRATE Technology GmbH ("Crate") under one or more contributor
+# license agreements.  See the NOTICE file distributed with this work for
+# additional information regarding copyright ownership.  Crate licenses
+# this file to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  You may
+# obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# However, if you have executed another commercial license agreement
+# with Crate these terms will supersede the license and you may use the
+# software solely pursuant to the terms of the relevant commercial agreement.
+
+""" Writes exported documents as Parquet files, using an extracted schema.
+
+The columns of the files are the ones ``translate`` creates for the schema:
+each field gets the Arrow type matching the type found most often in it, and
+fields whose type has no CrateDB column type are left out. Objects become
+structs, and arrays become lists of their most frequent element type.
+
+ObjectIds, decimals and UUIDs are written as strings to string columns, and
+decimals as floats to float columns. Integers are written to timestamp
+columns as milliseconds since the epoch. Other values which do not match the
+type of their column are written as nulls, and counted by the sink.
+
+This requires the optional ``pyarrow`` package.
+"""
+
+import os
+import uuid
+from datetime import datetime
+
+import bson
+from bson.binary import UUID_SUBTYPE, UuidRepresentation
+
+from .sink import write_manifest
+from .translate import TYPES, dominant_type
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+try:
+    from bson import DatetimeMS
+except ImportError:  # pymongo < 4.3
+    DatetimeMS = None
+
+COMPRESSIONS = {None: "snappy", "gzip": "gzip", "zstd": "zstd"}
+
+ROW_GROUP_SIZE = 100000
+
+
+def arrow_type(field):
+    """Returns the Arrow type of a field schema, or None if it is left out."""
+
+    type = dominant_type(field)
+    if type not in TYPES:
+        return None
+    if type in ("INTEGER", "INT64"):
+        return pa.int64()
+    if type == "FLOAT":
+        return pa.float64()
+    if type == "STRING":
+        return pa.string()
+    if type == "BOOLEAN":
+        return pa.bool_()
+    if type == "DATETIME":
+        return pa.timestamp("ms", tz="UTC")
+    if type == "OBJECT":
+        schema = arrow_schema(field["types"]["OBJECT"].get("document", {}))
+        return pa.struct(list(schema)) if len(schema) else None
+    item_type = arrow_type(field["types"]["ARRAY"])
+    return pa.list_(item_type) if item_type is not None else None
+
+
+def arrow_schema(document):
+    """Returns the Arrow schema of the fields of a document schema."""
+
+    fields = []
+    for name, field in document.items():
+        type = arrow_type(field)
+        if type is not None:
+            fields.append(pa.field(name, type))
+    return pa.schema(fields)
+
+
+def value_converter(type, invalid=None):
+    """Returns a function converting decoded BSON values into values of an
+    Arrow type, or None if they can not be converted. Values other than None
+    which can not be converted are passed to ``invalid``, if given.
+    """
+
+    convert = type_converter(type, invalid)
+    if invalid is None:
+        return convert
+
+    def convert_valid(value):
+        converted = convert(value)
+        if converted is None and value is not None:
+            invalid(value)
+        return converted
+
+    return convert_valid
+
+
+def type_converter(type, invalid):
+    if pa.types.is_integer(type):
+        return lambda v: v if isinstance(v, int) and not isinstance(v, bool) else None
+    if pa.types.is_floating(type):
+        return convert_float
+    if pa.types.is_string(type):
+        return convert_string
+    if pa.types.is_boolean(type):
+        return lambda v: v if isinstance(v, bool) else None
+    if pa.types.is_timestamp(type):
+        return convert_datetime
+    if pa.types.is_struct(type):
+        converters = [(f.name, value_converter(f.type, invalid)) for f in type]
+        return lambda v: (
+            {name: convert(v.get(name)) for name, convert in converters}
+            if isinstance(v, dict)
+            else None
+        )
+    convert_item = value_converter(type.value_type, invalid)
+    return lambda v: [convert_item(i) for i in v] if isinstance(v, list) else None
+
+
+def convert_float(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, bson.Decimal128):
+        try:
+            return float(value.to_decimal())
+        except ValueError:  # signaling NaN
+            return None
+    return None
+
+
+def convert_string(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (bson.ObjectId, bson.Decimal128, uuid.UUID)):
+        return str(value)
+    if isinstance(value, bson.Binary) and value.subtype == UUID_SUBTYPE:
+        return str(value.as_uuid(UuidRepresentation.STANDARD))
+    return None
+
+
+def convert_datetime(value):
+    if DatetimeMS is not None and isinstance(value, DatetimeMS):
+        return int(value)
+    # Coerced dates are given in milliseconds since the epoch.
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, datetime):
+        return value
+    return None
+
+
+class ParquetSink:
+    """Writes documents to the Parquet file ``{name}.parquet`` in a directory,
+    with the columns of the given document schema, except ``_id``, which is
+    not exported. With an ``id_column``, the ``_id`` is exported as a string
+    column of that name instead, which comes first.
+
+    The documents are buffered and written as a row group once
+    ``row_group_size`` rows have been buffered. The values written as nulls
+    as they can not be converted to the type of their column are counted in
+    ``nulled``. Like ``sink.FileSink``, the
+    file written is listed in ``files``, and saved to the manifest if one is
+    given.
+    """
+
+    def __init__(
+        self,
+        directory,
+        name,
+        document,
+        compress=None,
+        manifest=None,
+        row_group_size=ROW_GROUP_SIZE,
+        id_column=None,
+    ):
+        if pa is None:
+            raise ValueError("Parquet output requires the pyarrow package")
+        self.schema = arrow_schema(
+            {
+                name: field
+                for name, field in document.items()
+                if name not in ("_id", id_column)
+            }
+        )
+        if id_column is not None:
+            self.schema = self.schema.insert(0, pa.field(id_column, pa.string()))
+        self.nulled = 0
+        self.converters = [
+            (field.name, value_converter(field.type, self._invalid))
+            for field in self.schema
+        ]
+        self.compress = compress
+        self.manifest = manifest
+        self.row_group_size = row_group_size
+        self.files = [{"file": "{0}.parquet".format(name), "rows": 0}]
+        self.path = os.path.join(directory, self.files[0]["file"])
+        self.writer = None
+        self.rows = []
+
+    def _invalid(self, value):
+        self.nulled += 1
+
+    def write(self, document):
+        self.write_batch([document])
+
+    def write_batch(self, documents):
+        self.rows.extend(documents)
+        if len(self.rows) >= self.row_group_size:
+            self.write_row_group()
+
+    def write_row_group(self):
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(
+                self.path, self.schema, compression=COMPRESSIONS[self.compress]
+            )
+        rows, self.rows = self.rows, []
+        columns = [
+            pa.array([convert(row.get(name)) for row in rows], type=field.type)
+            for (name, convert), field in zip(self.converters, self.schema)
+        ]
+        self.writer.write_table(pa.Table.from_arrays(columns, schema=self.schema))
+        self.files[0]["rows"] += len(rows)
+
+    def flush(self):
+        if self.rows:
+            self.write_row_group()
+        if self.manifest is not None:
+            write_manifest(self.manifest, self.files, self.compress)
+
+    def close(self):
+        self.flush()
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(
+                self.path, self.schema, compression=COMPRESSIONS[self.compress]
+            )
+        self.writer.close()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8; -*-
+#
+# Licensed to CRATE Technology GmbH ("Crate") under one or more contributor
+# license agreements.  See the NOTICE file distributed with this work for
+# additional information regarding copyright ownership.  Crate licenses
+# this file to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  You may
+# obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# However, if you have executed another commercial license agreement
+# with Crate these terms will supersede the license and you may use the
+# software solely pursuant to the terms of the relevant commercial agreement.
+
+""" Reads documents from the BSON files written by ``mongodump``.
+
+A dump file holds the documents of a collection one after another, each
+starting with its length as a little-endian 32-bit integer. The file is
+memory-mapped, and each document is sliced from the mapping into a
+``RawBSONDocument``, without any buffered reads or decoding, so that the
+documents can be processed like the raw documents fetched from MongoDB.
+
+Since the document boundaries can be found by only reading the lengths, a
+file can be split into ranges of whole documents, which are read by separate
+workers. Compressed dump files, as written by ``mongodump --gzip``, can not be
+memory-mapped, and are not supported.
+"""
+
+import mmap
+import os
+import struct
+
+from bson.errors import InvalidBSON
+from bson.raw_bson import RawBSONDocument
+
+_LENGTH = struct.Struct("<i")
+
+
+def collection_name(path):
+    """Returns the name of the collection a dump file has been written for."""
+
+    name = os.path.basename(path)
+    return name[: -len(".bson")] if name.endswith(".bson") else name
+
+
+def check_dump(path):
+    if path.endswith(".gz"):
+        raise ValueError("Compressed dump file {0} is not supported".format(path))
+    if not os.path.isfile(path):
+        raise ValueError("Dump file {0} does not exist".format(path))
+
+
+def document_length(data, offset, size):
+    """Returns the length of the document at an offset of a dump file."""
+
+    if offset + _LENGTH.size > size:
+        raise InvalidBSON("Truncated document at offset {0}".format(offset))
+    (length,) = _LENGTH.unpack_from(data, offset)
+    if length < 5 or offset + length > size:
+        raise InvalidBSON("Invalid document length at offset {0}".format(offset))
+    return length
+
+
+def iter_documents(path, start=0, end=None):
+    """Yields the documents of a dump file as ``RawBSONDocument``, from the
+    document at the byte offset ``start`` up to the one at ``end``.
+    """
+
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            end = size if end is None else end
+            offset = start
+            while offset < end:
+                length = document_length(data, offset, size)
+                yield RawBSONDocument(data[offset : offset + length])
+                offset += length
+
+
+def split_dump(path, parts):
+    """Splits a dump file into at most ``parts`` ranges of whole documents of
+    about the same size, and returns their ``(start, end)`` byte offsets.
+    """
+
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return []
+        ranges = []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            start = offset = 0
+            for i in range(1, parts):
+                boundary = size * i // parts
+                while offset < boundary:
+                    offset += document_length(data, offset, size)
+                if offset > start and offset < size:
+                    ranges.append((start, offset))
+                    start = offset
+        ranges.append((start, size))
+        return ranges
+
+
+class DumpCollection:
+    """Reads a range of a dump file through the ``find`` method of a
+    collection, so that it can be exported like one.
+
+    Only finding all documents in the order of the file is supported.
+    """
+
+    def __init__(self, path, start=0, end=None):
+        check_dump(path)
+        self.path = path
+        self.name = collection_name(path)
+        self.start = start
+        self.end = end
+
+    def find(self, filter=None, sort=None, batch_size=None):
+        if filter or sort:
+            raise ValueError("Dump files can not be queried or sorted")
+        return iter_documents(self.path, self.start, self.end)
@@ -24,38 +24,114 @@
 ingested into CrateDB.
 """
 
+import base64
+import datetime
+import functools
+import json
+import os
+import queue
+import shutil
 import sys
-import orjson as json
-import calendar
+import tempfile
+import threading
 import re
-from datetime import datetime, timedelta
-import bsonjs
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from multiprocessing import get_context
 
+import bson
+import pymongo
+from bson import json_util
+from bson.codec_options import CodecOptions
+from bson.objectid import ObjectId
+from bson.raw_bson import RawBSONDocument
 
-_TZINFO_RE = re.compile("([+\-])?(\d\d):?(\d\d)")
+from .codec import decode, dumps, timestamp_converter
+from .columnar import ParquetSink
+from .dump import DumpCollection, check_dump, split_dump
+from .metrics import timer
+from .partition import partition_filters
+from .sink import FileSink, StreamSink, write_manifest
+from .util import iter_batches
+
+
+# Number of documents fetched, converted and written at a time, which is also
+# the number of rows of each bulk request to CrateDB.
+BATCH_SIZE = 1000
+
+_DONE = object()
+
+_REPLACE_OPTIONS = CodecOptions(unicode_decode_error_handler="replace")
+
+_OBJECTID_RE = re.compile(r"[0-9a-f]{24}$")
+
+_DATE_RE = re.compile(
+    r"([+-]?\d{4,6}-\d\d-\d\d)[T ](\d\d):(\d\d)(?::(\d\d)(?:[.,](\d+))?)?"
+    r"\s*(?:(Z)|([+-])(\d\d)(?::?(\d\d))?)?$"
+)
+
+_MONTH_DAYS = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+
+
+@functools.lru_cache(maxsize=4096)
+def _epoch_days(day):
+    """Returns the number of days since the epoch of an ISO date, also for
+    years beyond 9999. Dates are cached, as the values of time series share
+    few days.
+    """
+    year, month, day = (int(part) for part in day.rsplit("-", 2))
+    if not 1 <= month <= 12:
+        raise ValueError("Invalid month {0}".format(month))
+    leap = year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+    if not 1 <= day <= _MONTH_DAYS[month - 1] + (month == 2 and leap):
+        raise ValueError("Invalid day {0} of month {1}".format(day, month))
+    # Days from civil, counting years from March to put leap days last.
+    year -= month <= 2
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100
+    return era * 146097 + day_of_era + day_of_year - 719468
 
 
 def date_converter(value):
+    """Converts a MongoDB Extended JSON date into milliseconds since the epoch.
+
+    Dates are either ISO 8601 strings with an optional fraction of seconds and
+    a "Z" or numeric UTC offset, milliseconds, or ``{"$numberLong": "..."}``
+    for dates out of the ISO range. Strings are parsed with a regular
+    expression and integer arithmetic instead of ``datetime.strptime``, and a
+    ``ValueError`` is raised for dates and times out of range.
+    """
     if isinstance(value, int):
         return value
-    dt = datetime.strptime(value[:-5], "%Y-%m-%dT%H:%M:%S.%f")
-    iso_match = _TZINFO_RE.match(value[-5:])
-    if iso_match:
-        sign, hours, minutes = iso_match.groups()
-        tzoffset = int(hours) * 3600 + int(minutes) * 60
-        if sign == "-":
-            dt = dt + timedelta(seconds=tzoffset)
-        else:
-            dt = dt - timedelta(seconds=tzoffset)
-    else:
-        raise Exception("Can't parse datetime string {0}".format(value))
-    return calendar.timegm(dt.utctimetuple()) * 1000
-
-
-def timestamp_converter(value):
-    if len(str(value)) <= 10:
-        return value * 1000
-    return value
+    if isinstance(value, dict):
+        return int(value["$numberLong"])
+    match = _DATE_RE.match(value)
+    if match is None:
+        raise ValueError("Can't parse datetime string {0}".format(value))
+    day, hours, minutes, seconds, fraction, _, sign, tzhours, tzminutes = match.groups()
+    hours, minutes, seconds = int(hours), int(minutes), int(seconds or 0)
+    if hours > 23 or minutes > 59 or seconds > 59:
+        raise ValueError("Invalid time in datetime string {0}".format(value))
+    seconds = hours * 3600 + minutes * 60 + seconds
+    if sign is not None:
+        tzhours, tzminutes = int(tzhours), int(tzminutes or 0)
+        if tzhours > 23 or tzminutes > 59:
+            raise ValueError("Invalid UTC offset in datetime string {0}".format(value))
+        offset = tzhours * 3600 + tzminutes * 60
+        seconds = seconds + offset if sign == "-" else seconds - offset
+    millis = int(fraction[:3].ljust(3, "0")) if fraction else 0
+    try:
+        days = _epoch_days(day)
+    except ValueError:
+        raise ValueError("Invalid date in datetime string {0}".format(value))
+    return (days * 86400 + seconds) * 1000 + millis
 
 
 type_converter = {
@@ -69,6 +145,8 @@ def extract_value(value, parent_type=None):
     if isinstance(value, dict):
         if len(value) == 1:
             for k, v in value.items():
+                if k == "$date":
+                    return date_converter(v)
                 if k.startswith("$"):
                     return extract_value(v, k.lstrip("$"))
         return {
@@ -84,6 +162,9 @@ def extract_value(value, parent_type=None):
 
 
 def convert(d):
+    """Converts a document in MongoDB Extended JSON into a CrateDB compatible
+    document.
+    """
     newdict = {}
     del d["_id"]
     for k, v in d.items():
@@ -91,12 +172,518 @@ def convert(d):
     return newdict
 
 
-def export(collection):
+def convert_document(document, id_column=None):
+    """Converts a raw BSON document into a CrateDB compatible document.
+
+    The values are decoded straight from BSON; the types without a JSON
+    counterpart are converted when the sink serializes the document, see
+    ``codec.default``.
+
+    The ``_id`` is left out, unless an ``id_column`` is given, which receives
+    it as a string, see ``id_string``. A document with a field of that name
+    raises a ValueError instead of losing it.
+    """
+    d = decode(document.raw)
+    _id = d.pop("_id")
+    if id_column is not None:
+        if id_column in d:
+            raise ValueError(
+                "Document has a field named {0}, which can not hold the _id "
+                "as well".format(id_column)
+            )
+        d[id_column] = id_string(_id)
+    return d
+
+
+def id_string(value):
+    """Returns the string stored in the primary key column for an ``_id``: the
+    hexadecimal string of an ObjectId, strings as they are, and the Extended
+    JSON of other values.
+
+    So that different ``_id`` values never share a key, strings which look
+    like an ObjectId or are valid JSON, e.g. ``"5"``, are stored as a quoted
+    JSON string instead.
+    """
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, str):
+        if _OBJECTID_RE.match(value) is None:
+            try:
+                json.loads(value)
+            except ValueError:
+                return value
+        return json.dumps(value)
+    return json_util.dumps(value)
+
+
+def combine_filters(*filters):
+    """Combines MongoDB query filters, so that all of them need to match."""
+    filters = [f for f in filters if f]
+    if len(filters) > 1:
+        return {"$and": filters}
+    return filters[0] if filters else {}
+
+
+def field_projection(fields=None, exclude=None):
+    """Returns a MongoDB projection of only the ``fields``, or of all but the
+    ``exclude`` fields, given as dotted paths, or None to return all fields.
+    """
+    if fields and exclude:
+        raise ValueError("Fields can either be included or excluded, not both")
+    if fields:
+        return {field: 1 for field in fields}
+    if exclude:
+        if "_id" in exclude:
+            raise ValueError("The _id field can not be excluded")
+        return {field: 0 for field in exclude}
+    return None
+
+
+def parse_date(value):
+    """Parses an ISO 8601 date, with an optional time and UTC offset, into a
+    datetime in UTC. Dates without an offset are taken to be in UTC, and
+    invalid dates raise a ValueError.
+    """
+    if value[-1:] in ("Z", "z"):
+        # Only accepted by fromisoformat as of Python 3.11.
+        value = value[:-1] + "+00:00"
+    date = datetime.datetime.fromisoformat(value)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date.astimezone(datetime.timezone.utc)
+
+
+def date_filter(field, since=None, until=None):
+    """Returns a MongoDB query filter for the documents whose date ``field``
+    is at or after ``since``, and before ``until``.
+    """
+    condition = {}
+    if since is not None:
+        condition["$gte"] = since
+    if until is not None:
+        condition["$lt"] = until
+    return {field: condition} if condition else {}
+
+
+def convert_batch(batch, skip_errors=False, id_column=None):
+    """Converts a batch of raw BSON documents, returning the converted
+    documents, the ``_id`` of the last one, and the documents which failed to
+    convert along with their errors.
+
+    Unless ``skip_errors``, the first error is raised instead.
+    """
+    documents = []
+    failures = []
+    for document in batch:
+        try:
+            documents.append(convert_document(document, id_column))
+        except Exception as e:
+            if not skip_errors:
+                raise
+            failures.append((document, e))
+    ids = (document_id(document) for document in reversed(batch))
+    last_id = next((_id for _id in ids if _id is not None), None)
+    return documents, last_id, failures
+
+
+def document_id(document):
+    """Returns the ``_id`` of a raw BSON document, or None if the document
+    can not be decoded.
+
+    Strings which are not valid UTF-8 are decoded with replacement characters,
+    so that the ``_id`` of a document holding them can still be found.
+    """
+    try:
+        return document["_id"]
+    except Exception:
+        pass
+    try:
+        return bson.decode(document.raw, _REPLACE_OPTIONS).get("_id")
+    except Exception:
+        return None
+
+
+class DeadLetter:
+    """Records the documents which fail to be converted as JSON lines, with
+    their ``_id`` as Extended JSON, the error, and the base64 encoded BSON
+    document:
+
+    {"_id": {"$oid": "..."}, "error": "InvalidBSON: ...", "document": "..."}
+
+    The records are written to a file, or kept in ``records`` if no path is
+    given.
+    """
+
+    def __init__(self, path=None, append=False):
+        self.path = path
+        self.count = 0
+        self.records = []
+        self.out = open(path, "ab" if append else "wb") if path else None
+
+    def add(self, document, error):
+        _id = document_id(document)
+        self.write(
+            {
+                "_id": json.loads(json_util.dumps(_id)) if _id is not None else None,
+                "error": "{0}: {1}".format(type(error).__name__, error),
+                "document": base64.b64encode(document.raw).decode("ascii"),
+            }
+        )
+
+    def write(self, record):
+        self.count += 1
+        if self.out is not None:
+            self.out.write(dumps(record) + b"\n")
+        else:
+            self.records.append(record)
+
+    def flush(self):
+        if self.out is not None:
+            self.out.flush()
+
+    def close(self):
+        if self.out is not None:
+            self.out.close()
+
+
+def pipeline(batches, function, workers, ordered=True):
+    """Applies ``function`` to each batch using a pool of worker threads, while
+    another thread fetches the next batches, and yields the results.
+
+    The results are yielded in the order of the batches, or as soon as they
+    are ready when not ``ordered``. At most ``2 * workers`` batches are
+    fetched ahead, so that a slow consumer holds back the fetching.
+    """
+    depth = 2 * workers
+    fetched = queue.Queue(depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                fetched.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def fetch():
+        try:
+            for batch in batches:
+                put((batch, None))
+                if stop.is_set():
+                    return
+        except Exception as e:
+            put((_DONE, e))
+        else:
+            put((_DONE, None))
+
+    threading.Thread(target=fetch, daemon=True).start()
+    pool = ThreadPoolExecutor(workers)
+    pending = deque()
+    done = False
+    try:
+        while not done or pending:
+            while not done and len(pending) < depth:
+                try:
+                    batch, error = fetched.get(block=not pending)
+                except queue.Empty:
+                    break
+                if error is not None:
+                    raise error
+                if batch is _DONE:
+                    done = True
+                else:
+                    pending.append(pool.submit(function, batch))
+            if not pending:
+                continue
+            if ordered:
+                yield pending.popleft().result()
+            else:
+                ready, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in ready:
+                    pending.remove(future)
+                    yield future.result()
+    finally:
+        stop.set()
+        for future in pending:
+            future.cancel()
+        pool.shutdown()
+
+
+def export(
+    collection,
+    sink=None,
+    query=None,
+    checkpoint=None,
+    batch_size=BATCH_SIZE,
+    workers=0,
+    ordered=True,
+    coerce=None,
+    dead_letter=None,
+    id_column=None,
+    metrics=None,
+    projection=None,
+):
     """Exports a MongoDB collection's documents to standard JSON and then
     outputs it to stdout.
+
+    Optionally, the documents can be written to another sink, restricted by a
+    MongoDB query filter, and to the fields of a MongoDB ``projection``, see
+    ``field_projection``, so that the other fields are not transferred. When a
+    checkpoint is given, the documents are exported in ``_id`` order,
+    continuing after the last document recorded in it, and the checkpoint is
+    saved periodically.
+
+    The documents are fetched from MongoDB, and handed to the sink, in batches
+    of ``batch_size`` documents. With ``workers``, the batches are fetched,
+    converted by that many threads and written out concurrently, see
+    ``pipeline``. Unless ``ordered``, they may be written out of order, which
+    is not possible with a checkpoint.
+
+    Optionally, each converted document is passed through a ``coerce``
+    function, e.g. a ``coerce.Coercer``, before it is written out.
+
+    Documents which fail to convert abort the export, unless a ``DeadLetter``
+    is given, which records them instead.
+
+    The ``_id`` of the documents is left out, unless an ``id_column`` is given
+    to keep it in, see ``convert_document``.
+
+    When ``metrics`` are given, the documents and bytes fetched are counted in
+    them, and the time spent in each stage, see ``metrics.Metrics``.
+    """
+    if checkpoint is not None and not ordered:
+        raise ValueError("Checkpoints require the documents to be written in order")
+    if sink is None:
+        sink = StreamSink(sys.stdout.buffer)
+    options = {"batch_size": batch_size}
+    if projection:
+        options["projection"] = projection
+    if checkpoint is None:
+        cursor = collection.find(query or {}, **options)
+    else:
+        cursor = collection.find(
+            combine_filters(query, checkpoint.query()),
+            sort=[("_id", 1)],
+            **options,
+        )
+    batches = iter_batches(cursor, batch_size)
+    convert = functools.partial(
+        convert_batch, skip_errors=dead_letter is not None, id_column=id_column
+    )
+    time = timer(metrics)
+    if metrics is not None:
+        batches = metrics.batches(batches)
+        convert = metrics.timed("convert", convert)
+    if workers:
+        converted = pipeline(batches, convert, workers, ordered)
+    else:
+        converted = map(convert, batches)
+    for documents, last_id, failures in converted:
+        for document, error in failures:
+            dead_letter.add(document, error)
+        if coerce is not None:
+            with time("coerce"):
+                documents = [coerce(document) for document in documents]
+        with time("write"):
+            sink.write_batch(documents)
+        if checkpoint is not None and checkpoint.advance(last_id, len(documents)):
+            with time("flush"):
+                sink.flush()
+            if dead_letter is not None:
+                dead_letter.flush()
+            checkpoint.save()
+    with time("flush"):
+        sink.flush()
+    if dead_letter is not None:
+        dead_letter.flush()
+    if checkpoint is not None:
+        checkpoint.save()
+
+
+def export_partition(
+    host,
+    port,
+    database,
+    collection,
+    query,
+    path,
+    sink_factory,
+    batch_size=BATCH_SIZE,
+    coerce_factory=None,
+    skip_errors=False,
+    id_column=None,
+    dump=None,
+    projection=None,
+):
+    """Exports a single ``_id`` range of a collection to a file, or to the sink
+    created by ``sink_factory``.
+
+    This runs within a worker process, so it uses its own MongoDB client, and
+    its own coercer created by ``coerce_factory``, if given. The files written
+    by a file sink are returned, along with the counts of the coercer, and
+    the dead letter records of the documents which failed to convert, if
+    ``skip_errors``.
+
+    When a ``dump`` file is given, the ``query`` is the ``(start, end)`` byte
+    range of it to export instead, see ``dump.split_dump``.
+    """
+    coerce = coerce_factory() if coerce_factory is not None else None
+    dead_letter = DeadLetter() if skip_errors else None
+    if dump is not None:
+        client = None
+        source = DumpCollection(dump, *query)
+        query = None
+    else:
+        client = pymongo.MongoClient(host, int(port), document_class=RawBSONDocument)
+        source = client[database][collection]
+    files = []
+    try:
+        if sink_factory is not None:
+            sink = sink_factory()
+            try:
+                export(
+                    source,
+                    sink=sink,
+                    query=query,
+                    batch_size=batch_size,
+                    coerce=coerce,
+                    dead_letter=dead_letter,
+                    id_column=id_column,
+                    projection=projection,
+                )
+            finally:
+                sink.close()
+            files = getattr(sink, "files", [])
+        else:
+            with open(path, "wb") as out:
+                export(
+                    source,
+                    StreamSink(out),
+                    query=query,
+                    batch_size=batch_size,
+                    coerce=coerce,
+                    dead_letter=dead_letter,
+                    id_column=id_column,
+                    projection=projection,
+                )
+    finally:
+        if client is not None:
+            client.close()
+    stats = coerce.stats() if coerce is not None else None
+    return files, stats, dead_letter.records if dead_letter is not None else []
+
+
+def export_parallel(
+    host,
+    port,
+    database,
+    collection,
+    partitions,
+    directory=None,
+    sink_factory=None,
+    chunk_size=None,
+    compress=None,
+    batch_size=BATCH_SIZE,
+    schema=None,
+    coerce_factory=None,
+    dead_letter=None,
+    id_column=None,
+    dump=None,
+    query=None,
+    projection=None,
+):
+    """Exports a MongoDB collection using several worker processes, each
+    reading its own ``_id`` range of the collection, or its own range of
+    documents of a ``mongodump`` file, if a ``dump`` is given.
+
+    When a sink factory is given, each worker writes to its own sink created
+    by it. When a directory is given, each partition is written to its own
+    files within it, as described by ``FileSink``, or to its own Parquet file
+    with the columns of a document ``schema``, if one is given. The files are
+    listed in the manifest ``{collection}.manifest.json``. Otherwise, the partitions
+    are written to stdout in ``_id`` order, as soon as they are complete.
+
+    With a ``coerce_factory``, each worker coerces its documents with its own
+    coercer, and a coercer holding the counts of all of them is returned. The
+    documents which fail to convert are recorded in the ``dead_letter``, if
+    given, and the ``_id`` is kept in the ``id_column``, if given.
+
+    The documents of a collection can be restricted by a MongoDB ``query``
+    filter, which is combined with the filter of each range, and to the fields
+    of a ``projection``.
     """
-    for document in collection.find():
-        bson_json = bsonjs.dumps(document.raw)
-        json_object = json.loads(bson_json)
-        sys.stdout.buffer.write(json.dumps(convert(json_object)))
-        sys.stdout.buffer.write(b"\n")
+    if dump is not None:
+        if query or projection:
+            raise ValueError("Dump files can not be queried or projected")
+        check_dump(dump)
+        filters = split_dump(dump, partitions)
+    else:
+        client = pymongo.MongoClient(host, int(port))
+        try:
+            filters = [
+                combine_filters(query, partition)
+                for partition in partition_filters(
+                    client[database][collection], partitions
+                )
+            ]
+        finally:
+            client.close()
+
+    factories = [sink_factory] * len(filters)
+    if directory is not None and sink_factory is None:
+        if schema is not None:
+            factory = functools.partial(
+                ParquetSink, document=schema, id_column=id_column
+            )
+        else:
+            factory = functools.partial(FileSink, chunk_size=chunk_size)
+        factories = [
+            functools.partial(
+                factory, directory, f"{collection}-{i:04d}", compress=compress
+            )
+            for i in range(len(filters))
+        ]
+
+    files = []
+    coerce = coerce_factory() if coerce_factory is not None else None
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = [
+            os.path.join(tmpdir, f"{collection}-{i:04d}.json")
+            for i in range(len(filters))
+        ]
+        with ProcessPoolExecutor(partitions, mp_context=get_context("spawn")) as pool:
+            futures = [
+                pool.submit(
+                    export_partition,
+                    host,
+                    port,
+                    database,
+                    collection,
+                    partition,
+                    path,
+                    factory,
+                    batch_size,
+                    coerce_factory,
+                    dead_letter is not None,
+                    id_column,
+                    dump,
+                    projection,
+                )
+                for partition, path, factory in zip(filters, paths, factories)
+            ]
+            for future, path in zip(futures, paths):
+                partition_files, stats, records = future.result()
+                files.extend(partition_files)
+                for record in records:
+                    dead_letter.write(record)
+                if coerce is not None:
+                    coerce.update(stats)
+                if directory is None and sink_factory is None:
+                    with open(path, "rb") as f:
+                        shutil.copyfileobj(f, sys.stdout.buffer)
+                    os.remove(path)
+    if directory is not None and sink_factory is None:
+        manifest = os.path.join(directory, f"{collection}.manifest.json")
+        write_manifest(manifest, files, compress)
+    return coerce
@@ -21,8 +21,9 @@
 
 """ Exports a schema definition from a MongoDB collection.
 
-This will iterate over a collection (either totally, or partially) and build
-up a description of the schema of the MongoDB collection.
+This will iterate over a collection (either totally, partially, or over a
+random sample of its documents) and build up a description of the schema of
+the MongoDB collection.
 
 Within the schema, each field in the collection will be described with two
 fields:
@@ -35,6 +36,30 @@ of entries of that field with that data type. If it is an object, it will also
 contain a schema of the object's types. If it is an array, it will contain
 a list of types that are present in the arrays, as well as their counts.
 
+When the schema has been built from a random sample of documents, it is
+annotated with the "sample_size", and the "estimated_count" of documents in
+the collection the sample has been taken from.
+
+The types of the values of the decoded documents are looked up in
+``TYPES_MAP``.
+
+When scanning collections, the counts are kept in a compact ``SchemaCounter``
+while processing batches of documents, and the schema is only built from it
+at the end.
+
+Schemas built from different sets of documents can be combined using
+``merge_schemas``, which sums up their counts. This is used to extract the
+schema of a collection in parallel, by scanning ``_id`` ranges of it in
+separate processes.
+
+Schemas can also be extracted from the BSON files written by ``mongodump``,
+without a MongoDB server, see ``extract_schema_from_dump``.
+
+A schema built by a full scan records the greatest "last_id" of the
+collection at the time of the scan, as MongoDB Extended JSON. It can later be
+refreshed by only scanning the documents added since, using
+``refresh_schema_from_collection``.
+
 An example schema may look like:
 
 {
@@ -63,10 +88,26 @@ An example schema may look like:
 }
 """
 
+import json
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from multiprocessing import get_context
+
 import bson
+import pymongo
+from bson import json_util
+from bson.raw_bson import RawBSONDocument
 from pymongo.collection import Collection
 from rich import print, progress
 
+from .dump import check_dump, collection_name, iter_documents, split_dump
+from .metrics import Metrics, timer
+from .partition import id_range, partition_filters
+from .util import iter_batches
+
 progress = progress.Progress(
     progress.TextColumn("{task.description} ", justify="left"),
     progress.BarColumn(bar_width=None),
@@ -75,35 +116,329 @@ progress = progress.Progress(
     progress.TimeRemainingColumn(),
 )
 
+_progress_lock = threading.Lock()
+_progress_users = 0
+
+
+@contextmanager
+def progress_display():
+    """Shows the progress display while at least one extraction is running.
+
+    This allows several collections to be extracted concurrently, each adding
+    its own task to the same display.
+    """
+
+    global _progress_users
+    with _progress_lock:
+        if _progress_users == 0:
+            progress.start()
+        _progress_users += 1
+    try:
+        yield progress
+    finally:
+        with _progress_lock:
+            _progress_users -= 1
+            if _progress_users == 0:
+                progress.stop()
+
 
-def extract_schema_from_collection(collection: Collection, partial: bool):
+def extract_schema_from_collection(
+    collection: Collection,
+    partial: bool,
+    sample_size: int = None,
+    sample_fraction: float = None,
+    cancel: threading.Event = None,
+    query: dict = None,
+    metrics: Metrics = None,
+    upto_last_id: bool = False,
+):
     """Extracts a schema definition from a collection.
 
     If the extraction is partial, only the first document in the collection is
-    used to create the schema.
+    used to create the schema. If a sample size, or a fraction of the
+    collection to sample, is given, the schema is created from a random
+    sample of documents, using MongoDB's ``$sample`` aggregation stage.
+
+    When the optional ``cancel`` event is set, the extraction stops and
+    returns the schema built up so far.
+
+    If a query filter is given, only the documents matching it are scanned.
+
+    When ``metrics`` are given, the documents and bytes fetched are counted in
+    them, and the time spent fetching, decoding and counting them. The
+    documents are then fetched as raw BSON, and decoded separately.
+
+    A full scan records the greatest ``_id`` at its start as "last_id". The
+    documents inserted during the scan are only left out with
+    ``upto_last_id``, which requires MongoDB 3.6 or newer.
     """
 
-    schema = {"count": 0, "document": {}}
+    counter = SchemaCounter()
+    last_id = None
+    add_documents = counter.add
+    sampled = sample_size is not None or sample_fraction is not None
+    codec_options = collection.codec_options
+    source = collection
+    if metrics is not None:
+        # Fetch raw BSON documents to count their bytes, and decode them here.
+        source = collection.with_options(
+            codec_options=codec_options.with_options(document_class=RawBSONDocument)
+        )
     if partial:
         count = 1
+        cursor = source.find()
+    elif sampled:
+        estimated_count = collection.estimated_document_count()
+        if sample_size is None:
+            sample_size = max(1, round(estimated_count * sample_fraction))
+        count = min(sample_size, estimated_count)
+        cursor = source.aggregate(
+            [{"$sample": {"size": sample_size}}], allowDiskUse=True
+        )
+    elif query:
+        count = collection.count_documents(query)
+        cursor = source.find(query)
     else:
+        last_id = get_last_id(collection)
         count = collection.estimated_document_count()
-    with progress:
+        if upto_last_id and last_id is not None:
+            cursor = source.find(id_range(upto=last_id))
+        else:
+            cursor = source.find()
+    with progress_display():
         t = progress.add_task(collection.name, total=count)
         try:
-            for document in collection.find():
-                schema["count"] += 1
-                schema["document"] = extract_schema_from_document(
-                    document, schema["document"]
-                )
-                progress.update(t, advance=1)
-                if partial:
+            batches = iter_batches(cursor, 1 if partial else BATCH_SIZE)
+            if metrics is not None:
+                batches = metrics.batches(batches)
+                decode = metrics.timed("decode", decode_batch)
+                add = metrics.timed("count", counter.add)
+
+                def add_documents(batch):
+                    add(decode(batch, codec_options))
+
+            for batch in batches:
+                add_documents(batch)
+                progress.update(t, advance=len(batch))
+                if partial or (cancel is not None and cancel.is_set()):
                     break
         except KeyboardInterrupt:
-            return schema
+            pass
+    schema = counter.schema()
+    if sampled:
+        schema["sample_size"] = schema["count"]
+        schema["estimated_count"] = estimated_count
+    elif last_id is not None:
+        schema["last_id"] = encode_id(last_id)
+    return schema
+
+
+def decode_batch(batch, codec_options):
+    return [bson.decode(document.raw, codec_options) for document in batch]
+
+
+def refresh_schema_from_collection(
+    collection: Collection,
+    schema: dict,
+    cancel: threading.Event = None,
+    metrics: Metrics = None,
+):
+    """Updates a schema definition built by a previous full scan of a
+    collection with the documents added to it since.
+
+    Only the documents with an ``_id`` sorting after the "last_id" recorded in
+    the schema, and up to the greatest ``_id`` at the start of the refresh,
+    are scanned, and their counts are merged into the schema.
+    """
+
+    last_id = get_last_id(collection)
+    query = id_range(after=decode_id(schema["last_id"]), upto=last_id)
+    merge_schemas(
+        schema,
+        extract_schema_from_collection(
+            collection, False, cancel=cancel, query=query, metrics=metrics
+        ),
+    )
+    if last_id is not None:
+        schema["last_id"] = encode_id(last_id)
     return schema
 
 
+def get_last_id(collection: Collection):
+    """Returns the greatest ``_id`` of a collection, or ``None`` if it is
+    empty.
+    """
+
+    for document in collection.find({}, {"_id": 1}, sort=[("_id", -1)], limit=1):
+        return document["_id"]
+    return None
+
+
+def encode_id(value):
+    return json.loads(json_util.dumps(value))
+
+
+def decode_id(value):
+    return json_util.loads(json.dumps(value))
+
+
+def extract_schema_from_partition(host, port, database, collection, query):
+    """Extracts a schema definition from the documents of a collection which
+    match the given query filter.
+
+    This runs within a worker process, so it uses its own MongoDB client.
+    """
+
+    counter = SchemaCounter()
+    client = pymongo.MongoClient(host, int(port))
+    try:
+        cursor = client[database][collection].find(query)
+        for batch in iter_batches(cursor, BATCH_SIZE):
+            counter.add(batch)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.close()
+    return counter.schema()
+
+
+def extract_schema_parallel(host, port, database, collection, processes: int):
+    """Extracts a schema definition from a full scan of a collection, using
+    several worker processes.
+
+    The collection is split into ``_id`` ranges, the schema of each range is
+    extracted by a worker, and the resulting schemas are merged in ``_id``
+    order.
+    """
+
+    client = pymongo.MongoClient(host, int(port))
+    try:
+        last_id = get_last_id(client[database][collection])
+        count = client[database][collection].estimated_document_count()
+        # Use more partitions than processes, to balance their load.
+        filters = partition_filters(client[database][collection], processes * 4)
+    finally:
+        client.close()
+
+    schemas = [None] * len(filters)
+    with progress_display(), ProcessPoolExecutor(
+        processes, mp_context=get_context("spawn")
+    ) as pool:
+        t = progress.add_task(collection, total=count)
+        futures = {
+            pool.submit(
+                extract_schema_from_partition,
+                host,
+                port,
+                database,
+                collection,
+                query,
+            ): i
+            for i, query in enumerate(filters)
+        }
+        try:
+            for future in as_completed(futures):
+                schemas[futures[future]] = future.result()
+                progress.update(t, advance=future.result()["count"])
+        except KeyboardInterrupt:
+            for future, i in futures.items():
+                if not future.cancel():
+                    schemas[i] = future.result()
+
+    schema = {"count": 0, "document": {}}
+    for partial_schema in schemas:
+        if partial_schema is not None:
+            merge_schemas(schema, partial_schema)
+    if last_id is not None:
+        schema["last_id"] = encode_id(last_id)
+    return schema
+
+
+def extract_schema_from_dump(
+    path: str,
+    start: int = 0,
+    end: int = None,
+    task=None,
+    metrics: Metrics = None,
+):
+    """Extracts a schema definition from the documents of a ``mongodump``
+    file, or the range of it between the byte offsets ``start`` and ``end``,
+    see ``dump.iter_documents``.
+
+    When a progress ``task`` is given, it is advanced by the number of bytes
+    read, and ``metrics`` count the documents and bytes read.
+    """
+
+    counter = SchemaCounter()
+    time = timer(metrics)
+    batches = iter_batches(iter_documents(path, start, end), BATCH_SIZE)
+    if metrics is not None:
+        batches = metrics.batches(batches)
+    try:
+        for batch in batches:
+            with time("count"):
+                counter.add([bson.decode(document.raw) for document in batch])
+            if task is not None:
+                progress.update(task, advance=sum(len(d.raw) for d in batch))
+    except KeyboardInterrupt:
+        pass
+    return counter.schema()
+
+
+def extract_schema_from_dump_parallel(path: str, processes: int):
+    """Extracts a schema definition from a ``mongodump`` file, using several
+    worker processes, each reading its own range of whole documents.
+    """
+
+    check_dump(path)
+    # Use more ranges than processes, to balance their load.
+    ranges = split_dump(path, processes * 4)
+    schemas = [None] * len(ranges)
+    with progress_display(), ProcessPoolExecutor(
+        processes, mp_context=get_context("spawn")
+    ) as pool:
+        t = progress.add_task(collection_name(path), total=os.path.getsize(path))
+        futures = {
+            pool.submit(extract_schema_from_dump, path, start, end): i
+            for i, (start, end) in enumerate(ranges)
+        }
+        try:
+            for future in as_completed(futures):
+                i = futures[future]
+                schemas[i] = future.result()
+                progress.update(t, advance=ranges[i][1] - ranges[i][0])
+        except KeyboardInterrupt:
+            for future, i in futures.items():
+                if not future.cancel():
+                    schemas[i] = future.result()
+
+    schema = {"count": 0, "document": {}}
+    for partial_schema in schemas:
+        if partial_schema is not None:
+            merge_schemas(schema, partial_schema)
+    return schema
+
+
+def merge_schemas(a: dict, b: dict):
+    """Merges the schema definition ``b`` into ``a``, summing up the counts of
+    their fields and types recursively.
+
+    This works on collection schemas as well as on the schemas of individual
+    fields or types, and returns the updated schema ``a``.
+    """
+
+    for key, value in b.items():
+        if key == "count":
+            a["count"] = a.get("count", 0) + value
+        elif key in ("document", "types"):
+            children = a.setdefault(key, {})
+            for name, child in value.items():
+                children[name] = merge_schemas(children.get(name, {}), child)
+        else:
+            a.setdefault(key, value)
+    return a
+
+
 def extract_schema_from_document(document: dict, schema: dict):
     """Extracts and updates schema definition from a given document."""
 
@@ -156,17 +491,109 @@ def extract_schema_from_array(array: list, schema: dict):
     return schema
 
 
+class SchemaCounter:
+    """Counts the fields and types of documents in a compact form.
+
+    Each combination of a parent node, a field name and a type is interned to
+    an integer id, and its count is kept in a flat list indexed by that id.
+    Top-level fields have the parent ``-1``, and the elements of arrays have
+    no field name. As the count of a field is the sum of the counts of its
+    types, each value only takes a single lookup. The nested schema
+    definition is only built by ``schema``.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.ids = {}
+        self.keys = []
+        self.counts = []
+
+    def _intern(self, key):
+        node = self.ids[key] = len(self.counts)
+        self.keys.append(key)
+        self.counts.append(0)
+        return node
+
+    def add(self, documents):
+        """Counts the fields and types of a batch of decoded documents."""
+
+        for document in documents:
+            self.count += 1
+            self._add_document(document, -1)
+
+    def _add_document(self, document, parent):
+        ids, counts, types = self.ids, self.counts, TYPES_MAP
+        for k, v in document.items():
+            t = types.get(type(v), "UNKNOWN")
+            key = (parent, k, t)
+            node = ids.get(key)
+            if node is None:
+                node = self._intern(key)
+            counts[node] += 1
+            if t == "OBJECT":
+                self._add_document(v, node)
+            elif t == "ARRAY":
+                self._add_array(v, node)
+
+    def _add_array(self, array, parent):
+        ids, counts, types = self.ids, self.counts, TYPES_MAP
+        for v in array:
+            t = types.get(type(v), "UNKNOWN")
+            key = (parent, None, t)
+            node = ids.get(key)
+            if node is None:
+                node = self._intern(key)
+            counts[node] += 1
+            if t == "OBJECT":
+                self._add_document(v, node)
+            elif t == "ARRAY":
+                self._add_array(v, node)
+
+    def schema(self):
+        """Builds the nested schema definition from the counts."""
+
+        document = {}
+        entries = []
+        for (parent, k, t), count in zip(self.keys, self.counts):
+            if k is None:
+                types = entries[parent]["types"]
+            else:
+                fields = document if parent < 0 else entries[parent]["document"]
+                if k not in fields:
+                    fields[k] = {"count": 0, "types": {}}
+                fields[k]["count"] += count
+                types = fields[k]["types"]
+            if t == "OBJECT":
+                entry = {"count": count, "document": {}}
+            elif t == "ARRAY":
+                entry = {"count": count, "types": {}}
+            else:
+                entry = {"count": count}
+            types[t] = entry
+            entries.append(entry)
+        return {"count": self.count, "document": document}
+
+
+# Number of documents to process between progress updates.
+BATCH_SIZE = 1000
+
 TYPES_MAP = {
     # bson types
     bson.ObjectId: "OID",
     bson.datetime.datetime: "DATETIME",
     bson.Timestamp: "TIMESTAMP",
     bson.int64.Int64: "INT64",
+    bson.Decimal128: "DECIMAL128",
+    bson.Binary: "BINARY",
+    bson.regex.Regex: "REGEX",
+    re.Pattern: "REGEX",
     # primitive types
     str: "STRING",
     bool: "BOOLEAN",
     int: "INTEGER",
     float: "FLOAT",
+    bytes: "BINARY",
+    type(None): "NULL",
     # collection types
     list: "ARRAY",
     dict: "OBJECT",
@@ -0,0 +1,230 @@
+# -*- coding: utf-8; -*-
+#
+# Licensed to CRATE Technology GmbH ("Crate") under one or more contributor
+# license agreements.  See the NOTICE file distributed with this work for
+# additional information regarding copyright ownership.  Crate licenses
+# this file to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  You may
+# obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# However, if you have executed another commercial license agreement
+# with Crate these terms will supersede the license and you may use the
+# software solely pursuant to the terms of the relevant commercial agreement.
+
+""" Measures the throughput of exports and extractions.
+
+A ``Metrics`` object counts the documents and bytes read from MongoDB, and
+sums up the time spent in each stage of processing them:
+
+- "fetch": waiting for the next batch of documents from the cursor.
+- "convert": decoding the documents and converting them for CrateDB.
+- "coerce": coercing the values into their column types.
+- "write": serializing the documents and handing them to the sink.
+- "flush": waiting for the sink to deliver the documents.
+- "count": counting the fields and types of the documents, when extracting.
+
+When batches are converted by several worker threads, their times add up, so
+that the stages may sum up to more than the elapsed time.
+
+A ``Reporter`` periodically prints the metrics, and can save them to a file in
+the Prometheus text format, e.g. for the textfile collector of the node
+exporter:
+
+    # TYPE migr8_documents_total counter
+    migr8_documents_total{command="export",collection="test"} 100000
+    # TYPE migr8_stage_seconds_total counter
+    migr8_stage_seconds_total{command="export",collection="test",stage="fetch"} 1.5
+"""
+
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+PROMETHEUS = [
+    ("documents_total", "counter", "Documents read from MongoDB."),
+    ("bytes_total", "counter", "Bytes of BSON read from MongoDB."),
+    ("elapsed_seconds", "gauge", "Seconds since the start."),
+    ("documents_per_second", "gauge", "Documents read per second."),
+    ("bytes_per_second", "gauge", "Bytes read per second."),
+]
+
+
+class Metrics:
+    """Counts documents and bytes, and the time spent in each stage, safely
+    across threads. The ``labels`` describe the metrics in the Prometheus
+    format.
+    """
+
+    def __init__(self, **labels):
+        self.labels = labels
+        self.started = time.monotonic()
+        self.documents = 0
+        self.bytes = 0
+        self.seconds = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def count(self, documents, size=0):
+        with self._lock:
+            self.documents += documents
+            self.bytes += size
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self.seconds[stage] += seconds
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def timed(self, stage, function):
+        """Returns a function calling ``function``, timed as a stage."""
+
+        def timed_function(*args, **kwargs):
+            with self.time(stage):
+                return function(*args, **kwargs)
+
+        return timed_function
+
+    def batches(self, batches):
+        """Yields the batches of raw BSON documents of an iterator, counting
+        them and their bytes, and timing the wait for each as the "fetch"
+        stage.
+        """
+
+        iterator = iter(batches)
+        while True:
+            with self.time("fetch"):
+                batch = next(iterator, None)
+            if batch is None:
+                return
+            self.count(len(batch), sum(len(document.raw) for document in batch))
+            yield batch
+
+    def snapshot(self):
+        with self._lock:
+            elapsed = time.monotonic() - self.started
+            return {
+                "elapsed_seconds": elapsed,
+                "documents_total": self.documents,
+                "bytes_total": self.bytes,
+                "documents_per_second": self.documents / elapsed if elapsed else 0,
+                "bytes_per_second": self.bytes / elapsed if elapsed else 0,
+                "stages": dict(self.seconds),
+            }
+
+    def summary(self):
+        """Returns a line summarizing the metrics."""
+
+        state = self.snapshot()
+        line = (
+            "{documents_total:,} documents, {0:.1f} MB in {elapsed_seconds:.1f}s "
+            "({documents_per_second:,.0f} documents/s, {1:.1f} MB/s)".format(
+                state["bytes_total"] / 2**20,
+                state["bytes_per_second"] / 2**20,
+                **state,
+            )
+        )
+        if state["stages"]:
+            line += "; " + ", ".join(
+                "{0} {1:.1f}s".format(stage, seconds)
+                for stage, seconds in state["stages"].items()
+            )
+        return line
+
+    def prometheus(self, prefix="migr8"):
+        """Returns the metrics in the Prometheus text format."""
+
+        state = self.snapshot()
+        lines = []
+        for name, kind, help in PROMETHEUS:
+            lines.append("# HELP {0}_{1} {2}".format(prefix, name, help))
+            lines.append("# TYPE {0}_{1} {2}".format(prefix, name, kind))
+            lines.append(
+                "{0}_{1}{2} {3}".format(
+                    prefix, name, format_labels(self.labels), state[name]
+                )
+            )
+        name = "{0}_stage_seconds_total".format(prefix)
+        lines.append("# HELP {0} Seconds spent in each stage.".format(name))
+        lines.append("# TYPE {0} counter".format(name))
+        for stage, seconds in state["stages"].items():
+            labels = format_labels(dict(self.labels, stage=stage))
+            lines.append("{0}{1} {2}".format(name, labels, seconds))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(self.prometheus())
+        os.replace(tmp, path)
+
+
+def timer(metrics):
+    """Returns the ``time`` method of ``metrics``, or one doing nothing if they
+    are None, to time the stages of an optionally measured loop.
+    """
+
+    if metrics is not None:
+        return metrics.time
+    return lambda stage: nullcontext()
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{{{0}}}".format(
+        ",".join(
+            '{0}="{1}"'.format(
+                name, str(value).replace("\\", "\\\\").replace('"', '\\"')
+            )
+            for name, value in labels.items()
+        )
+    )
+
+
+class Reporter:
+    """Reports metrics every ``interval`` seconds from a thread, and once more
+    when stopped, by calling ``report`` with their summary line, and saving
+    them to a Prometheus text file, if a path is given.
+    """
+
+    def __init__(self, metrics, interval=10, report=None, path=None):
+        self.metrics = metrics
+        self.interval = interval
+        self.report = report
+        self.path = path
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.emit()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.emit()
+
+    def emit(self):
+        if self.report is not None:
+            self.report(self.metrics.summary())
+        if self.path is not None:
+            self.metrics.write_prometheus(self.path)
@@ -0,0 +1,208 @@
+# -*- coding: utf-8; -*-
+#
+# Licensed to CRATE Technology GmbH ("Crate") under one or more contributor
+# license agreements.  See the NOTICE file distributed with this work for
+# additional information regarding copyright ownership.  Crate licenses
+# this file to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  You may
+# obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# However, if you have executed another commercial license agreement
+# with Crate these terms will supersede the license and you may use the
+# software solely pursuant to the terms of the relevant commercial agreement.
+
+""" Splits a MongoDB collection into ``_id`` ranges.
+
+Each range is described by a MongoDB query filter, so that a collection can
+be processed by several independent cursors in parallel. The boundaries are
+picked from a random sample of ``_id`` values, sorted by the server, which
+requires MongoDB 3.2 or newer.
+
+MongoDB range queries only match values of the same BSON type as the bound,
+so documents whose ``_id`` has a different type than the sampled boundaries
+are covered by an additional, trailing partition. Likewise, ``id_range``
+matches the ``_id`` values of the types sorting before or after a bound by
+their type.
+"""
+
+import re
+import uuid
+from collections.abc import Mapping
+from datetime import datetime
+
+import bson
+from pymongo.collection import Collection
+
+# How many ``_id`` values to sample per requested partition.
+SAMPLES_PER_PARTITION = 32
+
+TYPE_ALIASES = [
+    (bson.ObjectId, "objectId"),
+    (str, "string"),
+    (datetime, "date"),
+    ((int, float, bson.Decimal128), "number"),
+]
+
+
+# The groups of BSON types whose values are compared with each other, in the
+# order in which MongoDB sorts them.
+SORT_ORDER = [
+    ["minKey"],
+    ["null"],
+    ["double", "int", "long", "decimal"],
+    ["symbol", "string"],
+    ["object"],
+    ["array"],
+    ["binData"],
+    ["objectId"],
+    ["bool"],
+    ["date"],
+    ["timestamp"],
+    ["regex"],
+    ["maxKey"],
+]
+
+SORT_GROUPS = [
+    # JavaScript code is a subclass of str, but is not compared with strings.
+    (bson.Code, None),
+    (bson.MinKey, 0),
+    (type(None), 1),
+    (bool, 8),
+    ((int, float, bson.Decimal128), 2),
+    (str, 3),
+    (Mapping, 4),
+    (list, 5),
+    ((bytes, uuid.UUID), 6),
+    (bson.ObjectId, 7),
+    (datetime, 9),
+    (bson.Timestamp, 10),
+    ((bson.Regex, re.Pattern), 11),
+    (bson.MaxKey, 12),
+]
+
+
+def get_type_alias(value):
+    """Returns the MongoDB ``$type`` alias for a boundary value, or ``None``
+    if values of that type can not be used for partitioning.
+    """
+
+    if isinstance(value, bool):
+        return None
+    for types, alias in TYPE_ALIASES:
+        if isinstance(value, types):
+            return alias
+    return None
+
+
+def sample_bounds(collection: Collection, partitions: int):
+    """Samples ``_id`` values from a collection and picks ``partitions - 1``
+    evenly spaced, distinct boundaries from them.
+    """
+
+    size = partitions * SAMPLES_PER_PARTITION
+    pipeline = [
+        {"$sample": {"size": size}},
+        {"$project": {"_id": 1}},
+        {"$sort": {"_id": 1}},
+    ]
+    sample = [document["_id"] for document in collection.aggregate(pipeline)]
+    if not sample:
+        return []
+
+    alias = get_type_alias(sample[0])
+    if alias is None:
+        return []
+    sample = [value for value in sample if get_type_alias(value) == alias]
+
+    bounds = []
+    for i in range(1, partitions):
+        value = sample[i * len(sample) // partitions]
+        if not bounds or value != bounds[-1]:
+            bounds.append(value)
+    if bounds and bounds[0] == sample[0]:
+        bounds = bounds[1:]
+    return bounds
+
+
+def partition_filters(collection: Collection, partitions: int):
+    """Splits a collection into (at most) the given number of ``_id`` ranges
+    and returns a query filter for each of them.
+
+    The filters are ordered by ``_id`` and, taken together, match every
+    document of the collection exactly once.
+    """
+
+    if partitions < 2:
+        return [{}]
+    bounds = sample_bounds(collection, partitions)
+    if not bounds:
+        return [{}]
+
+    alias = get_type_alias(bounds[0])
+    filters = []
+    lower = None
+    for upper in bounds + [None]:
+        condition = {"$type": alias}
+        if lower is not None:
+            condition["$gte"] = lower
+        if upper is not None:
+            condition["$lt"] = upper
+        filters.append({"_id": condition})
+        lower = upper
+    filters.append({"_id": {"$not": {"$type": alias}}})
+    return filters
+
+
+def sort_group(value):
+    """Returns the index of the group of BSON types of a value in
+    ``SORT_ORDER``, or ``None`` for types missing from it.
+    """
+
+    for types, group in SORT_GROUPS:
+        if isinstance(value, types):
+            return group
+    return None
+
+
+def id_bound(operator, value):
+    """Returns a query filter comparing the ``_id`` with a bound, which also
+    matches the ``_id`` values of the types sorting after the bound for
+    ``$gt`` and ``$gte``, or before it for ``$lt`` and ``$lte``.
+    """
+
+    condition = {"_id": {operator: value}}
+    group = sort_group(value)
+    if group is None:
+        return condition
+    if operator in ("$gt", "$gte"):
+        groups = SORT_ORDER[group + 1 :]
+    else:
+        groups = SORT_ORDER[:group]
+    types = [alias for aliases in groups for alias in aliases]
+    if not types:
+        return condition
+    return {"$or": [condition, {"_id": {"$type": types}}]}
+
+
+def id_range(after=None, upto=None):
+    """Returns a query filter for the documents whose ``_id`` sorts after the
+    ``after`` value and up to the ``upto`` value, where given, in the order of
+    a sort by ``_id``.
+    """
+
+    conditions = []
+    if after is not None:
+        conditions.append(id_bound("$gt", after))
+    if upto is not None:
+        conditions.append(id_bound("$lte", upto))
+    if len(conditions) > 1:
+        return {"$and": conditions}
+    return conditions[0] if conditions else {}
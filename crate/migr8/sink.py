@@ -0,0 +1,523 @@
+# -*- coding: utf-8; -*-
+#
+# Licensed to CRATE Technology GmbH ("Crate") under one or more contributor
+# license agreements.  See the NOTICE file distributed with this work for
+# additional information regarding copyright ownership.  Crate licenses
+# this file to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  You may
+# obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# However, if you have executed another commercial license agreement
+# with Crate these terms will supersede the license and you may use the
+# software solely pursuant to the terms of the relevant commercial agreement.
+
+""" Destinations for exported documents.
+
+A sink receives converted documents in batches through ``write_batch``, or
+one at a time through ``write``. Calling ``flush`` makes sure all documents
+written so far have been delivered, and ``close`` releases any resources held
+by the sink.
+"""
+
+import base64
+import gzip
+import http.client
+import itertools
+import json as stdjson
+import os
+import re
+import select
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, urlparse
+
+import orjson as json
+
+from .codec import dumps
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIONS = {"gzip": ".gz", "zstd": ".zst"}
+
+_SIZE_RE = re.compile(r"(\d+)\s*(?:([KMGT])I?)?B?", re.IGNORECASE)
+
+
+class CrateDBError(Exception):
+    pass
+
+
+class StreamSink:
+    """Writes documents as JSON lines to a binary file object."""
+
+    def __init__(self, out):
+        self.out = out
+
+    def write(self, document):
+        self.write_batch([document])
+
+    def write_batch(self, documents):
+        if documents:
+            self.out.write(b"\n".join(map(dumps, documents)) + b"\n")
+
+    def flush(self):
+        self.out.flush()
+
+    def close(self):
+        self.flush()
+
+
+class FileSink:
+    """Writes documents as JSON lines to files in a directory, optionally
+    compressed with gzip or zstd.
+
+    Without a chunk size, the documents are written to ``{name}.json``.
+    Otherwise, they are written to rolling ``{name}-00000.json`` files, each
+    holding at most ``chunk_size`` bytes of uncompressed JSON, unless a single
+    document is larger. The files written are listed in ``files``, with their
+    number of rows and uncompressed bytes.
+
+    When a manifest path is given, the list of files is saved to it on every
+    flush. With ``append``, the files listed in an existing manifest are kept,
+    and writing continues in the last file, or a new chunk. With a
+    ``position`` returned by ``position`` instead, the files are truncated to
+    it, and writing continues from there.
+    """
+
+    def __init__(
+        self,
+        directory,
+        name,
+        chunk_size=None,
+        compress=None,
+        manifest=None,
+        append=False,
+        position=None,
+    ):
+        if compress is not None and compress not in COMPRESSIONS:
+            raise ValueError("Unsupported compression {0}".format(compress))
+        if compress == "zstd" and zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+        self.directory = directory
+        self.name = name
+        self.chunk_size = chunk_size
+        self.compress = compress
+        self.manifest = manifest
+        self.files = []
+        self.out = None
+        # Whether to continue writing to the last file, once it is reopened.
+        self._continue = False
+        if position is not None:
+            self.truncate(position)
+        elif append and manifest is not None and os.path.exists(manifest):
+            with open(manifest) as f:
+                self.files = stdjson.load(f)["files"]
+            if chunk_size is None and self.files:
+                self.out = self.open(self.files[-1]["file"], "ab")
+
+    def filename(self, index=None):
+        suffix = COMPRESSIONS.get(self.compress, "")
+        if self.chunk_size is None:
+            return "{0}.json{1}".format(self.name, suffix)
+        if index is None:
+            index = len(self.files)
+        return "{0}-{1:05d}.json{2}".format(self.name, index, suffix)
+
+    def open(self, filename, mode="wb"):
+        path = os.path.join(self.directory, filename)
+        if self.compress == "gzip":
+            return gzip.open(path, mode)
+        if self.compress == "zstd":
+            return zstandard.ZstdCompressor().stream_writer(open(path, mode))
+        return open(path, mode)
+
+    def write(self, document):
+        self.write_batch([document])
+
+    def write_batch(self, documents):
+        """Writes the documents of a batch, with one write per file."""
+
+        lines = []
+        for document in documents:
+            line = dumps(document) + b"\n"
+            if self.out is None and self._continue:
+                self._continue = False
+                if not self.full(self.files[-1], line):
+                    self.out = self.open(self.files[-1]["file"], "ab")
+            current = self.files[-1] if self.out is not None else None
+            if current is not None and self.full(current, line):
+                self.out.write(b"".join(lines))
+                lines = []
+                self.out.close()
+                self.out = None
+            if self.out is None:
+                current = {"file": self.filename(), "rows": 0, "bytes": 0}
+                self.files.append(current)
+                self.out = self.open(current["file"])
+            lines.append(line)
+            current["rows"] += 1
+            current["bytes"] += len(line)
+        if lines:
+            self.out.write(b"".join(lines))
+
+    def full(self, current, line):
+        """Returns whether a line does not fit into the current chunk."""
+
+        if self.chunk_size is None or not current["bytes"]:
+            return False
+        return current["bytes"] + len(line) > self.chunk_size
+
+    def flush(self):
+        if self.out is not None:
+            self.out.flush()
+        if self.manifest is not None:
+            write_manifest(self.manifest, self.files, self.compress)
+
+    def close(self):
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+        self.flush()
+
+    def position(self):
+        """Flushes the sink, and returns the files written so far, along with
+        the size of the last one, to truncate it to when resuming.
+
+        A compressed file is closed, so that it can be truncated to a complete
+        gzip member or zstd frame, and a new one is appended to it when the
+        next documents are written.
+        """
+
+        if self.out is not None and self.compress is not None:
+            self.out.close()
+            self.out = None
+            self._continue = True
+        self.flush()
+        size = 0
+        if self.files:
+            size = os.path.getsize(os.path.join(self.directory, self.files[-1]["file"]))
+        return {"files": [dict(f) for f in self.files], "size": size}
+
+    def truncate(self, position):
+        """Discards everything written after a ``position``, and continues
+        writing to the last file.
+        """
+
+        self.files = [dict(f) for f in position["files"]]
+        if self.files:
+            path = os.path.join(self.directory, self.files[-1]["file"])
+            os.truncate(path, position["size"])
+            self._continue = True
+        if self.chunk_size is not None:
+            # Remove the chunks written after the position.
+            for i in itertools.count(len(self.files)):
+                path = os.path.join(self.directory, self.filename(i))
+                if not os.path.exists(path):
+                    break
+                os.remove(path)
+        self.flush()
+
+
+def write_manifest(path, files, compress=None):
+    """Writes a manifest listing the exported files and their row counts.
+
+    {
+        "compression": "gzip",
+        "rows": 150000,
+        "files": [
+            {"file": "test-00000.json.gz", "rows": 100000, "bytes": 1073741824},
+            {"file": "test-00001.json.gz", "rows": 50000, "bytes": 536870912}
+        ]
+    }
+    """
+
+    state = {
+        "compression": compress,
+        "rows": sum(f["rows"] for f in files),
+        "files": files,
+    }
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        stdjson.dump(state, f, indent=4)
+    os.replace(tmp, path)
+
+
+def parse_size(value):
+    """Parses a size in bytes, with an optional KB, MB, GB or TB suffix, which
+    are taken as powers of 1024.
+    """
+
+    match = _SIZE_RE.fullmatch(value.strip())
+    if match is None:
+        raise ValueError("Invalid size {0}".format(value))
+    number, unit = match.groups()
+    return int(number) * 1024 ** " KMGT".index((unit or " ").upper())
+
+
+def quote_identifier(name):
+    return '"{0}"'.format(name.replace('"', '""'))
+
+
+def parse_target(url):
+    """Parses a ``crate://[user[:password]@]host[:port]/[schema.]table`` URL."""
+
+    parsed = urlparse(url)
+    if parsed.scheme != "crate":
+        raise ValueError("Unsupported target URL {0}".format(url))
+    schema, _, table = parsed.path.lstrip("/").rpartition(".")
+    if not table:
+        raise ValueError("Target URL {0} does not name a table".format(url))
+    username = unquote(parsed.username) if parsed.username else None
+    password = unquote(parsed.password) if parsed.password else None
+    return {
+        "host": parsed.hostname or "localhost",
+        "port": parsed.port or 4200,
+        "username": username,
+        "password": password,
+        "schema": schema or "doc",
+        "table": table,
+    }
+
+
+def target_table(target):
+    return "{0}.{1}".format(
+        quote_identifier(target["schema"]), quote_identifier(target["table"])
+    )
+
+
+def target_headers(target):
+    """Returns the HTTP headers for requests to a parsed target URL."""
+
+    headers = {"Content-Type": "application/json"}
+    if target["username"]:
+        credentials = "{0}:{1}".format(target["username"], target["password"] or "")
+        headers["Authorization"] = "Basic " + base64.b64encode(
+            credentials.encode()
+        ).decode("ascii")
+    return headers
+
+
+def insert_statement(table, columns, primary_key=None):
+    """Returns the ``INSERT`` statement for rows of the given columns.
+
+    When the rows hold a ``primary_key`` column, existing rows with the same
+    key are updated instead, so that exporting a document again does not
+    duplicate it.
+    """
+
+    statement = "INSERT INTO {0} ({1}) VALUES ({2})".format(
+        table,
+        ", ".join(quote_identifier(c) for c in columns),
+        ", ".join("?" * len(columns)),
+    )
+    if primary_key is None or primary_key not in columns:
+        return statement
+    updates = [quote_identifier(c) for c in columns if c != primary_key]
+    if not updates:
+        return "{0} ON CONFLICT ({1}) DO NOTHING".format(
+            statement, quote_identifier(primary_key)
+        )
+    return "{0} ON CONFLICT ({1}) DO UPDATE SET {2}".format(
+        statement,
+        quote_identifier(primary_key),
+        ", ".join("{0} = excluded.{0}".format(c) for c in updates),
+    )
+
+
+def delete_statement(table, primary_key):
+    return "DELETE FROM {0} WHERE {1} = ?".format(table, quote_identifier(primary_key))
+
+
+def bulk_results(status, content):
+    """Returns the number of succeeded and failed rows of a bulk request."""
+
+    if status != 200:
+        raise CrateDBError(
+            "CrateDB request failed with status {0}: {1}".format(
+                status, content.decode("utf-8", "replace")
+            )
+        )
+    results = json.loads(content).get("results", [])
+    failed = sum(1 for result in results if result.get("rowcount") == -2)
+    return len(results) - failed, failed
+
+
+def closed_by_peer(sock):
+    """Returns whether an idle connection was closed by the other end, which
+    makes it readable.
+    """
+
+    readable, _, _ = select.select([sock], [], [], 0)
+    return bool(readable)
+
+
+class CrateDBSink:
+    """Inserts documents into a CrateDB table using bulk ``_sql`` requests.
+
+    Documents are grouped by their set of columns, and each group is sent as
+    one ``INSERT`` statement with ``bulk_args`` once it reaches the batch size.
+    Once ``max_pending`` rows are waiting in groups, e.g. as the documents
+    have many different sets of optional fields, all groups are sent. Requests
+    are issued from a pool of threads, each holding a keep-alive connection,
+    and at most ``concurrency`` requests are in flight at a time. Requests are
+    not repeated, as their rows may have been inserted already.
+
+    With a ``primary_key`` column, documents whose key already exists in the
+    table are updated, see ``insert_statement``, and rows can be deleted by
+    their keys.
+    """
+
+    def __init__(
+        self,
+        url,
+        batch_size=1000,
+        concurrency=4,
+        timeout=60,
+        primary_key=None,
+        max_pending=None,
+    ):
+        target = parse_target(url)
+        self.host = target["host"]
+        self.port = target["port"]
+        self.table = target_table(target)
+        self.headers = target_headers(target)
+        self.batch_size = batch_size
+        self.max_pending = max_pending or 10 * batch_size
+        self.timeout = timeout
+        self.primary_key = primary_key
+        self.inserted = 0
+        self.deleted = 0
+        self.failed = 0
+
+        self._pending = {}
+        self._pending_rows = 0
+        self._futures = set()
+        self._errors = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._connections = []
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._pool = ThreadPoolExecutor(concurrency)
+
+    def write(self, document):
+        columns = tuple(document)
+        rows = self._pending.setdefault(columns, [])
+        rows.append(list(document.values()))
+        self._pending_rows += 1
+        if len(rows) >= self.batch_size:
+            del self._pending[columns]
+            self._pending_rows -= len(rows)
+            self._submit(self.statement(columns), rows)
+        elif self._pending_rows >= self.max_pending:
+            self._submit_pending()
+
+    def write_batch(self, documents):
+        for document in documents:
+            self.write(document)
+
+    def _submit_pending(self):
+        pending, self._pending = self._pending, {}
+        self._pending_rows = 0
+        for columns, rows in pending.items():
+            self._submit(self.statement(columns), rows)
+
+    def flush(self):
+        self._submit_pending()
+        with self._lock:
+            futures = list(self._futures)
+        for future in futures:
+            future.result()
+        self._raise_error()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._pool.shutdown()
+            for connection in self._connections:
+                connection.close()
+
+    def statement(self, columns):
+        return insert_statement(self.table, columns, self.primary_key)
+
+    def delete(self, keys, count=True):
+        """Deletes the rows with the given ``primary_key`` values, counting
+        them in ``deleted`` if ``count`` is set.
+        """
+
+        counter = "deleted" if count else None
+        for i in range(0, len(keys), self.batch_size):
+            rows = [[key] for key in keys[i : i + self.batch_size]]
+            self._submit(delete_statement(self.table, self.primary_key), rows, counter)
+
+    def _submit(self, statement, rows, counter="inserted"):
+        body = dumps({"stmt": statement, "bulk_args": rows})
+        self._slots.acquire()
+        try:
+            # Stop at the first failed request, instead of carrying on until
+            # the next flush.
+            self._raise_error()
+            future = self._pool.submit(self._execute, body, counter)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+
+    def _raise_error(self):
+        with self._lock:
+            if self._errors:
+                raise self._errors[0]
+
+    def _done(self, future):
+        with self._lock:
+            self._futures.discard(future)
+            if not future.cancelled() and future.exception() is not None:
+                self._errors.append(future.exception())
+        self._slots.release()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = http.client.HTTPConnection(
+                self.host, self.port, timeout=self.timeout
+            )
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def _send(self, connection, body):
+        connection.request("POST", "/_sql", body=body, headers=self.headers)
+        response = connection.getresponse()
+        return response.status, response.read()
+
+    def _request(self, body):
+        connection = self._connection()
+        if connection.sock is not None and closed_by_peer(connection.sock):
+            # The server closed the idle keep-alive connection, so reconnect
+            # before sending anything.
+            connection.close()
+        try:
+            return self._send(connection, body)
+        except BaseException:
+            connection.close()
+            raise
+
+    def _execute(self, body, counter="inserted"):
+        succeeded, failed = bulk_results(*self._request(body))
+        with self._lock:
+            if counter is not None:
+                setattr(self, counter, getattr(self, counter) + succeeded)
+            self.failed += failed
@@ -0,0 +1,254 @@
+# -*- coding: utf-8; -*-
+#
+# Licensed to CRATE Technology GmbH ("Crate") under one or more contributor
+# license agreements.  See the NOTICE file distributed with this work for
+# additional information regarding copyright ownership.  Crate licenses
+# this file to you under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.  You may
+# obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.  See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+# However, if you have executed another commercial license agreement
+# with Crate these terms will supersede the license and you may use the
+# software solely pursuant to the terms of the relevant commercial agreement.
+
+""" Replicates the changes of a MongoDB collection into a CrateDB table.
+
+A change stream on the collection is opened before it is exported, so that
+the changes made during the export are not missed. Once the export is done,
+the change stream is tailed, and its changes are applied to the table in
+micro-batches: inserted, updated and replaced documents are converted like
+exported ones, and upserted by their ``_id``, which is kept in a primary key
+column, see ``export.convert_document``. Deleted documents are deleted by
+their key.
+
+Within a micro-batch, only the last change of each document is applied, and
+a batch is completely written before the next one is, so that the changes of
+a document are applied in order.
+
+The resume token of the last applied change is saved to a state file, from
+which an interrupted sync continues without exporting the collection again.
+While no changes arrive, the change stream's own resume token is saved, so
+that a sync of a quiet collection does not fall behind MongoDB's oplog:
+
+{
+    "database": "test_db",
+    "collection": "test",
+    "resume_token": {"_data": "8263..."}
+}
+
+Change streams require MongoDB to run as a replica set.
+"""
+
+import json
+import os
+import time
+
+import bson
+from bson import json_util
+
+from .export import convert_document, export, id_string
+from .sink import CrateDBError
+
+# Change events which end a change stream.
+STOP_EVENTS = ("drop", "dropDatabase", "rename", "invalidate")
+
+
+class SyncState:
+    """Tracks the resume token of a sync of one collection in a state file."""
+
+    def __init__(self, path, database, collection):
+        self.path = path
+        self.database = database
+        self.collection = collection
+        self.resume_token = None
+
+    def load(self):
+        """Loads the resume token of a previous sync from the state file, if it
+        exists.
+        """
+
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            state = json.load(f)
+        if (state["database"], state["collection"]) != (
+            self.database,
+            self.collection,
+        ):
+            raise ValueError(
+                "Sync state {0} belongs to collection {1}.{2}".format(
+                    self.path, state["database"], state["collection"]
+                )
+            )
+        self.resume_token = json_util.loads(json.dumps(state["resume_token"]))
+
+    def save(self):
+        state = {
+            "database": self.database,
+            "collection": self.collection,
+            "resume_token": json.loads(json_util.dumps(self.resume_token)),
+        }
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f, indent=4)
+        os.replace(tmp, self.path)
+
+
+def plain(document):
+    """Returns a raw BSON document, e.g. a resume token, as a dict."""
+
+    if hasattr(document, "raw"):
+        return bson.decode(document.raw)
+    return document
+
+
+def micro_batches(stream, batch_size, interval, stop=None):
+    """Yields lists of the change events of a change stream, once
+    ``batch_size`` events have arrived, or ``interval`` seconds after the
+    first event of a batch, and ends with the change stream, or when ``stop``
+    is set. While no events arrive, an empty list is yielded every
+    ``interval`` seconds.
+    """
+
+    batch = []
+    deadline = time.monotonic() + interval
+    while stream.alive and not (stop is not None and stop.is_set()):
+        change = stream.try_next()
+        if change is not None:
+            if not batch:
+                deadline = time.monotonic() + interval
+            batch.append(change)
+        if len(batch) >= batch_size or time.monotonic() >= deadline:
+            yield batch
+            batch = []
+            deadline = time.monotonic() + interval
+    if batch:
+        yield batch
+
+
+def apply_changes(sink, changes, id_column, coerce=None):
+    """Applies a micro-batch of change events to a CrateDB sink, and returns
+    the number of upserted and deleted documents.
+
+    As an upsert leaves the columns which are missing in a document as they
+    are, updates set the top-level fields they remove to null. Documents which
+    were replaced, or deleted and inserted again, are deleted before they are
+    inserted, so that none of the fields of the previous document are left.
+    """
+
+    latest = {}
+    removed = {}
+    replaced = set()
+    for change in changes:
+        key = id_string(change["documentKey"]["_id"])
+        latest[key] = change
+        if change["operationType"] in ("replace", "delete"):
+            replaced.add(key)
+            removed.pop(key, None)
+        elif change["operationType"] == "update":
+            fields = change["updateDescription"].get("removedFields", [])
+            removed.setdefault(key, set()).update(f for f in fields if "." not in f)
+
+    upserts = []
+    deletes = []
+    for key, change in latest.items():
+        document = change.get("fullDocument")
+        if change["operationType"] == "delete" or document is None:
+            deletes.append(key)
+            replaced.discard(key)
+            continue
+        document = convert_document(document, id_column)
+        for field in removed.get(key, ()):
+            document.setdefault(field, None)
+        if coerce is not None:
+            document = coerce(document)
+        upserts.append(document)
+
+    if replaced:
+        sink.delete(list(replaced), count=False)
+        sink.flush()
+    # The keys of the upserts and deletes differ, so they need not be ordered.
+    sink.write_batch(upserts)
+    if deletes:
+        sink.delete(deletes)
+    sink.flush()
+    return len(upserts), len(deletes)
+
+
+def sync(
+    collection,
+    sink,
+    id_column="id",
+    state=None,
+    batch_size=1000,
+    interval=1.0,
+    coerce=None,
+    stop=None,
+    report=None,
+):
+    """Exports a collection to a CrateDB sink with a ``primary_key`` column,
+    and applies the changes made to the collection from then on, until the
+    change stream ends or ``stop`` is set.
+
+    When a ``SyncState`` holding a resume token is given, the export is
+    skipped, and the changes are applied from that token on. The state is
+    saved after each micro-batch, and every ``interval`` seconds while no
+    changes arrive. ``report``, if given, is called with the numbers of
+    upserted and deleted documents of each micro-batch.
+
+    If the sink fails to write rows, a ``CrateDBError`` is raised before the
+    state is saved, so that a resumed sync applies the changes again.
+    """
+
+    def save(resume_token):
+        if sink.failed:
+            raise CrateDBError(
+                "{0} rows failed to be written, the sync has been "
+                "stopped".format(sink.failed)
+            )
+        if state is not None and resume_token != state.resume_token:
+            state.resume_token = resume_token
+            state.save()
+
+    resume_token = state.resume_token if state is not None else None
+    with collection.watch(
+        full_document="updateLookup",
+        resume_after=resume_token,
+        max_await_time_ms=int(interval * 1000),
+    ) as stream:
+        if resume_token is None:
+            resume_token = plain(stream.resume_token)
+            export(collection, sink, coerce=coerce, id_column=id_column)
+            save(resume_token)
+
+        for changes in micro_batches(stream, batch_size, interval, stop):
+            if not changes:
+                # The stream's token follows the changes applied so far.
+                save(plain(stream.resume_token))
+                continue
+            stop_event = next(
+                (c for c in changes if c["operationType"] in STOP_EVENTS), None
+            )
+            if stop_event is not None:
+                changes = changes[: changes.index(stop_event)]
+            counts = apply_changes(
+                sink,
+                [c for c in changes if "documentKey" in c],
+                id_column,
+                coerce,
+            )
+            if changes:
+                save(plain(changes[-1]["_id"]))
+            if report is not None:
+                report(*counts)
+            if stop_event is not None:
+                return stop_event["operationType"]
+    return None
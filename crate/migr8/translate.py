@@ -25,6 +25,13 @@ Given a generated MongoDB collection schema, this will translate that schema
 into a CREATE TABLE statement, mapping fields to columns and the collection
 name to the table name.
 
+If the schema has been extracted from a random sample of documents, the
+statement is preceded by a comment noting the size of the sample.
+
+With an ID column, the collection's ``_id`` is kept in a ``TEXT PRIMARY KEY``
+column of that name, see ``export.id_string``, so that loading documents again
+updates their rows instead of duplicating them.
+
 In the case where there are type conflicts (for example, 40% of the values
 for a field are integers, and 60% are strings), the translator will choose
 the type with the greatest proportion.
@@ -51,6 +58,10 @@ CREATE TABLE IF NOT EXISTS "doc"."{table}" (\n{columns}\n);
 
 COLUMN = '"{column_name}" {type}'
 
+PRIMARY_KEY = '"{column_name}" TEXT PRIMARY KEY'
+
+SAMPLE = "-- Schema sampled from {sample_size} of ~{estimated_count} documents"
+
 OBJECT = "OBJECT ({object_type}) AS (\n{definition}\n)"
 
 
@@ -85,11 +96,22 @@ def translate_array(schema):
         return f"ARRAY({subtype})"
 
 
+def dominant_type(schema):
+    """Returns the type found most often in a field schema, or None if it has
+    no types.
+    """
+
+    types = schema.get("types", {})
+    if not types:
+        return None
+    return max(types, key=lambda item: types[item]["count"])
+
+
 def determine_type(schema):
     """Determine the type of a specific field schema."""
 
     types = schema.get("types", [])
-    type = max(types, key=lambda item: types[item]["count"])
+    type = dominant_type(schema)
     if type in TYPES:
         sql_type = TYPES.get(type)
         if sql_type == "OBJECT":
@@ -131,11 +153,25 @@ def indent_sql(query: str) -> str:
     return "\n".join(lines)
 
 
-def translate(schemas):
+def check_id_column(name, document, id_column):
+    """Raises a ValueError if the document schema of a collection has a field
+    named like the ``id_column``, which can not hold the ``_id`` as well.
+    """
+
+    if id_column in document:
+        raise ValueError(
+            "The collection {0} has a field named {1}, which can not hold the "
+            "_id as well".format(name, id_column)
+        )
+
+
+def translate(schemas, id_column=None):
     """Translate a schema definition for a set of MongoDB collection schemas.
 
     This results in a set of CrateDB compatible CREATE TABLE expressions
-    corresponding to the set of MongoDB collection schemas.
+    corresponding to the set of MongoDB collection schemas. With an
+    ``id_column``, each table gets a primary key column of that name, see
+    ``check_id_column``.
     """
 
     tables = list(schemas.keys())
@@ -143,6 +179,9 @@ def translate(schemas):
     for tablename in tables:
         collection = schemas[tablename]
         columns = []
+        if id_column is not None:
+            check_id_column(tablename, collection["document"], id_column)
+            columns.append((PRIMARY_KEY.format(column_name=id_column), None))
         for fieldname, field in collection["document"].items():
             sql_type, comment = determine_type(field)
             if sql_type != "UNKNOWN":
@@ -155,7 +194,8 @@ def translate(schemas):
                 columns[index] = f"{column[1]}\n{column[0]}"
             else:
                 columns[index] = column[0]
-        sql_queries[tablename] = indent_sql(
-            BASE.format(table=tablename, columns=",\n".join(columns))
-        )
+        query = BASE.format(table=tablename, columns=",\n".join(columns))
+        if "sample_size" in collection:
+            query = "\n" + SAMPLE.format(**collection) + query
+        sql_queries[tablename] = indent_sql(query)
     return sql_queries
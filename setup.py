@@ -34,17 +34,19 @@ setup(
     namespace_packages=["crate"],
     entry_points={"console_scripts": ["migr8 = crate.migr8.__main__:main"]},
     install_requires=[
-        "pymongo>=3.10.1,<5",
+        "pymongo>=3.11,<5",
         "rich>=3.3.2,<14",
         "orjson>=3.3.1,<4",
-        "python-bsonjs>=0.2,<0.5",
     ],
     extras_require={
+        "parquet": ["pyarrow"],
+        "zstd": ["zstandard"],
         "testing": [
             "black==24.3.0",
             "flake8==7.0.0",
             "isort==5.13.2",
-        ]
+            "python-bsonjs>=0.2,<0.5",
+        ],
     },
     python_requires=">=3.6",
     classifiers=[
@@ -0,0 +1,240 @@
+import datetime
+from unittest import mock
+
+import bson
+
+from crate.migr8 import aggregate, extract
+
+import unittest
+
+
+def server_type(value):
+    """Returns the name ``$type`` returns for a value."""
+
+    for types, name in [
+        (bool, "bool"),
+        (bson.Int64, "long"),
+        (int, "int"),
+        (float, "double"),
+        (str, "string"),
+        (dict, "object"),
+        (list, "array"),
+        (datetime.datetime, "date"),
+        (bson.ObjectId, "objectId"),
+        (bson.Decimal128, "decimal"),
+        (bytes, "binData"),
+        (type(None), "null"),
+    ]:
+        if isinstance(value, types):
+            return name
+    raise TypeError(value)
+
+
+class Collection:
+    """Runs the aggregation pipelines of the aggregate engine on a list of
+    documents, supporting only the stages and expressions used by it.
+    """
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.pipelines = []
+
+    def aggregate(self, pipeline, allowDiskUse=False):
+        self.pipelines.append(pipeline)
+        return self.run(pipeline, [dict(d) for d in self.documents])
+
+    def value(self, document, expression):
+        if expression == "$$ROOT":
+            return document
+        value = document
+        for key in expression[1:].split("."):
+            if not isinstance(value, dict) or key not in value:
+                return None
+            value = value[key]
+        return value
+
+    def run(self, pipeline, documents):
+        for stage in pipeline:
+            ((name, spec),) = stage.items()
+            documents = getattr(self, name[1:])(spec, documents)
+        return documents
+
+    def limit(self, spec, documents):
+        return documents[:spec]
+
+    def count(self, spec, documents):
+        return [{spec: len(documents)}] if documents else []
+
+    def facet(self, spec, documents):
+        return [{k: self.run(p, list(documents)) for k, p in spec.items()}]
+
+    def project(self, spec, documents):
+        ((field, expression),) = spec.items()
+        if isinstance(expression, dict):
+            return [
+                {field: [{"k": k, "v": v} for k, v in self.value(d, e).items()]}
+                for d in documents
+                for e in [expression["$objectToArray"]]
+            ]
+        return [{field: self.value(d, expression)} for d in documents]
+
+    def unwind(self, spec, documents):
+        if isinstance(spec, str):
+            spec = {"path": spec}
+        field = spec["path"][1:]
+        unwound = []
+        for d in documents:
+            for i, value in enumerate(d[field]):
+                u = dict(d, **{field: value})
+                if "includeArrayIndex" in spec:
+                    u[spec["includeArrayIndex"]] = i
+                unwound.append(u)
+        return unwound
+
+    def addFields(self, spec, documents):
+        ((field, expression),) = spec.items()
+        return [
+            dict(d, **{field: server_type(self.value(d, expression["$type"]))})
+            for d in documents
+        ]
+
+    def match(self, spec, documents):
+        return [
+            d
+            for d in documents
+            if all(self.value(d, "$" + k) == v for k, v in spec.items())
+        ]
+
+    def group(self, spec, documents):
+        groups = {}
+        for d in documents:
+            if isinstance(spec["_id"], dict):
+                key = {k: self.value(d, e) for k, e in spec["_id"].items()}
+            else:
+                key = self.value(d, spec["_id"])
+            group = groups.setdefault(repr(key), {"_id": key})
+            for field, accumulator in spec.items():
+                if field == "$sum" or field == "_id":
+                    continue
+                ((op, arg),) = accumulator.items()
+                if op == "$sum":
+                    group[field] = group.get(field, 0) + arg
+                else:
+                    value = self.value(d, arg)
+                    group[field] = min(group.get(field, value), value)
+        return list(groups.values())
+
+    def sort(self, spec, documents):
+        for field, direction in reversed(list(spec.items())):
+            documents.sort(key=lambda d: d[field], reverse=direction < 0)
+        return documents
+
+
+class TestAggregate(unittest.TestCase):
+    def test_nested_schema(self):
+        collection = mock.Mock()
+        collection.aggregate.side_effect = [
+            # Number of documents.
+            [{"count": 3}],
+            # Fields of the documents.
+            [
+                {
+                    "0": [
+                        {"_id": {"k": "a", "t": "int"}, "count": 2, "position": 0},
+                        {"_id": {"k": "a", "t": "string"}, "count": 1, "position": 0},
+                        {"_id": {"k": "b", "t": "object"}, "count": 3, "position": 1},
+                        {"_id": {"k": "c", "t": "array"}, "count": 1, "position": 2},
+                        {"_id": {"k": "d", "t": "decimal"}, "count": 1, "position": 3},
+                    ]
+                }
+            ],
+            # Fields of the "b" objects and elements of the "c" arrays.
+            [
+                {
+                    "0": [{"_id": {"k": "x", "t": "date"}, "count": 3, "position": 0}],
+                    "1": [{"_id": "long", "count": 4}, {"_id": "double", "count": 1}],
+                }
+            ],
+        ]
+
+        s = aggregate.aggregate_schema_from_collection(collection, False)
+        self.assertEqual(
+            s,
+            {
+                "count": 3,
+                "document": {
+                    "a": {
+                        "count": 3,
+                        "types": {"INTEGER": {"count": 2}, "STRING": {"count": 1}},
+                    },
+                    "b": {
+                        "count": 3,
+                        "types": {
+                            "OBJECT": {
+                                "count": 3,
+                                "document": {
+                                    "x": {
+                                        "count": 3,
+                                        "types": {"DATETIME": {"count": 3}},
+                                    }
+                                },
+                            }
+                        },
+                    },
+                    "c": {
+                        "count": 1,
+                        "types": {
+                            "ARRAY": {
+                                "count": 1,
+                                "types": {
+                                    "INT64": {"count": 4},
+                                    "FLOAT": {"count": 1},
+                                },
+                            }
+                        },
+                    },
+                    "d": {"count": 1, "types": {"DECIMAL128": {"count": 1}}},
+                },
+            },
+        )
+
+        # The nested pipelines narrow down the documents to the nested values.
+        # Each level runs one pipeline, with one facet per nested value.
+        pipelines = [c.args[0] for c in collection.aggregate.call_args_list]
+        self.assertEqual(len(pipelines), 3)
+        facets = pipelines[2][-1]["$facet"]
+        self.assertIn({"$match": {"_f.k": "b", "_t": "object"}}, facets["0"])
+        self.assertEqual(
+            facets["0"][4], {"$project": {"_f": {"$objectToArray": "$_f.v"}}}
+        )
+        self.assertIn({"$match": {"_f.k": "c", "_t": "array"}}, facets["1"])
+        self.assertIn({"$project": {"_e": "$_f.v"}}, facets["1"])
+
+    def test_same_as_extracted_schema(self):
+        documents = [
+            {
+                "_id": bson.ObjectId(),
+                "a": 1,
+                "b": {"x": 1.5, "y": {"z": [1, "s"]}},
+                "c": [1, 2, {"d": True, "e": [[None]]}],
+            },
+            {"_id": bson.ObjectId(), "a": "s", "b": {"x": bson.Int64(2)}, "c": []},
+            {"_id": bson.ObjectId(), "b": [{"x": datetime.datetime(2020, 1, 1)}]},
+        ]
+        collection = Collection(documents)
+        schema = aggregate.aggregate_schema_from_collection(collection, False)
+
+        expected = {}
+        for document in documents:
+            extract.extract_schema_from_document(document, expected)
+        self.assertEqual(schema, {"count": 3, "document": expected})
+        # One pipeline counts the documents, and one each level of the schema.
+        self.assertEqual(len(collection.pipelines), 6)
+
+    def test_partial(self):
+        collection = mock.Mock()
+        collection.aggregate.side_effect = [[], []]
+        s = aggregate.aggregate_schema_from_collection(collection, True)
+        self.assertEqual(s, {"count": 0, "document": {}})
+        for c in collection.aggregate.call_args_list:
+            self.assertEqual(c.args[0][0], {"$limit": 1})
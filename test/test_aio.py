@@ -0,0 +1,107 @@
+import asyncio
+import io
+import socket
+import threading
+from http.server import ThreadingHTTPServer
+
+import bson
+from bson.raw_bson import RawBSONDocument
+
+from crate.migr8 import aio
+from crate.migr8.sink import CrateDBSink, StreamSink
+from test.test_sink import CrateDBStub
+
+import unittest
+
+
+class Cursor:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def __aiter__(self):
+        return self.iterate()
+
+    async def iterate(self):
+        for document in self.documents:
+            await asyncio.sleep(0)
+            yield RawBSONDocument(bson.encode(document))
+
+
+class Collection:
+    def __init__(self, documents):
+        self.documents = documents
+        self.calls = []
+
+    def find(self, query, batch_size):
+        self.calls.append((query, batch_size))
+        return Cursor(self.documents)
+
+
+def unused_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class TestAsyncExport(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), CrateDBStub)
+        self.server.requests = []
+        self.server.connections = set()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "crate://127.0.0.1:{0}/test.items".format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    async def test_export_to_cratedb(self):
+        collection = Collection([{"_id": i, "i": i} for i in range(100)])
+        sink = aio.ThreadSink(CrateDBSink(self.url, batch_size=10, concurrency=3))
+        await aio.export(collection, sink, batch_size=7)
+        await sink.close()
+
+        self.assertEqual(collection.calls, [({}, 7)])
+        self.assertEqual(sink.sink.inserted, 100)
+        self.assertEqual(len(self.server.requests), 10)
+        self.assertLessEqual(len(self.server.connections), 3)
+        path, body = self.server.requests[0]
+        self.assertEqual(path, "/_sql")
+        self.assertEqual(body["stmt"], 'INSERT INTO "test"."items" ("i") VALUES (?)')
+        rows = sorted(
+            row for _, body in self.server.requests for row in body["bulk_args"]
+        )
+        self.assertEqual(rows, [[i] for i in range(100)])
+
+    async def test_failed_rows(self):
+        sink = aio.ThreadSink(CrateDBSink(self.url, batch_size=10))
+        await sink.write_batch([{"a": 1}, {"a": None}])
+        await sink.close()
+        self.assertEqual((sink.sink.inserted, sink.sink.failed), (1, 1))
+
+    async def test_connection_error(self):
+        url = "crate://127.0.0.1:{0}/test.items".format(unused_port())
+        sink = aio.ThreadSink(CrateDBSink(url, batch_size=1))
+        with self.assertRaises(ConnectionError):
+            await sink.write_batch([{"a": 1}, {"a": 2}])
+            await sink.close()
+
+    async def test_export_collections(self):
+        client = {
+            "db": {
+                "a": Collection([{"_id": i, "a": i} for i in range(3)]),
+                "b": Collection([{"_id": i, "b": i} for i in range(5)]),
+            }
+        }
+        outputs = {}
+
+        def sink_factory(name):
+            outputs[name] = io.BytesIO()
+            return aio.ThreadSink(StreamSink(outputs[name]))
+
+        sinks = await aio.export_collections(
+            client, "db", ["a", "b"], sink_factory, batch_size=2
+        )
+        self.assertEqual(len(sinks), 2)
+        self.assertEqual(outputs["a"].getvalue(), b'{"a":0}\n{"a":1}\n{"a":2}\n')
+        self.assertEqual(len(outputs["b"].getvalue().splitlines()), 5)
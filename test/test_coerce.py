@@ -0,0 +1,123 @@
+import datetime
+import uuid
+from math import inf
+
+import bson
+
+from crate.migr8.coerce import Coercer
+from crate.migr8.extract import extract_schema_from_document
+
+import unittest
+
+
+def schema_of(documents):
+    schema = {}
+    for document in documents:
+        extract_schema_from_document(document, schema)
+    return schema
+
+
+class TestCoercer(unittest.TestCase):
+    def coercer(self, *documents):
+        return Coercer(schema_of(documents))
+
+    def test_matching_values(self):
+        document = {
+            "i": 1,
+            "l": bson.Int64(2),
+            "f": 1.5,
+            "s": "a",
+            "b": False,
+            "d": datetime.datetime(2020, 1, 1),
+            "o": {"x": 1},
+            "a": [1, 2],
+            "n": None,
+        }
+        coerce = self.coercer(document)
+        self.assertEqual(coerce(dict(document)), document)
+        self.assertEqual(coerce.stats(), {"coerced": {}, "dropped": {}})
+
+    def test_integers(self):
+        coerce = self.coercer({"i": 1}, {"i": 2})
+        self.assertEqual(coerce({"i": "3"}), {"i": 3})
+        self.assertEqual(coerce({"i": 4.0}), {"i": 4})
+        self.assertEqual(coerce({"i": True}), {"i": 1})
+        self.assertEqual(coerce({"i": 4.5}), {})
+        self.assertEqual(coerce({"i": "x"}), {})
+        self.assertEqual(coerce.coerced, {"i": 3})
+        self.assertEqual(coerce.dropped, {"i": 2})
+
+    def test_floats(self):
+        coerce = self.coercer({"f": 1.5})
+        self.assertEqual(coerce({"f": 2}), {"f": 2})
+        self.assertEqual(coerce({"f": "2.5"}), {"f": 2.5})
+        self.assertEqual(coerce({"f": [1]}), {})
+        self.assertEqual(coerce({"f": bson.Decimal128("0.1")}), {"f": 0.1})
+        self.assertEqual(coerce({"f": bson.Decimal128("-Infinity")}), {"f": -inf})
+        self.assertEqual(coerce({"f": bson.Decimal128("sNaN")}), {})
+
+    def test_strings(self):
+        coerce = self.coercer({"s": "a"})
+        self.assertEqual(coerce({"s": 1}), {"s": "1"})
+        self.assertEqual(coerce({"s": True}), {"s": "true"})
+        self.assertEqual(coerce({"s": {"a": 1}}), {})
+        oid, u = bson.ObjectId(), uuid.uuid4()
+        self.assertEqual(coerce({"s": oid}), {"s": str(oid)})
+        self.assertEqual(coerce({"s": bson.Decimal128("1.50")}), {"s": "1.50"})
+        self.assertEqual(coerce({"s": u}), {"s": str(u)})
+        self.assertEqual(coerce({"s": bson.Binary.from_uuid(u)}), {"s": str(u)})
+        self.assertEqual(coerce({"s": bson.Binary(b"ab")}), {})
+
+    def test_booleans(self):
+        coerce = self.coercer({"b": True})
+        self.assertEqual(coerce({"b": "False"}), {"b": False})
+        self.assertEqual(coerce({"b": 1}), {})
+
+    def test_datetimes(self):
+        coerce = self.coercer({"d": datetime.datetime(2020, 1, 1)})
+        self.assertEqual(coerce({"d": 1000}), {"d": 1000})
+        self.assertEqual(coerce({"d": "1970-01-01T00:00:01Z"}), {"d": 1000})
+        self.assertEqual(coerce({"d": "yesterday"}), {})
+
+    def test_nested(self):
+        coerce = self.coercer(
+            {"o": {"x": 1, "y": {"z": "a"}}, "a": [1, 2], "m": [{"k": 1}]}
+        )
+        self.assertEqual(
+            coerce(
+                {
+                    "o": {"x": "2", "y": {"z": 3}, "other": "kept"},
+                    "a": [1, "2", "x", None],
+                    "m": [{"k": "3"}, "no object"],
+                }
+            ),
+            {
+                "o": {"x": 2, "y": {"z": "3"}, "other": "kept"},
+                "a": [1, 2, None, None],
+                "m": [{"k": 3}, None],
+            },
+        )
+        self.assertEqual(coerce.coerced, {"o.x": 1, "o.y.z": 1, "a[]": 1, "m[].k": 1})
+        self.assertEqual(coerce.dropped, {"a[]": 1, "m[]": 1})
+        self.assertEqual(coerce({"o": 1, "a": "a"}), {})
+
+    def test_dominant_type(self):
+        coerce = self.coercer({"v": "a"}, {"v": "b"}, {"v": 1})
+        self.assertEqual(coerce({"v": 2}), {"v": "2"})
+
+    def test_untranslated_fields(self):
+        coerce = self.coercer({"r": bson.Regex("a"), "oid": bson.ObjectId()})
+        self.assertEqual(coerce({"r": 1, "oid": "x"}), {"r": 1, "oid": "x"})
+
+    def test_id_column(self):
+        coerce = Coercer(schema_of([{"id": 1, "n": 1}]), id_column="id")
+        self.assertEqual(coerce({"id": "x", "n": "2"}), {"id": "x", "n": 2})
+
+    def test_update(self):
+        coerce = self.coercer({"i": 1})
+        other = self.coercer({"i": 1})
+        coerce({"i": "1"})
+        other({"i": "2"})
+        other({"i": "x"})
+        coerce.update(other.stats())
+        self.assertEqual(coerce.stats(), {"coerced": {"i": 2}, "dropped": {"i": 1}})
@@ -0,0 +1,192 @@
+import datetime
+import json
+import os
+import tempfile
+import uuid
+
+import bson
+from bson.raw_bson import RawBSONDocument
+
+from crate.migr8 import columnar, export
+from crate.migr8.coerce import Coercer
+from crate.migr8.extract import extract_schema_from_document
+
+import unittest
+
+
+def schema_of(documents):
+    schema = {}
+    for document in documents:
+        extract_schema_from_document(document, schema)
+    return schema
+
+
+@unittest.skipIf(columnar.pa is None, "pyarrow is not installed")
+class TestParquet(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.directory = tmpdir.name
+
+    def test_arrow_schema(self):
+        schema = schema_of(
+            [
+                {
+                    "_id": bson.ObjectId(),
+                    "i": 1,
+                    "l": bson.Int64(2),
+                    "f": 1.5,
+                    "s": "a",
+                    "b": True,
+                    "d": datetime.datetime(2020, 1, 1),
+                    "o": {"x": 1, "empty": {}},
+                    "a": ["a", "b"],
+                    "e": [],
+                    "r": bson.Regex("a"),
+                }
+            ]
+        )
+        pa = columnar.pa
+        self.assertEqual(
+            columnar.arrow_schema(schema),
+            pa.schema(
+                [
+                    ("i", pa.int64()),
+                    ("l", pa.int64()),
+                    ("f", pa.float64()),
+                    ("s", pa.string()),
+                    ("b", pa.bool_()),
+                    ("d", pa.timestamp("ms", tz="UTC")),
+                    ("o", pa.struct([("x", pa.int64())])),
+                    ("a", pa.list_(pa.string())),
+                ]
+            ),
+        )
+
+    def test_dominant_type(self):
+        schema = schema_of([{"n": 1}, {"n": 2}, {"n": "three"}])
+        self.assertEqual(
+            columnar.arrow_schema(schema).field("n").type, columnar.pa.int64()
+        )
+
+    def test_write(self):
+        documents = [
+            {"_id": 1, "n": 1, "d": datetime.datetime(2020, 1, 1), "o": {"x": "a"}},
+            {"_id": 2, "n": "two", "d": "2020", "o": {"x": 3}},
+            {"_id": 3, "n": 3, "d": datetime.datetime(2020, 1, 2), "o": "o"},
+        ]
+        schema = schema_of(documents)
+        manifest = os.path.join(self.directory, "test.manifest.json")
+        sink = columnar.ParquetSink(
+            self.directory,
+            "test",
+            schema,
+            compress="gzip",
+            manifest=manifest,
+            row_group_size=2,
+        )
+        sink.write_batch(
+            [
+                export.convert_document(RawBSONDocument(bson.encode(d)))
+                for d in documents
+            ]
+        )
+        sink.close()
+
+        path = os.path.join(self.directory, "test.parquet")
+        self.assertEqual(columnar.pq.ParquetFile(path).metadata.num_row_groups, 1)
+        rows = columnar.pq.read_table(path).to_pylist()
+        self.assertEqual([row["n"] for row in rows], [1, None, 3])
+        self.assertEqual(rows[0]["d"].date(), datetime.date(2020, 1, 1))
+        self.assertIsNone(rows[1]["d"])
+        self.assertEqual([row["o"] for row in rows], [{"x": "a"}, {"x": None}, None])
+        # "two", "2020", 3 and "o" do not match their columns.
+        self.assertEqual(sink.nulled, 4)
+        with open(manifest) as f:
+            self.assertEqual(
+                json.load(f),
+                {
+                    "compression": "gzip",
+                    "rows": 3,
+                    "files": [{"file": "test.parquet", "rows": 3}],
+                },
+            )
+
+    def test_coerced_dates(self):
+        documents = [
+            {"_id": 1, "ts": datetime.datetime(2020, 1, 1)},
+            {"_id": 2, "ts": datetime.datetime(2020, 1, 2)},
+            {"_id": 3, "ts": "2021-01-01T00:00:00Z"},
+            {"_id": 4, "ts": 1600000000000},
+        ]
+        schema = schema_of(documents)
+        coerce = Coercer(schema)
+        sink = columnar.ParquetSink(self.directory, "test", schema)
+        sink.write_batch(
+            [
+                coerce(export.convert_document(RawBSONDocument(bson.encode(d))))
+                for d in documents
+            ]
+        )
+        sink.close()
+
+        rows = columnar.pq.read_table(
+            os.path.join(self.directory, "test.parquet")
+        ).to_pylist()
+        utc = datetime.timezone.utc
+        self.assertEqual(
+            [row["ts"] for row in rows],
+            [
+                datetime.datetime(2020, 1, 1, tzinfo=utc),
+                datetime.datetime(2020, 1, 2, tzinfo=utc),
+                datetime.datetime(2021, 1, 1, tzinfo=utc),
+                datetime.datetime.fromtimestamp(1600000000, utc),
+            ],
+        )
+        self.assertEqual(sink.nulled, 0)
+
+    def test_bson_values(self):
+        pa = columnar.pa
+        invalid = []
+        to_string = columnar.value_converter(pa.string(), invalid.append)
+        oid, u = bson.ObjectId(), uuid.uuid4()
+        self.assertEqual(to_string(oid), str(oid))
+        self.assertEqual(to_string(bson.Decimal128("1.50")), "1.50")
+        self.assertEqual(to_string(u), str(u))
+        self.assertEqual(to_string(bson.Binary.from_uuid(u)), str(u))
+        self.assertIsNone(to_string(None))
+        self.assertIsNone(to_string(bson.Binary(b"ab")))
+        to_float = columnar.value_converter(pa.float64(), invalid.append)
+        self.assertEqual(to_float(bson.Decimal128("1.5")), 1.5)
+        self.assertIsNone(to_float(bson.Decimal128("sNaN")))
+        self.assertIsNone(to_float(True))
+        to_list = columnar.value_converter(pa.list_(pa.int64()), invalid.append)
+        self.assertEqual(to_list([1, None, "a"]), [1, None, None])
+        # Only the values which can not be converted are passed on, not nulls.
+        self.assertEqual(
+            invalid, [bson.Binary(b"ab"), bson.Decimal128("sNaN"), True, "a"]
+        )
+
+    def test_id_column(self):
+        documents = [{"_id": bson.ObjectId(), "n": 1} for _ in range(2)]
+        sink = columnar.ParquetSink(
+            self.directory, "test", schema_of(documents), id_column="id"
+        )
+        sink.write_batch(
+            [
+                export.convert_document(RawBSONDocument(bson.encode(d)), "id")
+                for d in documents
+            ]
+        )
+        sink.close()
+        table = columnar.pq.read_table(os.path.join(self.directory, "test.parquet"))
+        self.assertEqual(table.column_names, ["id", "n"])
+        self.assertEqual(
+            table.column("id").to_pylist(), [str(d["_id"]) for d in documents]
+        )
+
+    def test_empty(self):
+        sink = columnar.ParquetSink(self.directory, "test", schema_of([{"n": 1}]))
+        sink.close()
+        table = columnar.pq.read_table(os.path.join(self.directory, "test.parquet"))
+        self.assertEqual(table.num_rows, 0)
@@ -0,0 +1,99 @@
+import json
+import os
+import tempfile
+
+import bson
+
+from crate.migr8 import dump, export, extract
+from crate.migr8.sink import FileSink
+
+import unittest
+
+
+class TestDump(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.directory = tmpdir.name
+        self.path = os.path.join(self.directory, "test.bson")
+        self.documents = [
+            {"_id": i, "n": i, "s": "x" * (i % 7), "o": {"a": [i, str(i)]}}
+            for i in range(100)
+        ]
+        with open(self.path, "wb") as f:
+            for document in self.documents:
+                f.write(bson.encode(document))
+
+    def test_iter_documents(self):
+        documents = list(dump.iter_documents(self.path))
+        self.assertEqual([bson.decode(d.raw) for d in documents], self.documents)
+
+    def test_empty_file(self):
+        open(self.path, "wb").close()
+        self.assertEqual(list(dump.iter_documents(self.path)), [])
+        self.assertEqual(dump.split_dump(self.path, 4), [])
+
+    def test_truncated_file(self):
+        with open(self.path, "r+b") as f:
+            f.truncate(os.path.getsize(self.path) - 3)
+        with self.assertRaises(bson.errors.InvalidBSON):
+            list(dump.iter_documents(self.path))
+
+    def test_split_dump(self):
+        ranges = dump.split_dump(self.path, 4)
+        self.assertEqual(len(ranges), 4)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], os.path.getsize(self.path))
+        ids = [
+            d["_id"]
+            for start, end in ranges
+            for d in dump.iter_documents(self.path, start, end)
+        ]
+        self.assertEqual(ids, list(range(100)))
+
+    def test_split_more_parts_than_documents(self):
+        ranges = dump.split_dump(self.path, 1000)
+        self.assertEqual(len(ranges), 100)
+
+    def test_collection_name(self):
+        self.assertEqual(dump.collection_name("dump/db/test.bson"), "test")
+
+    def test_compressed_dump(self):
+        with self.assertRaises(ValueError):
+            dump.DumpCollection(self.path + ".gz")
+
+    def test_query(self):
+        with self.assertRaises(ValueError):
+            dump.DumpCollection(self.path).find({"n": 1})
+
+    def test_extract_schema(self):
+        schema = {}
+        for document in self.documents:
+            extract.extract_schema_from_document(document, schema)
+        extracted = extract.extract_schema_from_dump(self.path)
+        self.assertEqual(extracted["count"], 100)
+        self.assertEqual(extracted["document"], schema)
+
+    def test_export(self):
+        sink = FileSink(self.directory, "test")
+        export.export(dump.DumpCollection(self.path), sink, batch_size=30)
+        sink.close()
+        with open(os.path.join(self.directory, "test.json")) as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual(
+            rows, [{k: v for k, v in d.items() if k != "_id"} for d in self.documents]
+        )
+
+    def test_export_parallel(self):
+        out = os.path.join(self.directory, "out")
+        os.mkdir(out)
+        export.export_parallel(
+            None, None, None, "test", 3, directory=out, dump=self.path
+        )
+        with open(os.path.join(out, "test.manifest.json")) as f:
+            manifest = json.load(f)
+        self.assertEqual(manifest["rows"], 100)
+        self.assertEqual(
+            [f["file"] for f in manifest["files"]],
+            ["test-0000.json", "test-0001.json", "test-0002.json"],
+        )
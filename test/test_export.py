@@ -0,0 +1,621 @@
+import base64
+import datetime
+import io
+import json
+import os
+import random
+import tempfile
+import time
+from unittest import mock
+
+import bson
+import bsonjs
+import orjson
+from bson.raw_bson import RawBSONDocument
+
+from crate.migr8 import codec, export, partition
+from crate.migr8.checkpoint import Checkpoint
+from crate.migr8.coerce import Coercer
+from crate.migr8.sink import StreamSink
+
+import unittest
+
+
+def raw(document):
+    return RawBSONDocument(bson.encode(document))
+
+
+class TestExport(unittest.TestCase):
+    def test_export_to_file_object(self):
+        collection = mock.Mock()
+        collection.find.return_value = [
+            raw({"_id": 1, "a": "b", "c": [1, 2]}),
+            raw({"_id": 2, "a": {"b": 3.5}}),
+        ]
+        out = io.BytesIO()
+        export.export(collection, StreamSink(out), query={"_id": {"$gt": 0}})
+        collection.find.assert_called_once_with({"_id": {"$gt": 0}}, batch_size=1000)
+        self.assertEqual(out.getvalue(), b'{"a":"b","c":[1,2]}\n{"a":{"b":3.5}}\n')
+
+
+class TestBatches(unittest.TestCase):
+    def test_stream_sink_batch(self):
+        out = io.BytesIO()
+        sink = StreamSink(out)
+        sink.write_batch([{"a": 1}, {"a": 2}])
+        sink.write_batch([])
+        self.assertEqual(out.getvalue(), b'{"a":1}\n{"a":2}\n')
+
+    def test_export_in_batches(self):
+        collection = mock.Mock()
+        collection.find.return_value = [raw({"_id": i, "n": i}) for i in range(5)]
+        sink = mock.Mock()
+        export.export(collection, sink, batch_size=2)
+        collection.find.assert_called_once_with({}, batch_size=2)
+        self.assertEqual(
+            [c.args[0] for c in sink.write_batch.call_args_list],
+            [[{"n": 0}, {"n": 1}], [{"n": 2}, {"n": 3}], [{"n": 4}]],
+        )
+        sink.write.assert_not_called()
+
+    def test_export_with_coercion(self):
+        collection = mock.Mock()
+        collection.find.return_value = [
+            raw({"_id": 1, "n": 1}),
+            raw({"_id": 2, "n": "2"}),
+            raw({"_id": 3, "n": "x"}),
+        ]
+        coerce = Coercer({"n": {"count": 3, "types": {"INTEGER": {"count": 2}}}})
+        out = io.BytesIO()
+        export.export(collection, StreamSink(out), coerce=coerce)
+        self.assertEqual(out.getvalue(), b'{"n":1}\n{"n":2}\n{}\n')
+        self.assertEqual(coerce.stats(), {"coerced": {"n": 1}, "dropped": {"n": 1}})
+
+
+class TestKeepId(unittest.TestCase):
+    def test_keep_id(self):
+        oid = bson.ObjectId()
+        collection = mock.Mock()
+        collection.find.return_value = [
+            raw({"_id": oid, "n": 1}),
+            raw({"_id": "a", "n": 2}),
+            raw({"_id": 3, "n": 3}),
+            raw({"_id": {"k": 4}, "n": 4}),
+        ]
+        out = io.BytesIO()
+        export.export(collection, StreamSink(out), id_column="key")
+        self.assertEqual(
+            [orjson.loads(line)["key"] for line in out.getvalue().splitlines()],
+            [str(oid), "a", "3", '{"k": 4}'],
+        )
+
+    def test_id_string_unambiguous(self):
+        # Numbers of different types, like 5 and Int64(5), are equal as _id.
+        oid = bson.ObjectId()
+        values = [
+            oid,
+            str(oid),
+            5,
+            "5",
+            5.5,
+            "5.5",
+            True,
+            "true",
+            None,
+            "null",
+            {"k": 4},
+            '{"k": 4}',
+            [1],
+            "[1]",
+            '"a"',
+            "a",
+            "",
+        ]
+        keys = [export.id_string(value) for value in values]
+        self.assertEqual(len(set(keys)), len(values), keys)
+        self.assertEqual(export.id_string("a"), "a")
+        self.assertEqual(export.id_string("5"), '"5"')
+        self.assertEqual(export.id_string(str(oid)), '"{0}"'.format(oid))
+
+    def test_id_column_collision(self):
+        document = raw({"_id": 1, "key": 2})
+        with self.assertRaisesRegex(ValueError, "field named key"):
+            export.convert_document(document, "key")
+
+    def test_id_left_out(self):
+        document = raw({"_id": bson.ObjectId(), "n": 1})
+        self.assertEqual(export.convert_document(document), {"n": 1})
+
+
+class TestDeadLetter(unittest.TestCase):
+    def setUp(self):
+        self.invalid = RawBSONDocument(
+            bson.encode({"_id": 2, "s": "x"}).replace(b"x\x00", b"\xff\x00")
+        )
+        self.collection = mock.Mock()
+        self.collection.find.return_value = [
+            raw({"_id": 1, "n": 1}),
+            self.invalid,
+            raw({"_id": 3, "n": 3}),
+        ]
+
+    def test_conversion_error_stops_export(self):
+        with self.assertRaises(bson.errors.InvalidBSON):
+            export.export(self.collection, mock.Mock())
+
+    def test_dead_letter(self):
+        out = io.BytesIO()
+        dead_letter = export.DeadLetter()
+        export.export(self.collection, StreamSink(out), dead_letter=dead_letter)
+        self.assertEqual(out.getvalue(), b'{"n":1}\n{"n":3}\n')
+        self.assertEqual(dead_letter.count, 1)
+        [record] = dead_letter.records
+        self.assertEqual(record["_id"], 2)
+        self.assertTrue(record["error"].startswith("InvalidBSON: "))
+        self.assertEqual(base64.b64decode(record["document"]), bytes(self.invalid.raw))
+
+    def test_dead_letter_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "dead.json")
+            for append in (False, True):
+                dead_letter = export.DeadLetter(path, append=append)
+                export.export(self.collection, mock.Mock(), dead_letter=dead_letter)
+                dead_letter.close()
+            with open(path, "rb") as f:
+                records = [orjson.loads(line) for line in f]
+        self.assertEqual([r["_id"] for r in records], [2, 2])
+
+    def test_checkpoint_skips_failed_batch(self):
+        self.collection.find.return_value = [self.invalid]
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        checkpoint = Checkpoint(
+            os.path.join(tmpdir.name, "checkpoint.json"), "db", "test"
+        )
+        checkpoint.advance(1)
+        export.export(
+            self.collection,
+            mock.Mock(),
+            checkpoint=checkpoint,
+            dead_letter=export.DeadLetter(),
+        )
+        self.assertEqual(checkpoint.last_id, 2)
+
+
+class TestFilters(unittest.TestCase):
+    def test_field_projection(self):
+        self.assertIsNone(export.field_projection())
+        self.assertEqual(export.field_projection(["a", "b.c"]), {"a": 1, "b.c": 1})
+        self.assertEqual(export.field_projection(exclude=["blob"]), {"blob": 0})
+        with self.assertRaises(ValueError):
+            export.field_projection(["a"], ["b"])
+        with self.assertRaises(ValueError):
+            export.field_projection(exclude=["_id"])
+
+    def test_parse_date(self):
+        utc = datetime.timezone.utc
+        self.assertEqual(
+            export.parse_date("2024-02-29"), datetime.datetime(2024, 2, 29, tzinfo=utc)
+        )
+        self.assertEqual(
+            export.parse_date("2024-02-29T12:30:00.5+01:00"),
+            datetime.datetime(2024, 2, 29, 11, 30, 0, 500000, tzinfo=utc),
+        )
+        self.assertEqual(
+            export.parse_date("2024-02-29T23:00Z"),
+            datetime.datetime(2024, 2, 29, 23, tzinfo=utc),
+        )
+        for value in (
+            "yesterday",
+            "garbage",
+            "",
+            "2024-13-45",
+            "2023-02-29",
+            "2024-01-01T25:00",
+            "2024-01-01T12:00+25:00",
+        ):
+            with self.subTest(value=value), self.assertRaises(ValueError):
+                export.parse_date(value)
+
+    def test_date_filter(self):
+        since = datetime.datetime(2024, 1, 1)
+        until = datetime.datetime(2025, 1, 1)
+        self.assertEqual(export.date_filter("ts"), {})
+        self.assertEqual(export.date_filter("ts", since), {"ts": {"$gte": since}})
+        self.assertEqual(
+            export.date_filter("ts", since, until),
+            {"ts": {"$gte": since, "$lt": until}},
+        )
+
+    def test_export_with_projection(self):
+        collection = mock.Mock()
+        collection.find.return_value = [raw({"_id": 1, "a": 1})]
+        out = io.BytesIO()
+        export.export(collection, StreamSink(out), query={"a": 1}, projection={"a": 1})
+        collection.find.assert_called_once_with(
+            {"a": 1}, batch_size=1000, projection={"a": 1}
+        )
+        self.assertEqual(out.getvalue(), b'{"a":1}\n')
+
+
+class TestPipeline(unittest.TestCase):
+    def slow(self, batch):
+        time.sleep(random.random() / 100)
+        return batch
+
+    def test_ordered(self):
+        batches = [[i] for i in range(50)]
+        results = list(export.pipeline(iter(batches), self.slow, 4))
+        self.assertEqual(results, batches)
+
+    def test_unordered(self):
+        batches = [[i] for i in range(50)]
+        results = list(export.pipeline(iter(batches), self.slow, 4, ordered=False))
+        self.assertEqual(sorted(results), batches)
+
+    def test_backpressure(self):
+        fetched = []
+
+        def batches():
+            for i in range(100):
+                fetched.append(i)
+                yield [i]
+
+        results = export.pipeline(batches(), self.slow, 1)
+        next(results)
+        time.sleep(0.3)
+        self.assertLessEqual(len(fetched), 6)
+        results.close()
+
+    def test_fetch_error(self):
+        def batches():
+            yield [1]
+            raise RuntimeError("cursor")
+
+        with self.assertRaisesRegex(RuntimeError, "cursor"):
+            list(export.pipeline(batches(), self.slow, 2))
+
+    def test_convert_error(self):
+        def fail(batch):
+            raise RuntimeError("convert")
+
+        with self.assertRaisesRegex(RuntimeError, "convert"):
+            list(export.pipeline(iter([[1], [2]]), fail, 2))
+
+    def test_export_with_workers(self):
+        collection = mock.Mock()
+        collection.find.return_value = [raw({"_id": i, "n": i}) for i in range(50)]
+        out = io.BytesIO()
+        export.export(collection, StreamSink(out), batch_size=3, workers=4)
+        self.assertEqual(
+            out.getvalue().splitlines(),
+            [b'{"n":%d}' % i for i in range(50)],
+        )
+
+    def test_unordered_checkpoint(self):
+        checkpoint = Checkpoint("checkpoint.json", "db", "test")
+        with self.assertRaises(ValueError):
+            export.export(mock.Mock(), checkpoint=checkpoint, ordered=False)
+
+
+class TestConvert(unittest.TestCase):
+    def native(self, document):
+        return orjson.loads(codec.dumps(export.convert_document(raw(document))))
+
+    def legacy(self, document):
+        return export.convert(orjson.loads(bsonjs.dumps(bson.encode(document))))
+
+    def test_same_as_extended_json(self):
+        document = {
+            "_id": bson.ObjectId(),
+            "oid": bson.ObjectId(),
+            "int": 1,
+            "long": bson.Int64(2**40),
+            "float": 1.5,
+            "string": "a",
+            "bool": True,
+            "null": None,
+            "timestamp": bson.Timestamp(1600000000, 1),
+            "decimal": bson.Decimal128("1.5"),
+            "binary": bson.Binary(b"ab", 0x80),
+            "bytes": b"cd",
+            "regex": bson.Regex("^a", "imx"),
+            "min": bson.MinKey(),
+            "max": bson.MaxKey(),
+            "ref": bson.DBRef("other", 1, "db"),
+            "nested": {"a": [1, {"b": bson.ObjectId()}], "c": {"d": "e"}},
+        }
+        self.assertEqual(self.native(document), self.legacy(document))
+
+    def test_dates(self):
+        document = {
+            "_id": 1,
+            "date": datetime.datetime(2020, 1, 2, 3, 4, 5, 678000),
+            "before_epoch": datetime.datetime(1960, 1, 1),
+            "dates": [datetime.datetime(1970, 1, 1, 0, 0, 1)],
+        }
+        self.assertEqual(
+            self.native(document),
+            {"date": 1577934245678, "before_epoch": -315619200000, "dates": [1000]},
+        )
+
+    def test_dates_same_as_extended_json(self):
+        document = {
+            "_id": 1,
+            "date": datetime.datetime(2020, 1, 2, 3, 4, 5, 678000),
+            "before_epoch": datetime.datetime(1960, 1, 1),
+            "out_of_range": bson.DatetimeMS(253402300800000),
+        }
+        self.assertEqual(self.native(document), self.legacy(document))
+
+    def test_date_out_of_range(self):
+        millis = 253402300800000  # 10000-01-01
+        document = {"_id": 1, "date": bson.DatetimeMS(millis)}
+        self.assertEqual(self.native(document), {"date": millis})
+
+
+class TestDateConverter(unittest.TestCase):
+    def test_iso_strings(self):
+        for value, expected in [
+            ("2020-01-02T03:04:05.678Z", 1577934245678),
+            ("2020-01-02T03:04:05Z", 1577934245000),
+            ("2020-01-02T03:04:05.6Z", 1577934245600),
+            ("2020-01-02T03:04:05.678912Z", 1577934245678),
+            ("2020-01-02T03:04:05.678+0000", 1577934245678),
+            ("2020-01-02T05:04:05.678+02:00", 1577934245678),
+            ("2020-01-02T01:34:05.678-0130", 1577934245678),
+            ("1960-01-01T00:00:00Z", -315619200000),
+        ]:
+            self.assertEqual(export.date_converter(value), expected, value)
+
+    def test_millis(self):
+        self.assertEqual(export.date_converter(1577934245678), 1577934245678)
+        self.assertEqual(
+            export.date_converter({"$numberLong": "-62135596800001"}),
+            -62135596800001,
+        )
+
+    def test_invalid(self):
+        for value in [
+            "yesterday",
+            "2020-13-01T00:00:00Z",
+            "2020-00-01T00:00:00Z",
+            "2020-01-00T00:00:00Z",
+            "2020-13-45T00:00:00Z",
+            "2020-04-31T00:00:00Z",
+            "2021-02-29T00:00:00Z",
+            "1900-02-29T00:00:00Z",
+            "2020-01-01T24:00:00Z",
+            "2020-01-01T25:61:00Z",
+            "2020-01-01T00:60:00Z",
+            "2020-01-01T00:00:60Z",
+            "2020-01-01T00:00:00+24:00",
+            "2020-01-01T00:00:00+01:60",
+        ]:
+            with self.assertRaises(ValueError, msg=value):
+                export.date_converter(value)
+
+    def test_leap_days(self):
+        self.assertEqual(export.date_converter("2020-02-29T00:00:00Z"), 1582934400000)
+        self.assertEqual(export.date_converter("2000-02-29T00:00:00Z"), 951782400000)
+
+    def test_extended_json(self):
+        document = {
+            "_id": 1,
+            "a": {"$date": "2020-01-02T03:04:05.678Z"},
+            "b": {"$date": {"$numberLong": "253402300800000"}},
+            "c": [{"$date": 1000}],
+        }
+        self.assertEqual(
+            export.convert(document),
+            {"a": 1577934245678, "b": 253402300800000, "c": [1000]},
+        )
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, "checkpoint.json")
+        self.ids = [bson.ObjectId() for _ in range(5)]
+        self.collection = mock.Mock()
+        self.collection.find.return_value = [
+            raw({"_id": i, "n": n}) for n, i in enumerate(self.ids)
+        ]
+
+    def test_checkpoint(self):
+        checkpoint = Checkpoint(self.path, "db", "test", interval=2)
+        written = []
+        sink = mock.Mock()
+        sink.write_batch.side_effect = written.extend
+        sink.flush.side_effect = lambda: self.assertEqual(
+            len(written), checkpoint.count
+        )
+        export.export(self.collection, sink, checkpoint=checkpoint, batch_size=2)
+
+        self.collection.find.assert_called_once_with(
+            {}, sort=[("_id", 1)], batch_size=2
+        )
+        self.assertEqual(sink.write_batch.call_count, 3)
+        self.assertEqual(sink.flush.call_count, 3)
+        self.assertEqual(written, [{"n": n} for n in range(5)])
+        with open(self.path) as f:
+            state = json.load(f)
+        self.assertEqual(
+            state,
+            {
+                "database": "db",
+                "collection": "test",
+                "last_id": {"$oid": str(self.ids[-1])},
+                "count": 5,
+            },
+        )
+
+    def test_resume(self):
+        checkpoint = Checkpoint(self.path, "db", "test")
+        checkpoint.advance(self.ids[1])
+        checkpoint.advance(self.ids[1])
+        checkpoint.save()
+
+        resumed = Checkpoint(self.path, "db", "test")
+        resumed.load()
+        self.assertTrue(resumed.resumed)
+        self.assertEqual(resumed.count, 2)
+        export.export(self.collection, mock.Mock(), query={"n": 1}, checkpoint=resumed)
+        self.collection.find.assert_called_once_with(
+            {"$and": [{"n": 1}, partition.id_range(after=self.ids[1])]},
+            sort=[("_id", 1)],
+            batch_size=1000,
+        )
+        self.assertEqual(resumed.count, 7)
+
+    def test_output_position(self):
+        positions = iter(range(10))
+        checkpoint = Checkpoint(
+            self.path, "db", "test", position=lambda: next(positions)
+        )
+        checkpoint.save()
+        checkpoint.save()
+        resumed = Checkpoint(self.path, "db", "test")
+        resumed.load()
+        self.assertEqual(resumed.output, 1)
+
+    def test_checkpoint_interval_with_batches(self):
+        checkpoint = Checkpoint(self.path, "db", "test", interval=10)
+        self.assertFalse(checkpoint.advance(self.ids[0], 8))
+        self.assertTrue(checkpoint.advance(self.ids[1], 8))
+        self.assertFalse(checkpoint.advance(self.ids[2], 3))
+        self.assertTrue(checkpoint.advance(self.ids[3], 25))
+        self.assertEqual(checkpoint.count, 44)
+
+    def test_resume_other_collection(self):
+        Checkpoint(self.path, "db", "test").save()
+        with self.assertRaises(ValueError):
+            Checkpoint(self.path, "db", "other").load()
+
+    def test_missing_checkpoint(self):
+        checkpoint = Checkpoint(self.path, "db", "test")
+        checkpoint.load()
+        self.assertFalse(checkpoint.resumed)
+        self.assertEqual(checkpoint.query(), {})
+
+
+class TestPartition(unittest.TestCase):
+    def sampled(self, values):
+        collection = mock.Mock()
+        collection.aggregate.return_value = [{"_id": v} for v in sorted(values)]
+        return collection
+
+    def test_single_partition(self):
+        collection = self.sampled(range(100))
+        self.assertEqual(partition.partition_filters(collection, 1), [{}])
+        collection.aggregate.assert_not_called()
+
+    def test_empty_collection(self):
+        collection = self.sampled([])
+        self.assertEqual(partition.partition_filters(collection, 4), [{}])
+
+    def test_ranges(self):
+        collection = self.sampled(range(100))
+        filters = partition.partition_filters(collection, 4)
+        self.assertEqual(
+            filters,
+            [
+                {"_id": {"$type": "number", "$lt": 25}},
+                {"_id": {"$type": "number", "$gte": 25, "$lt": 50}},
+                {"_id": {"$type": "number", "$gte": 50, "$lt": 75}},
+                {"_id": {"$type": "number", "$gte": 75}},
+                {"_id": {"$not": {"$type": "number"}}},
+            ],
+        )
+
+    def test_duplicate_bounds(self):
+        collection = self.sampled(["a"] * 10 + ["b"] * 10)
+        filters = partition.partition_filters(collection, 4)
+        self.assertEqual(
+            filters,
+            [
+                {"_id": {"$type": "string", "$lt": "b"}},
+                {"_id": {"$type": "string", "$gte": "b"}},
+                {"_id": {"$not": {"$type": "string"}}},
+            ],
+        )
+
+    def test_id_range(self):
+        self.assertEqual(partition.id_range(), {})
+        self.assertEqual(
+            partition.id_range(after=5),
+            {
+                "$or": [
+                    {"_id": {"$gt": 5}},
+                    {
+                        "_id": {
+                            "$type": [
+                                "symbol",
+                                "string",
+                                "object",
+                                "array",
+                                "binData",
+                                "objectId",
+                                "bool",
+                                "date",
+                                "timestamp",
+                                "regex",
+                                "maxKey",
+                            ]
+                        }
+                    },
+                ]
+            },
+        )
+        oid = bson.ObjectId()
+        self.assertEqual(
+            partition.id_range(after="a", upto=oid),
+            {
+                "$and": [
+                    partition.id_bound("$gt", "a"),
+                    {
+                        "$or": [
+                            {"_id": {"$lte": oid}},
+                            {
+                                "_id": {
+                                    "$type": [
+                                        "minKey",
+                                        "null",
+                                        "double",
+                                        "int",
+                                        "long",
+                                        "decimal",
+                                        "symbol",
+                                        "string",
+                                        "object",
+                                        "array",
+                                        "binData",
+                                    ]
+                                }
+                            },
+                        ]
+                    },
+                ]
+            },
+        )
+
+    def test_id_bound_types(self):
+        self.assertEqual(
+            partition.id_bound("$gt", bson.MaxKey()), {"_id": {"$gt": bson.MaxKey()}}
+        )
+        self.assertEqual(
+            partition.id_bound("$gt", datetime.datetime(2020, 1, 1))["$or"][1],
+            {"_id": {"$type": ["timestamp", "regex", "maxKey"]}},
+        )
+        self.assertEqual(
+            partition.id_bound("$lte", True)["$or"][1]["_id"]["$type"][-1],
+            "objectId",
+        )
+        code = bson.Code("x")
+        self.assertEqual(partition.id_bound("$gt", code), {"_id": {"$gt": code}})
+
+    def test_object_ids(self):
+        ids = [bson.ObjectId() for _ in range(10)]
+        filters = partition.partition_filters(self.sampled(ids), 2)
+        self.assertEqual(filters[0], {"_id": {"$type": "objectId", "$lt": ids[5]}})
@@ -1,5 +1,14 @@
-from crate.migr8 import extract
+import json
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from crate.migr8 import extract, partition
+from crate.migr8.metrics import Metrics
 import bson
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
 
 import unittest
 
@@ -56,6 +65,27 @@ class TestExtractTypes(unittest.TestCase):
         self.assertListEqual(["OBJECT"], list(s["a"]["types"].keys()))
 
 
+class TestExtractBSONTypes(unittest.TestCase):
+    def test_types(self):
+        i = {
+            "a": bson.Decimal128("1.5"),
+            "b": bson.Binary(b"ab", 0x80),
+            "c": b"ab",
+            "d": bson.regex.Regex("^a", "i"),
+            "e": re.compile("b"),
+        }
+        expected = {
+            "a": "DECIMAL128",
+            "b": "BINARY",
+            "c": "BINARY",
+            "d": "REGEX",
+            "e": "REGEX",
+        }
+        s = extract.extract_schema_from_document(bson.decode(bson.encode(i)), {})
+        for key, value in expected.items():
+            self.assertListEqual([value], list(s[key]["types"]))
+
+
 class TestTypeCount(unittest.TestCase):
     def test_multiple_of_same_type(self):
         i = [{"a": 2}, {"a": 3}, {"a": 6}]
@@ -74,3 +104,212 @@ class TestTypeCount(unittest.TestCase):
         self.assertEqual(s["a"]["types"]["INTEGER"]["count"], 1)
         self.assertEqual(s["a"]["types"]["STRING"]["count"], 1)
         self.assertEqual(s["a"]["types"]["BOOLEAN"]["count"], 1)
+
+
+class TestExtractCollection(unittest.TestCase):
+    def finder(self, documents):
+        """Mocks ``find``, which yields no ``_id`` when only asked for it."""
+
+        def find(query=None, projection=None, **kwargs):
+            return iter([] if projection else documents)
+
+        return find
+
+    def collection(self, documents, estimated_count):
+        collection = mock.MagicMock()
+        collection.name = "test"
+        collection.estimated_document_count.return_value = estimated_count
+        collection.find.side_effect = self.finder(documents)
+        collection.aggregate.return_value = iter(documents)
+        return collection
+
+    def test_sample_size(self):
+        collection = self.collection([{"a": 1}, {"a": "b"}], 1000)
+        s = extract.extract_schema_from_collection(collection, False, sample_size=2)
+        collection.aggregate.assert_called_once_with(
+            [{"$sample": {"size": 2}}], allowDiskUse=True
+        )
+        collection.find.assert_not_called()
+        self.assertEqual(s["count"], 2)
+        self.assertEqual(s["sample_size"], 2)
+        self.assertEqual(s["estimated_count"], 1000)
+        self.assertEqual(list(s["document"]["a"]["types"]), ["INTEGER", "STRING"])
+
+    def test_sample_fraction(self):
+        collection = self.collection([{"a": 1}], 1000)
+        extract.extract_schema_from_collection(collection, False, sample_fraction=0.05)
+        collection.aggregate.assert_called_once_with(
+            [{"$sample": {"size": 50}}], allowDiskUse=True
+        )
+
+    def test_full_scan_is_not_annotated(self):
+        collection = self.collection([{"a": 1}, {"a": 2}], 2)
+        s = extract.extract_schema_from_collection(collection, False)
+        self.assertEqual(s["count"], 2)
+        self.assertNotIn("sample_size", s)
+
+    def test_full_scan_records_last_id(self):
+        last_id = bson.ObjectId()
+        collection = self.collection([{"a": 1}], 1)
+        collection.find.side_effect = lambda query=None, projection=None, **kw: iter(
+            [{"_id": last_id}] if projection else [{"a": 1}]
+        )
+        s = extract.extract_schema_from_collection(collection, False)
+        self.assertEqual(s["last_id"], {"$oid": str(last_id)})
+        self.assertEqual(collection.find.call_args.args, ())
+        # The scan only stops at the last _id when asked to.
+        extract.extract_schema_from_collection(collection, False, upto_last_id=True)
+        self.assertEqual(
+            collection.find.call_args.args[0], partition.id_range(upto=last_id)
+        )
+        s = extract.extract_schema_from_collection(collection, True)
+        self.assertNotIn("last_id", s)
+
+    def test_refresh(self):
+        old_id, new_id = bson.ObjectId(), bson.ObjectId()
+        previous = {
+            "count": 2,
+            "document": {"a": {"count": 2, "types": {"INTEGER": {"count": 2}}}},
+            "last_id": {"$oid": str(old_id)},
+        }
+        tail = [{"a": "x"}, {"a": 3, "b": True}]
+
+        def find(query=None, projection=None, **kwargs):
+            if projection:
+                return iter([{"_id": new_id}])
+            self.assertEqual(
+                query,
+                {
+                    "$and": [
+                        partition.id_bound("$gt", old_id),
+                        partition.id_bound("$lte", new_id),
+                    ]
+                },
+            )
+            return iter(tail)
+
+        collection = self.collection([], 4)
+        collection.find.side_effect = find
+        collection.count_documents.return_value = 2
+        s = extract.refresh_schema_from_collection(collection, previous)
+
+        self.assertEqual(s["count"], 4)
+        self.assertEqual(
+            s["document"]["a"],
+            {"count": 4, "types": {"INTEGER": {"count": 3}, "STRING": {"count": 1}}},
+        )
+        self.assertEqual(s["document"]["b"]["count"], 1)
+        self.assertEqual(s["last_id"], {"$oid": str(new_id)})
+
+    def test_metrics(self):
+        documents = [{"a": 1}, {"a": "b"}]
+        raw = [RawBSONDocument(bson.encode(d)) for d in documents]
+        collection = self.collection([], 2)
+        collection.codec_options = CodecOptions()
+        collection.count_documents.return_value = 2
+        collection.with_options.return_value.find.side_effect = self.finder(raw)
+        metrics = Metrics()
+        s = extract.extract_schema_from_collection(
+            collection, False, query={"a": {"$exists": True}}, metrics=metrics
+        )
+        options = collection.with_options.call_args.kwargs["codec_options"]
+        self.assertIs(options.document_class, RawBSONDocument)
+        self.assertEqual(s["count"], 2)
+        self.assertEqual(
+            s["document"]["a"]["types"],
+            {"INTEGER": {"count": 1}, "STRING": {"count": 1}},
+        )
+        self.assertEqual(metrics.documents, 2)
+        self.assertEqual(metrics.bytes, sum(len(d.raw) for d in raw))
+        self.assertEqual(sorted(metrics.seconds), ["count", "decode", "fetch"])
+
+    def test_cancel(self):
+        cancel = threading.Event()
+
+        def documents():
+            cancel.set()
+            for i in range(5000):
+                yield {"a": i}
+
+        collection = self.collection(documents(), 5000)
+        s = extract.extract_schema_from_collection(collection, False, cancel=cancel)
+        # The extraction stops after the current batch.
+        self.assertEqual(s["count"], extract.BATCH_SIZE)
+
+    def test_concurrent_collections(self):
+        collections = [
+            self.collection([{"a": i} for i in range(100)], 100) for _ in range(4)
+        ]
+        tasks = len(extract.progress.tasks)
+        with ThreadPoolExecutor(4) as pool, extract.progress_display() as display:
+            schemas = list(
+                pool.map(
+                    lambda c: extract.extract_schema_from_collection(c, False),
+                    collections,
+                )
+            )
+            self.assertTrue(display.live.is_started)
+            self.assertEqual(len(display.tasks), tasks + 4)
+        self.assertFalse(extract.progress.live.is_started)
+        for s in schemas:
+            self.assertEqual(s["document"]["a"]["types"]["INTEGER"]["count"], 100)
+
+
+class TestSchemaCounter(unittest.TestCase):
+    documents = [
+        {"a": 1, "b": {"c": "x", "d": [1, [2.5, None]]}},
+        {"a": "x", "b": {"c": 2, "e": True}, "f": []},
+        {"a": 2, "d": [{"f": 1}, "y", {"f": "z"}], "b": {}},
+        {"g": None, "a": bson.Int64(3)},
+    ]
+
+    def test_matches_document_schema(self):
+        s = {}
+        for document in self.documents:
+            s = extract.extract_schema_from_document(document, s)
+        counter = extract.SchemaCounter()
+        counter.add(self.documents[:2])
+        counter.add(self.documents[2:])
+        self.assertEqual(counter.schema(), {"count": 4, "document": s})
+        # The order of fields and types is preserved as well.
+        self.assertEqual(
+            json.dumps(counter.schema()["document"]),
+            json.dumps(s),
+        )
+
+    def test_empty(self):
+        self.assertEqual(extract.SchemaCounter().schema(), {"count": 0, "document": {}})
+
+
+class TestMergeSchemas(unittest.TestCase):
+    def extract(self, documents):
+        s = {"count": 0, "document": {}}
+        for document in documents:
+            s["count"] += 1
+            s["document"] = extract.extract_schema_from_document(
+                document, s["document"]
+            )
+        return s
+
+    def test_merge(self):
+        documents = [
+            {"a": 1, "b": {"c": "x"}, "d": [1, [2.5]]},
+            {"a": "x", "b": {"c": 2, "e": True}},
+            {"a": 2, "d": [{"f": 1}, "y"]},
+            {"g": None},
+        ]
+        merged = extract.merge_schemas(
+            self.extract(documents[:2]), self.extract(documents[2:])
+        )
+        self.assertEqual(merged, self.extract(documents))
+
+    def test_merge_does_not_share_state(self):
+        a = {"count": 0, "document": {}}
+        b = self.extract([{"a": {"b": 1}}])
+        extract.merge_schemas(a, b)
+        extract.merge_schemas(a, b)
+        self.assertEqual(a["count"], 2)
+        self.assertEqual(b["count"], 1)
+        self.assertEqual(
+            b["document"]["a"]["types"]["OBJECT"]["document"]["b"]["count"], 1
+        )
@@ -1,8 +1,32 @@
+import argparse
+import datetime
+import io
+import json
+import os
+import sys
+import tempfile
 from unittest import mock
 
+import bson
 import pymongo
-
-from crate.migr8.__main__ import parse_input_numbers, gather_collections
+from bson.raw_bson import RawBSONDocument
+
+from crate.migr8.__main__ import (
+    extract,
+    fraction,
+    gather_collections,
+    get_args,
+    iso_date,
+    parse_input_numbers,
+    positive_int,
+)
+from crate.migr8.aggregate import aggregate_schema_from_collection
+from crate.migr8.export import export, export_parallel
+from crate.migr8.extract import (
+    extract_schema_from_collection,
+    extract_schema_parallel,
+)
+from crate.migr8.sink import StreamSink
 
 import unittest
 
@@ -39,6 +63,44 @@ class TestInputNumberParser(unittest.TestCase):
         self.assertEqual(parsed, [0, 1, 3, 5, 6, 7, 8, 9, 10, 11, 12])
 
 
+class TestSampleArguments(unittest.TestCase):
+    def parse(self, *argv):
+        with mock.patch.object(sys, "argv", ["migr8", "extract", *argv]):
+            return get_args()
+
+    def test_types(self):
+        self.assertEqual(positive_int("5"), 5)
+        self.assertEqual(fraction("1"), 1.0)
+        for value in ("0", "-1", "x"):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                positive_int(value)
+        for value in ("0", "1.5", "nan", "x"):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                fraction(value)
+
+    def test_invalid_arguments(self):
+        with mock.patch("sys.stderr", io.StringIO()), self.assertRaises(SystemExit):
+            self.parse("--sample-fraction", "2")
+        for argv in (
+            ["--sample-size", "10"],
+            ["--scan", "full", "--sample-fraction", "0.1"],
+            ["--scan", "sample", "--sample-size", "10", "--sample-fraction", "0.1"],
+        ):
+            args = self.parse("--database", "db", *argv)
+            with self.assertRaises(SystemExit):
+                extract(args)
+
+
+class TestDateArguments(unittest.TestCase):
+    def test_iso_date(self):
+        self.assertEqual(
+            iso_date("2024-01-01").isoformat(), "2024-01-01T00:00:00+00:00"
+        )
+        for value in ("2024-13-45", "garbage"):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                iso_date(value)
+
+
 class TestMongoDBIntegration(unittest.TestCase):
     """
     A few conditional integration test cases with MongoDB.
@@ -87,3 +149,89 @@ class TestMongoDBIntegration(unittest.TestCase):
         with mock.patch("builtins.input", return_value="unknown"):
             collections = gather_collections(database=self.db)
             self.assertEqual(collections, ["foobar"])
+
+    def test_export_parallel(self):
+        """
+        Verify that a parallel export yields the same documents as a serial one.
+        """
+        if self.client.server_info()["versionArray"] < [3, 2]:
+            raise self.skipTest("$sample requires MongoDB 3.2")
+        self.db.drop_collection("parallel")
+        self.db["parallel"].insert_many([{"n": i, "s": str(i)} for i in range(1000)])
+
+        out = io.BytesIO()
+        collection = self.client.get_database(
+            self.DBNAME,
+            codec_options=self.db.codec_options.with_options(
+                document_class=RawBSONDocument
+            ),
+        )["parallel"]
+        export(collection, StreamSink(out))
+
+        with tempfile.TemporaryDirectory() as directory:
+            export_parallel(self.HOST, self.PORT, self.DBNAME, "parallel", 4, directory)
+            with open(os.path.join(directory, "parallel.manifest.json")) as f:
+                manifest = json.load(f)
+            lines = []
+            for entry in manifest["files"]:
+                with open(os.path.join(directory, entry["file"]), "rb") as f:
+                    lines.extend(f.read().splitlines())
+        self.assertEqual(manifest["rows"], 1000)
+
+        self.assertEqual(sorted(lines), sorted(out.getvalue().splitlines()))
+
+    def test_extract_schema(self):
+        """
+        Verify that a full scan counts every document and records the last _id.
+        """
+        self.db.drop_collection("full")
+        self.db["full"].insert_many([{"n": i, "s": str(i)} for i in range(100)])
+        last_id = self.db["full"].find_one(sort=[("_id", -1)])["_id"]
+        schema = extract_schema_from_collection(self.db["full"], False)
+        self.assertEqual(schema["count"], 100)
+        self.assertEqual(schema["document"]["n"]["count"], 100)
+        self.assertEqual(schema["last_id"], {"$oid": str(last_id)})
+
+    def test_extract_schema_parallel(self):
+        """
+        Verify that a parallel schema extraction yields the same counts as a
+        serial one.
+        """
+        if self.client.server_info()["versionArray"] < [3, 2]:
+            raise self.skipTest("$sample requires MongoDB 3.2")
+        self.db.drop_collection("parallel")
+        self.db["parallel"].insert_many(
+            [{"n": i if i % 3 else str(i), "o": {"x": [i]}} for i in range(1000)]
+        )
+        serial = extract_schema_from_collection(self.db["parallel"], False)
+        parallel = extract_schema_parallel(
+            self.HOST, self.PORT, self.DBNAME, "parallel", 2
+        )
+        self.assertEqual(parallel, serial)
+
+    def test_aggregate_schema(self):
+        """
+        Verify that the aggregate engine yields the same schema as the python
+        engine.
+        """
+        if self.client.server_info()["versionArray"] < [3, 4, 4]:
+            raise self.skipTest("The aggregate engine requires MongoDB 3.4.4")
+        self.db.drop_collection("aggregate")
+        self.db["aggregate"].insert_many(
+            [
+                {
+                    "n": i if i % 3 else str(i),
+                    "l": bson.Int64(i) if i % 2 else 1.5,
+                    "d": datetime.datetime(2020, 1, 1) if i % 4 else None,
+                    "dec": bson.Decimal128(str(i)),
+                    "b": i % 5 == 0,
+                    "o": {"x": [i, {"y": "z"}, [None, True]], "oid": bson.ObjectId()},
+                    "a": [{"k": i}, "s"] if i % 2 else [],
+                }
+                for i in range(100)
+            ]
+        )
+        python = extract_schema_from_collection(self.db["aggregate"], False)
+        aggregated = aggregate_schema_from_collection(self.db["aggregate"], False)
+        self.assertEqual(aggregated["count"], python["count"])
+        self.assertEqual(aggregated["document"], python["document"])
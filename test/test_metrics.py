@@ -0,0 +1,105 @@
+import os
+import tempfile
+from unittest import mock
+
+import bson
+from bson.raw_bson import RawBSONDocument
+
+from crate.migr8 import export
+from crate.migr8.metrics import Metrics, Reporter, format_labels
+
+import unittest
+
+
+def raw(document):
+    return RawBSONDocument(bson.encode(document))
+
+
+class TestMetrics(unittest.TestCase):
+    def test_batches(self):
+        metrics = Metrics()
+        batches = [[raw({"a": 1}), raw({"a": 2})], [raw({"b": "x"})]]
+        self.assertEqual(list(metrics.batches(batches)), batches)
+        self.assertEqual(metrics.documents, 3)
+        self.assertEqual(metrics.bytes, 12 + 12 + 14)
+        self.assertEqual(list(metrics.seconds), ["fetch"])
+
+    def test_timed(self):
+        metrics = Metrics()
+        double = metrics.timed("convert", lambda x: 2 * x)
+        self.assertEqual(double(2), 4)
+        with self.assertRaises(ZeroDivisionError), metrics.time("write"):
+            1 / 0
+        self.assertEqual(sorted(metrics.seconds), ["convert", "write"])
+
+    def test_summary(self):
+        metrics = Metrics()
+        metrics.count(1000, 2**20)
+        metrics.record("fetch", 0.5)
+        self.assertRegex(
+            metrics.summary(),
+            r"^1,000 documents, 1\.0 MB in [\d.]+s "
+            r"\([\d,]+ documents/s, [\d.]+ MB/s\); fetch 0\.5s$",
+        )
+
+    def test_prometheus(self):
+        metrics = Metrics(command="export", collection="test")
+        metrics.count(10, 100)
+        metrics.record("write", 1.5)
+        text = metrics.prometheus()
+        self.assertIn("# TYPE migr8_documents_total counter\n", text)
+        self.assertIn(
+            'migr8_documents_total{command="export",collection="test"} 10\n', text
+        )
+        self.assertIn(
+            'migr8_bytes_total{command="export",collection="test"} 100\n', text
+        )
+        self.assertIn(
+            "migr8_stage_seconds_total"
+            '{command="export",collection="test",stage="write"} 1.5\n',
+            text,
+        )
+
+    def test_format_labels(self):
+        self.assertEqual(format_labels({}), "")
+        self.assertEqual(format_labels({"a": 'x"y\\'}), '{a="x\\"y\\\\"}')
+
+    def test_reporter(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "migr8.prom")
+            lines = []
+            metrics = Metrics()
+            with Reporter(metrics, 60, report=lines.append, path=path):
+                metrics.count(5)
+            self.assertEqual(len(lines), 1)
+            self.assertTrue(lines[0].startswith("5 documents"))
+            with open(path) as f:
+                self.assertIn("migr8_documents_total 5\n", f.read())
+            self.assertEqual(os.listdir(tmpdir), ["migr8.prom"])
+
+
+class TestExportMetrics(unittest.TestCase):
+    def test_export(self):
+        collection = mock.Mock()
+        collection.find.return_value = [raw({"_id": i, "n": i}) for i in range(5)]
+        metrics = Metrics()
+        export.export(
+            collection,
+            mock.Mock(),
+            batch_size=2,
+            coerce=lambda document: document,
+            metrics=metrics,
+        )
+        self.assertEqual(metrics.documents, 5)
+        self.assertEqual(metrics.bytes, 5 * 21)
+        self.assertEqual(
+            sorted(metrics.seconds), ["coerce", "convert", "fetch", "flush", "write"]
+        )
+
+    def test_export_with_workers(self):
+        collection = mock.Mock()
+        collection.find.return_value = [raw({"_id": i}) for i in range(10)]
+        metrics = Metrics()
+        export.export(collection, mock.Mock(), batch_size=3, workers=2, metrics=metrics)
+        self.assertEqual(metrics.documents, 10)
+        self.assertIn("convert", metrics.seconds)
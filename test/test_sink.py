@@ -0,0 +1,397 @@
+import gzip
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from crate.migr8 import sink
+
+import unittest
+
+
+class CrateDBStub(BaseHTTPRequestHandler):
+    """Answers CrateDB bulk requests, failing rows whose first value is None."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append((self.path, body))
+        self.server.connections.add(self.client_address)
+        results = [
+            {"rowcount": -2 if args[0] is None else 1} for args in body["bulk_args"]
+        ]
+        content = json.dumps({"cols": [], "results": results}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestCrateDBSink(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), CrateDBStub)
+        self.server.requests = []
+        self.server.connections = set()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "crate://127.0.0.1:{0}/test.items".format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_bulk_insert(self):
+        s = sink.CrateDBSink(self.url, batch_size=2, concurrency=1)
+        s.write({"a": 1, "b": "x"})
+        s.write({"a": 2, "b": "y"})
+        s.write({"a": 3})
+        s.write({"a": None, "b": "z"})
+        s.close()
+
+        self.assertEqual(s.inserted, 3)
+        self.assertEqual(s.failed, 1)
+        self.assertEqual(
+            self.server.requests,
+            [
+                (
+                    "/_sql",
+                    {
+                        "stmt": 'INSERT INTO "test"."items" ("a", "b") VALUES (?, ?)',
+                        "bulk_args": [[1, "x"], [2, "y"]],
+                    },
+                ),
+                (
+                    "/_sql",
+                    {
+                        "stmt": 'INSERT INTO "test"."items" ("a") VALUES (?)',
+                        "bulk_args": [[3]],
+                    },
+                ),
+                (
+                    "/_sql",
+                    {
+                        "stmt": 'INSERT INTO "test"."items" ("a", "b") VALUES (?, ?)',
+                        "bulk_args": [[None, "z"]],
+                    },
+                ),
+            ],
+        )
+        # All requests were sent over one keep-alive connection.
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_concurrent_requests(self):
+        s = sink.CrateDBSink(self.url, batch_size=10, concurrency=4)
+        for i in range(1000):
+            s.write({"i": i})
+        s.close()
+        self.assertEqual(s.inserted, 1000)
+        self.assertEqual(len(self.server.requests), 100)
+
+    def test_max_pending(self):
+        s = sink.CrateDBSink(self.url, batch_size=10, concurrency=1, max_pending=4)
+        for i in range(6):
+            s.write({"c{0}".format(i): i})
+        # The first four groups were sent once four rows were waiting.
+        s._raise_error()
+        self.assertEqual(s._pending_rows, 2)
+        s.close()
+        self.assertEqual(s.inserted, 6)
+        self.assertEqual(len(self.server.requests), 6)
+
+    def test_upsert(self):
+        s = sink.CrateDBSink(self.url, concurrency=1, primary_key="id")
+        s.write({"a": 1, "id": "x"})
+        s.write({"id": "y"})
+        s.write({"a": 2})
+        s.close()
+        self.assertEqual(
+            [body["stmt"] for _, body in self.server.requests],
+            [
+                'INSERT INTO "test"."items" ("a", "id") VALUES (?, ?) '
+                'ON CONFLICT ("id") DO UPDATE SET "a" = excluded."a"',
+                'INSERT INTO "test"."items" ("id") VALUES (?) '
+                'ON CONFLICT ("id") DO NOTHING',
+                'INSERT INTO "test"."items" ("a") VALUES (?)',
+            ],
+        )
+
+    def test_delete(self):
+        s = sink.CrateDBSink(self.url, batch_size=2, primary_key="id")
+        s.delete(["x", "y", "z"])
+        s.delete(["w"], count=False)
+        s.close()
+        self.assertEqual(s.deleted, 3)
+        self.assertEqual(
+            sorted(body["bulk_args"] for _, body in self.server.requests),
+            [[["w"]], [["x"], ["y"]], [["z"]]],
+        )
+        self.assertEqual(
+            self.server.requests[0][1]["stmt"],
+            'DELETE FROM "test"."items" WHERE "id" = ?',
+        )
+
+
+class FailingStub(CrateDBStub):
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.requests.append(self.path)
+        content = b'{"error": {"message": "SQLParseException"}}'
+        self.send_response(400)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class ClosingStub(CrateDBStub):
+    """Closes the keep-alive connection after each response."""
+
+    def do_POST(self):
+        super().do_POST()
+        self.close_connection = True
+
+
+class NoResponseStub(CrateDBStub):
+    """Closes the connection instead of answering the second request."""
+
+    def do_POST(self):
+        if self.server.requests:
+            self.rfile.read(int(self.headers["Content-Length"]))
+            self.server.requests.append((self.path, None))
+            self.close_connection = True
+            return
+        super().do_POST()
+
+
+class TestCrateDBSinkErrors(unittest.TestCase):
+    def serve(self, handler):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        server.requests = []
+        server.connections = set()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server, "crate://127.0.0.1:{0}/test.items".format(server.server_port)
+
+    def test_closed_keep_alive_connection(self):
+        server, url = self.serve(ClosingStub)
+        s = sink.CrateDBSink(url, batch_size=1, concurrency=1)
+        s.write({"a": 1})
+        s.flush()
+        time.sleep(0.1)
+        s.write({"a": 2})
+        s.close()
+        self.assertEqual(s.inserted, 2)
+        self.assertEqual(len(server.requests), 2)
+
+    def test_request_not_repeated(self):
+        server, url = self.serve(NoResponseStub)
+        s = sink.CrateDBSink(url, batch_size=1, concurrency=1)
+        s.write({"a": 1})
+        s.flush()
+        s.write({"a": 2})
+        with self.assertRaises(ConnectionError):
+            s.close()
+        # The rows of the second request may have been inserted.
+        self.assertEqual(len(server.requests), 2)
+
+    def test_failed_request_stops_writes(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), FailingStub)
+        server.requests = []
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = "crate://127.0.0.1:{0}/test.items".format(server.server_port)
+        s = sink.CrateDBSink(url, batch_size=1, concurrency=1)
+        s.write({"a": 1})
+        # The next request waits for the first one, and raises its error.
+        with self.assertRaises(sink.CrateDBError):
+            s.write({"a": 2})
+        with self.assertRaises(sink.CrateDBError):
+            s.close()
+        self.assertEqual(len(server.requests), 1)
+
+    def test_connection_error(self):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        url = "crate://127.0.0.1:{0}/test.items".format(port)
+        s = sink.CrateDBSink(url, batch_size=1)
+        s.write({"a": 1})
+        with self.assertRaises(ConnectionError):
+            s.close()
+
+
+class TestParseTarget(unittest.TestCase):
+    def test_defaults(self):
+        target = sink.parse_target("crate://localhost/items")
+        self.assertEqual(target["port"], 4200)
+        self.assertEqual(target["schema"], "doc")
+        self.assertEqual(target["table"], "items")
+
+    def test_credentials(self):
+        target = sink.parse_target("crate://crate:s%40cret@db:4201/test.items")
+        self.assertEqual(target["host"], "db")
+        self.assertEqual(target["port"], 4201)
+        self.assertEqual(target["username"], "crate")
+        self.assertEqual(target["password"], "s@cret")
+        self.assertEqual(target["schema"], "test")
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            sink.parse_target("http://localhost:4200/items")
+        with self.assertRaises(ValueError):
+            sink.parse_target("crate://localhost:4200/")
+
+
+class TestFileSink(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.directory = tmpdir.name
+        self.manifest = os.path.join(self.directory, "test.manifest.json")
+
+    def read(self, name, opener=open):
+        with opener(os.path.join(self.directory, name), "rb") as f:
+            return f.read()
+
+    def test_single_file(self):
+        s = sink.FileSink(self.directory, "test", manifest=self.manifest)
+        s.write({"a": 1})
+        s.write({"a": 2})
+        s.close()
+        self.assertEqual(self.read("test.json"), b'{"a":1}\n{"a":2}\n')
+        with open(self.manifest) as f:
+            manifest = json.load(f)
+        self.assertEqual(
+            manifest,
+            {
+                "compression": None,
+                "rows": 2,
+                "files": [{"file": "test.json", "rows": 2, "bytes": 16}],
+            },
+        )
+
+    def test_chunks(self):
+        s = sink.FileSink(self.directory, "test", chunk_size=20, compress="gzip")
+        for i in range(5):
+            s.write({"a": i})
+        s.close()
+        self.assertEqual(
+            s.files,
+            [
+                {"file": "test-00000.json.gz", "rows": 2, "bytes": 16},
+                {"file": "test-00001.json.gz", "rows": 2, "bytes": 16},
+                {"file": "test-00002.json.gz", "rows": 1, "bytes": 8},
+            ],
+        )
+        self.assertEqual(
+            self.read("test-00001.json.gz", gzip.open), b'{"a":2}\n{"a":3}\n'
+        )
+        self.assertFalse(os.path.exists(self.manifest))
+
+    def test_batch_across_chunks(self):
+        s = sink.FileSink(self.directory, "test", chunk_size=20)
+        s.write_batch([{"a": i} for i in range(5)])
+        s.close()
+        self.assertEqual([f["rows"] for f in s.files], [2, 2, 1])
+        self.assertEqual(self.read("test-00002.json"), b'{"a":4}\n')
+
+    def test_document_larger_than_chunk(self):
+        s = sink.FileSink(self.directory, "test", chunk_size=4)
+        s.write({"a": 1})
+        s.write({"a": 2})
+        s.close()
+        self.assertEqual([f["rows"] for f in s.files], [1, 1])
+
+    @unittest.skipIf(sink.zstandard is None, "zstandard is not installed")
+    def test_zstd(self):
+        s = sink.FileSink(self.directory, "test", compress="zstd")
+        s.write({"a": 1})
+        s.close()
+        data = (
+            sink.zstandard.ZstdDecompressor()
+            .decompressobj()
+            .decompress(self.read("test.json.zst"))
+        )
+        self.assertEqual(data, b'{"a":1}\n')
+
+    def test_append(self):
+        for compress in (None, "gzip"):
+            for chunk_size in (None, 100):
+                s = sink.FileSink(
+                    self.directory, "test", chunk_size, compress, self.manifest
+                )
+                s.write({"a": 1})
+                s.close()
+                s = sink.FileSink(
+                    self.directory,
+                    "test",
+                    chunk_size,
+                    compress,
+                    self.manifest,
+                    append=True,
+                )
+                s.write({"a": 2})
+                s.close()
+                opener = gzip.open if compress else open
+                data = b"".join(self.read(f["file"], opener) for f in s.files)
+                self.assertEqual(data, b'{"a":1}\n{"a":2}\n')
+                self.assertEqual(sum(f["rows"] for f in s.files), 2)
+                self.assertEqual(len(s.files), 1 if chunk_size is None else 2)
+                for f in s.files:
+                    os.remove(os.path.join(self.directory, f["file"]))
+                os.remove(self.manifest)
+
+    def test_resume_at_position(self):
+        for compress in (None, "gzip"):
+            for chunk_size in (None, 20):
+                s = sink.FileSink(
+                    self.directory, "test", chunk_size, compress, self.manifest
+                )
+                s.write_batch([{"a": 1}, {"a": 2}])
+                position = s.position()
+                s.write_batch([{"a": 3}])
+                position = s.position()
+                # Written after the position, and discarded when resuming.
+                s.write_batch([{"a": 4}, {"a": 5}, {"a": 6}])
+                s.close()
+                s = sink.FileSink(
+                    self.directory,
+                    "test",
+                    chunk_size,
+                    compress,
+                    self.manifest,
+                    position=position,
+                )
+                s.write({"a": 7})
+                s.close()
+                opener = gzip.open if compress else open
+                data = b"".join(self.read(f["file"], opener) for f in s.files)
+                self.assertEqual(data, b'{"a":1}\n{"a":2}\n{"a":3}\n{"a":7}\n')
+                self.assertEqual(sum(f["rows"] for f in s.files), 4)
+                self.assertEqual(
+                    sorted(os.listdir(self.directory)),
+                    sorted([f["file"] for f in s.files] + ["test.manifest.json"]),
+                )
+                for f in s.files:
+                    os.remove(os.path.join(self.directory, f["file"]))
+                os.remove(self.manifest)
+
+
+class TestParseSize(unittest.TestCase):
+    def test_units(self):
+        self.assertEqual(sink.parse_size("512"), 512)
+        self.assertEqual(sink.parse_size("64KB"), 64 * 1024)
+        self.assertEqual(sink.parse_size("10 mb"), 10 * 1024**2)
+        self.assertEqual(sink.parse_size("1GiB"), 1024**3)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            sink.parse_size("1 PB")
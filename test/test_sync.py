@@ -0,0 +1,272 @@
+import json
+import os
+import tempfile
+from unittest import mock
+
+import bson
+from bson.raw_bson import RawBSONDocument
+
+from crate.migr8 import sync
+
+import unittest
+
+
+def raw(document):
+    return RawBSONDocument(bson.encode(document))
+
+
+class ChangeStream:
+    """Stands in for a pymongo change stream, returning the given changes and
+    then ``None``, as if no further changes arrived. Like pymongo's, its
+    ``resume_token`` is the one of the last change returned, or the one after
+    all of them once ``None`` is returned.
+    """
+
+    def __init__(self, changes, resume_token, end_token=None):
+        self.changes = [raw(change) for change in changes]
+        self.resume_token = raw(resume_token)
+        self.end_token = raw(end_token) if end_token is not None else None
+        self.alive = True
+        self.polls = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.alive = False
+
+    def try_next(self):
+        if self.changes:
+            change = self.changes.pop(0)
+            if change["operationType"] in sync.STOP_EVENTS:
+                self.alive = False
+            self.resume_token = change["_id"]
+            return change
+        if self.end_token is not None:
+            self.resume_token = self.end_token
+        self.polls += 1
+        return None
+
+
+class Sink:
+    def __init__(self):
+        self.rows = {}
+        self.flushes = 0
+        self.failed = 0
+
+    def write_batch(self, documents):
+        for document in documents:
+            self.rows.setdefault(document["id"], {}).update(document)
+
+    def delete(self, keys, count=True):
+        for key in keys:
+            self.rows.pop(key, None)
+
+    def flush(self):
+        self.flushes += 1
+
+
+def change(n, operation, _id, document=None, **extra):
+    change = {
+        "_id": {"_data": str(n)},
+        "operationType": operation,
+        "documentKey": {"_id": _id},
+    }
+    if document is not None:
+        change["fullDocument"] = dict(document, _id=_id)
+    change.update(extra)
+    return change
+
+
+class TestSync(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, "sync.json")
+        self.collection = mock.Mock()
+        self.collection.find.return_value = [
+            raw({"_id": 1, "n": 1}),
+            raw({"_id": 2, "n": 2}),
+        ]
+        self.sink = Sink()
+
+    def watch(self, changes, end_token=None):
+        stream = ChangeStream(changes, {"_data": "0"}, end_token)
+        self.collection.watch.return_value = stream
+        return stream
+
+    def test_export_and_apply_changes(self):
+        self.watch(
+            [
+                change(1, "insert", 3, {"n": 3}),
+                change(
+                    2,
+                    "update",
+                    1,
+                    {"m": 1},
+                    updateDescription={
+                        "updatedFields": {"m": 1},
+                        "removedFields": ["n"],
+                    },
+                ),
+                change(3, "delete", 2),
+                change(4, "replace", 3, {"n": 4}),
+                change(5, "drop", None),
+            ]
+        )
+        state = sync.SyncState(self.path, "db", "test")
+        reported = []
+        stopped = sync.sync(
+            self.collection,
+            self.sink,
+            state=state,
+            report=lambda *counts: reported.append(counts),
+        )
+        self.assertEqual(stopped, "drop")
+        self.assertEqual(
+            self.sink.rows,
+            {"1": {"id": "1", "n": None, "m": 1}, "3": {"id": "3", "n": 4}},
+        )
+        self.assertEqual(reported, [(2, 1)])
+        with open(self.path) as f:
+            self.assertEqual(json.load(f)["resume_token"], {"_data": "4"})
+
+    def test_resume(self):
+        state = sync.SyncState(self.path, "db", "test")
+        state.resume_token = {"_data": "4"}
+        state.save()
+
+        self.watch([change(5, "insert", 5, {"n": 5}), change(6, "invalidate", None)])
+        resumed = sync.SyncState(self.path, "db", "test")
+        resumed.load()
+        sync.sync(self.collection, self.sink, state=resumed)
+
+        self.collection.find.assert_not_called()
+        self.assertEqual(
+            self.collection.watch.call_args.kwargs["resume_after"], {"_data": "4"}
+        )
+        self.assertEqual(self.sink.rows, {"5": {"id": "5", "n": 5}})
+        self.assertEqual(resumed.resume_token, {"_data": "5"})
+
+    def test_resume_other_collection(self):
+        sync.SyncState(self.path, "db", "test").save()
+        with self.assertRaises(ValueError):
+            sync.SyncState(self.path, "db", "other").load()
+
+    def test_failed_rows_stop_sync(self):
+        self.watch([change(1, "insert", 3, {"n": 3}), change(2, "insert", 4, {})])
+        state = sync.SyncState(self.path, "db", "test")
+        state.resume_token = {"_data": "0"}
+
+        def fail(documents):
+            self.sink.failed += len(documents)
+
+        self.sink.write_batch = fail
+        with self.assertRaisesRegex(sync.CrateDBError, "2 rows failed"):
+            sync.sync(self.collection, self.sink, state=state)
+        self.assertEqual(state.resume_token, {"_data": "0"})
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_failed_export_is_not_saved(self):
+        self.watch([])
+        state = sync.SyncState(self.path, "db", "test")
+        self.sink.failed = 1
+        with self.assertRaises(sync.CrateDBError):
+            sync.sync(self.collection, self.sink, state=state)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_save_resume_token_while_idle(self):
+        stream = self.watch([change(1, "insert", 3, {"n": 3})], {"_data": "9"})
+        state = sync.SyncState(self.path, "db", "test")
+        reported = []
+        stop = mock.Mock(is_set=lambda: stream.polls > 3)
+        sync.sync(
+            self.collection,
+            self.sink,
+            state=state,
+            interval=0,
+            stop=stop,
+            report=lambda *counts: reported.append(counts),
+        )
+        self.assertEqual(reported, [(1, 0)])
+        with open(self.path) as f:
+            self.assertEqual(json.load(f)["resume_token"], {"_data": "9"})
+
+    def test_micro_batches(self):
+        stream = ChangeStream(
+            [change(i, "insert", i, {"n": i}) for i in range(5)], {"_data": "0"}
+        )
+
+        def stop_when_idle():
+            return stream.polls > 0
+
+        stop = mock.Mock(is_set=stop_when_idle)
+        batches = list(sync.micro_batches(stream, 2, 60, stop))
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+
+    def test_latest_change_wins(self):
+        changes = [
+            raw(change(1, "insert", 1, {"n": 1})),
+            raw(change(2, "delete", 1)),
+            raw(change(3, "insert", 2, {"n": 2})),
+            raw(change(4, "update", 2, {"n": 3}, updateDescription={})),
+        ]
+        self.sink.rows = {"1": {"id": "1", "n": 0}}
+        counts = sync.apply_changes(self.sink, changes, "id")
+        self.assertEqual(counts, (1, 1))
+        self.assertEqual(self.sink.rows, {"2": {"id": "2", "n": 3}})
+
+    def test_replace(self):
+        self.sink.rows = {
+            "1": {"id": "1", "a": 1, "b": 1},
+            "2": {"id": "2", "a": 2, "b": 2},
+            "3": {"id": "3", "a": 3, "b": 3},
+        }
+        changes = [
+            raw(change(1, "replace", 1, {"a": 4})),
+            # Deleted and inserted again, or replaced and updated.
+            raw(change(2, "delete", 2)),
+            raw(change(3, "insert", 2, {"b": 5})),
+            raw(change(4, "replace", 3, {"a": 6, "c": 6})),
+            raw(
+                change(
+                    5,
+                    "update",
+                    3,
+                    {"a": 6},
+                    updateDescription={"removedFields": ["c"]},
+                )
+            ),
+        ]
+        counts = sync.apply_changes(self.sink, changes, "id")
+        self.assertEqual(counts, (3, 0))
+        self.assertEqual(
+            self.sink.rows,
+            {
+                "1": {"id": "1", "a": 4},
+                "2": {"id": "2", "b": 5},
+                "3": {"id": "3", "a": 6, "c": None},
+            },
+        )
+
+    def test_removed_fields_of_earlier_updates(self):
+        self.sink.rows = {"1": {"id": "1", "a": 1, "b": 1}}
+        changes = [
+            raw(
+                change(
+                    1, "update", 1, {"b": 1}, updateDescription={"removedFields": ["a"]}
+                )
+            ),
+            raw(change(2, "update", 1, {"b": 2}, updateDescription={})),
+        ]
+        sync.apply_changes(self.sink, changes, "id")
+        self.assertEqual(self.sink.rows, {"1": {"id": "1", "a": None, "b": 2}})
+
+    def test_delete_keeps_other_id_types(self):
+        changes = [
+            raw(change(1, "insert", 5, {"n": 1})),
+            raw(change(2, "insert", "5", {"n": 2})),
+            raw(change(3, "delete", "5")),
+        ]
+        sync.apply_changes(self.sink, changes, "id")
+        self.assertEqual(self.sink.rows, {"5": {"id": "5", "n": 1}})
@@ -50,3 +50,41 @@ class TestTranslate(unittest.TestCase):
         i = {"count": 1, "types": {"STRING": {"count": 1}}}
         o = translate.translate_array(i)
         self.assertEqual("ARRAY(TEXT)", o)
+
+    def test_sampled_schema(self):
+        i = {
+            "test": {
+                "count": 10,
+                "sample_size": 10,
+                "estimated_count": 5000,
+                "document": {"a": {"count": 10, "types": {"STRING": {"count": 10}}}},
+            }
+        }
+        o = translate.translate(i)["test"]
+        self.assertEqual(
+            o.split("\n")[1], "-- Schema sampled from 10 of ~5000 documents"
+        )
+        self.assertIn('"a" TEXT', o)
+
+    def test_dominant_type(self):
+        field = {"count": 3, "types": {"STRING": {"count": 1}, "FLOAT": {"count": 2}}}
+        self.assertEqual(translate.dominant_type(field), "FLOAT")
+        self.assertIsNone(translate.dominant_type({"count": 0, "types": {}}))
+
+    def test_primary_key(self):
+        i = {
+            "test": {
+                "count": 1,
+                "document": {
+                    "_id": {"count": 1, "types": {"OID": {"count": 1}}},
+                    "id": {"count": 1, "types": {"INTEGER": {"count": 1}}},
+                    "a": {"count": 1, "types": {"STRING": {"count": 1}}},
+                },
+            }
+        }
+        o = translate.translate(i, id_column="key")["test"]
+        self.assertIn('"key" TEXT PRIMARY KEY,\n    "id" INTEGER,\n    "a" TEXT\n', o)
+        self.assertNotIn("PRIMARY KEY", translate.translate(i)["test"])
+        # The field would be lost in the primary key column.
+        with self.assertRaisesRegex(ValueError, "test has a field named id"):
+            translate.translate(i, id_column="id")